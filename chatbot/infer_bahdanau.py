@@ -3,7 +3,14 @@ from __future__ import print_function
 import tensorflow as tf
 from tensorflow.python.ops import lookup_ops
 import numpy as np
+import os
+import sys
+
+# common/ holds the modules shared by all the projects
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
 from process_cornell import process_line
+from common.rnn_cells import create_lstm_cell, fused_bidirectional_lstm
+from common.beam_search import decode_length, beam_search_decode
 
 # TODO: Use tf.app.flags
 flags = tf.app.flags
@@ -15,6 +22,9 @@ flags.DEFINE_integer('hidden_size', 300, 'hidden size of RNN cell')
 flags.DEFINE_integer('encoder_num_layers', 2, 'number of layers of encoder')
 flags.DEFINE_integer('decoder_num_layers', 2, 'number of layers of decoder')
 flags.DEFINE_integer('batch_size', 1, 'batch size')
+flags.DEFINE_string('cell_type', 'lstm', 'LSTM implementation: lstm, block (LSTMBlockCell) or fused (LSTMBlockFusedCell encoder)')
+flags.DEFINE_integer('beam_width', 1, 'beam width, 1 for greedy decoding')
+flags.DEFINE_float('length_penalty_weight', 1.0, 'length normalization of beam scores, 0 to disable')
 
 FLAGS = flags.FLAGS
 
@@ -36,7 +46,8 @@ def create_network(source_sequence, sos, eos,
                    # target_sequence_length,
                    vocab_size,
                    hidden_size, batch_size,
-                   encoder_num_layers, decoder_num_layers):
+                   encoder_num_layers, decoder_num_layers,
+                   cell_type, beam_width, length_penalty_weight):
   with tf.variable_scope('encoder'):
     encoder_embedding = tf.get_variable(
       'encoder_embedding_weights',
@@ -48,27 +59,31 @@ def create_network(source_sequence, sos, eos,
     encoder_embedded = tf.nn.embedding_lookup(encoder_embedding, source_sequence)
 
     def _create_encoder_cell(hidden_size):
-      cell =  tf.nn.rnn_cell.LSTMCell(hidden_size)
-      return cell
+      return create_lstm_cell(cell_type, hidden_size)
 
     bi_num_layers = int(encoder_num_layers / 2)
 
-    if bi_num_layers == 1:
-      fw_encoder_lstm = _create_encoder_cell(hidden_size)
-      bw_encoder_lstm = _create_encoder_cell(hidden_size)
+    if cell_type == 'fused':
+      encoder_outputs, bi_encoder_state = fused_bidirectional_lstm(
+        encoder_embedded, source_sequence_length, hidden_size,
+        bi_num_layers, None)
     else:
-      fw_encoder_lstm = tf.nn.rnn_cell.MultiRNNCell(
-        [_create_encoder_cell(hidden_size) for _ in range(bi_num_layers)])
-      bw_encoder_lstm = tf.nn.rnn_cell.MultiRNNCell(
-        [_create_encoder_cell(hidden_size) for _ in range(bi_num_layers)])
-
-    encoder_outputs, bi_encoder_state = tf.nn.bidirectional_dynamic_rnn(
-      fw_encoder_lstm,
-      bw_encoder_lstm,
-      encoder_embedded,
-      dtype=tf.float32,
-      time_major=True,
-      sequence_length=source_sequence_length)
+      if bi_num_layers == 1:
+        fw_encoder_lstm = _create_encoder_cell(hidden_size)
+        bw_encoder_lstm = _create_encoder_cell(hidden_size)
+      else:
+        fw_encoder_lstm = tf.nn.rnn_cell.MultiRNNCell(
+          [_create_encoder_cell(hidden_size) for _ in range(bi_num_layers)])
+        bw_encoder_lstm = tf.nn.rnn_cell.MultiRNNCell(
+          [_create_encoder_cell(hidden_size) for _ in range(bi_num_layers)])
+
+      encoder_outputs, bi_encoder_state = tf.nn.bidirectional_dynamic_rnn(
+        fw_encoder_lstm,
+        bw_encoder_lstm,
+        encoder_embedded,
+        dtype=tf.float32,
+        time_major=True,
+        sequence_length=source_sequence_length)
 
     if bi_num_layers == 1:
       encoder_state = bi_encoder_state
@@ -81,8 +96,16 @@ def create_network(source_sequence, sos, eos,
 
     encoder_outputs = tf.concat(encoder_outputs, -1)
 
+  maximum_iterations = decode_length(source_sequence_length)
+  attention_state = tf.transpose(encoder_outputs, [1, 0, 2])
+  if beam_width > 1:
+    # Every beam attends over its own copy of the encoder outputs
+    attention_state = tf.contrib.seq2seq.tile_batch(attention_state, beam_width)
+    encoder_state = tf.contrib.seq2seq.tile_batch(encoder_state, beam_width)
+    source_sequence_length = tf.contrib.seq2seq.tile_batch(
+      source_sequence_length, beam_width)
+
   with tf.variable_scope('attention'):
-    attention_state = tf.transpose(encoder_outputs, [1, 0, 2])
     attention_mechanism = tf.contrib.seq2seq.BahdanauAttention(
       hidden_size,
       attention_state,
@@ -96,8 +119,7 @@ def create_network(source_sequence, sos, eos,
       initializer=tf.initializers.random_uniform(-1, 1, dtype=tf.float32))
 
     def _create_decoder_cell(hidden_size):
-      cell =  tf.nn.rnn_cell.LSTMCell(hidden_size)
-      return cell
+      return create_lstm_cell(cell_type, hidden_size)
     decoder_lstm = tf.nn.rnn_cell.MultiRNNCell(
       [_create_decoder_cell(hidden_size) for _ in range(decoder_num_layers)])
     decoder_lstm = tf.contrib.seq2seq.AttentionWrapper(
@@ -106,28 +128,39 @@ def create_network(source_sequence, sos, eos,
     decoder_output_layer = tf.layers.Dense(vocab_size, use_bias=False)
 
     decoder_initial_state = decoder_lstm.zero_state(
-      batch_size, tf.float32).clone(cell_state=encoder_state)
+      batch_size * beam_width, tf.float32).clone(cell_state=encoder_state)
 
     target_sos_id = tf.cast(vocab.lookup(tf.constant(sos)), tf.int32)
     target_eos_id = tf.cast(vocab.lookup(tf.constant(eos)), tf.int32)
     infer_sequence_in = tf.fill([batch_size], target_sos_id)
 
-    infer_helper = tf.contrib.seq2seq.GreedyEmbeddingHelper(
-      decoder_embedding,
-      infer_sequence_in,
-      target_eos_id)
-    infer_decoder = tf.contrib.seq2seq.BasicDecoder(
-      decoder_lstm,
-      infer_helper,
-      decoder_initial_state,
-      decoder_output_layer)
-
-    maximum_iterations = tf.round(tf.reduce_max(source_sequence_length) * 2)
-    infer_decoder_outputs, _, _ = tf.contrib.seq2seq.dynamic_decode(
-      infer_decoder,
-      output_time_major=True,
-      swap_memory=True)
-    preds = infer_decoder_outputs.sample_id
+    if beam_width > 1:
+      preds = beam_search_decode(
+        decoder_lstm,
+        decoder_embedding,
+        infer_sequence_in,
+        target_eos_id,
+        decoder_initial_state,
+        decoder_output_layer,
+        beam_width, length_penalty_weight,
+        maximum_iterations)
+    else:
+      infer_helper = tf.contrib.seq2seq.GreedyEmbeddingHelper(
+        decoder_embedding,
+        infer_sequence_in,
+        target_eos_id)
+      infer_decoder = tf.contrib.seq2seq.BasicDecoder(
+        decoder_lstm,
+        infer_helper,
+        decoder_initial_state,
+        decoder_output_layer)
+
+      infer_decoder_outputs, _, _ = tf.contrib.seq2seq.dynamic_decode(
+        infer_decoder,
+        maximum_iterations=maximum_iterations,
+        output_time_major=True,
+        swap_memory=True)
+      preds = infer_decoder_outputs.sample_id
 
   return preds
 
@@ -149,7 +182,8 @@ preds = create_network(
   source_sequence_length,
   vocab_size,
   FLAGS.hidden_size, FLAGS.batch_size,
-  FLAGS.encoder_num_layers, FLAGS.decoder_num_layers)
+  FLAGS.encoder_num_layers, FLAGS.decoder_num_layers,
+  FLAGS.cell_type, FLAGS.beam_width, FLAGS.length_penalty_weight)
 
 sess = tf.Session()
 
@@ -0,0 +1,163 @@
+from __future__ import print_function
+
+import os
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+
+class AsyncCheckpointer(object):
+  """
+  Save checkpoints without blocking the training loop
+
+  save() only copies the variables to host memory, a background thread writes them
+  through a separate graph whose Saver uses the same variable names as the model.
+  The last `max_to_keep` checkpoints are kept. If `average_decay` > 0, an exponential
+  moving average is also written to an 'average' sub-directory: it is updated once per
+  save() from the saved snapshots (not at every training step), only the trainable
+  variables are averaged, the others (optimizer slots, global step) are the latest values.
+  With enabled=False, save() calls `saver.save()` inline (the old behavior).
+  If writing a checkpoint fails, the error is raised by the next save() or close().
+  """
+
+  def __init__(self, sess, saver, max_to_keep=5, average_decay=0.,
+               enabled=True, var_list=None):
+    self._sess = sess
+    self._saver = saver
+    self._enabled = enabled
+    self._average_decay = average_decay
+    self._var_list = var_list or tf.global_variables()
+    trainable = set(tf.trainable_variables())
+    self._averaged = [var in trainable for var in self._var_list]
+    self._average = None
+    self._error = None
+    self.pause_times = []
+    self.write_times = []
+
+    if not enabled:
+      return
+
+    self._graph = tf.Graph()
+    with self._graph.as_default():
+      self._placeholders = []
+      assign_ops = []
+      writer_vars = {}
+      for i, var in enumerate(self._var_list):
+        dtype = var.dtype.base_dtype
+        placeholder = tf.placeholder(dtype, var.shape)
+        writer_var = tf.Variable(
+          tf.zeros(var.shape, dtype), name='writer_var_{}'.format(i))
+        self._placeholders.append(placeholder)
+        assign_ops.append(tf.assign(writer_var, placeholder))
+        writer_vars[var.op.name] = writer_var
+      self._assign_op = tf.group(*assign_ops)
+      self._writer_saver = tf.train.Saver(writer_vars, max_to_keep=max_to_keep)
+      self._average_saver = tf.train.Saver(writer_vars, max_to_keep=max_to_keep)
+      self._writer_sess = tf.Session()
+      self._writer_sess.run(tf.global_variables_initializer())
+
+    # Holds at most one pending snapshot, save() waits if the writer falls behind
+    self._queue = queue.Queue(maxsize=1)
+    self._thread = threading.Thread(target=self._write_loop)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def save(self, save_path):
+    start = time.time()
+    if not self._enabled:
+      self._saver.save(self._sess, save_path)
+    else:
+      values = self._sess.run(self._var_list)
+      # Fetched arrays may share memory with the variables the optimizer keeps updating
+      values = [v if v.flags['OWNDATA'] else np.copy(v) for v in values]
+      self._put((save_path, values))
+    pause = time.time() - start
+    self.pause_times.append(pause)
+    print('Training paused {:.3f}s to save {}'.format(pause, save_path))
+
+  def _check_error(self):
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise error
+
+  def _put(self, item):
+    """
+    Queue item for the writer thread, raise its error instead of waiting for it forever
+    """
+    while True:
+      self._check_error()
+      try:
+        self._queue.put(item, timeout=1.)
+        return
+      except queue.Full:
+        if not self._thread.is_alive():
+          self._check_error()
+          raise RuntimeError('The checkpoint writer thread stopped')
+
+  def _write(self, saver, save_path, values):
+    self._writer_sess.run(
+      self._assign_op, feed_dict=dict(zip(self._placeholders, values)))
+    directory = os.path.dirname(save_path)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+    saver.save(self._writer_sess, save_path, write_meta_graph=False)
+
+  def _write_loop(self):
+    while True:
+      item = self._queue.get()
+      if item is None:
+        break
+      try:
+        self._write_item(*item)
+      except Exception as e:
+        # Stop writing, save() and close() raise the error in the training thread
+        self._error = e
+        break
+
+  def _write_item(self, save_path, values):
+    start = time.time()
+    self._write(self._writer_saver, save_path, values)
+
+    if self._average_decay > 0:
+      if self._average is None:
+        self._average = [np.array(v) for v in values]
+      else:
+        for average, value, averaged in zip(self._average, values, self._averaged):
+          if averaged and np.issubdtype(average.dtype, np.floating):
+            average *= self._average_decay
+            average += (1 - self._average_decay) * value
+          else:
+            average[...] = value
+      self._write(
+        self._average_saver,
+        os.path.join(os.path.dirname(save_path), 'average',
+                     os.path.basename(save_path)),
+        self._average)
+
+    self.write_times.append(time.time() - start)
+
+  def close(self):
+    """
+    Wait for pending checkpoints to be written and print the stall statistics
+    """
+    if self._enabled:
+      try:
+        self._put(None)
+        self._thread.join()
+        self._check_error()
+      finally:
+        self._writer_sess.close()
+
+    if self.pause_times:
+      print('Checkpoints: {} saved, training paused {:.3f}s on average ({:.3f}s max)'.format(
+        len(self.pause_times), np.mean(self.pause_times), np.max(self.pause_times)))
+    if self.write_times:
+      print('Checkpoints: {:.3f}s on average to write in the background'.format(
+        np.mean(self.write_times)))
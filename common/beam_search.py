@@ -0,0 +1,40 @@
+import tensorflow as tf
+
+
+def decode_length(source_sequence_length, decode_length_ratio=2.):
+  """
+  Maximum number of decoding steps for a batch, proportional to its longest source sentence
+  """
+  return tf.to_int32(tf.round(
+    tf.to_float(tf.reduce_max(source_sequence_length)) * decode_length_ratio))
+
+
+def beam_search_decode(cell, embedding, start_tokens, end_token,
+                       initial_state, output_layer, beam_width,
+                       length_penalty_weight, maximum_iterations):
+  """
+  Batched beam search, decoding stops as soon as all beams of all sentences have finished
+  :param cell: Decoder cell, attention memory must be tiled with tf.contrib.seq2seq.tile_batch
+  :param start_tokens: Start token of every sentence, (batch_size,)
+  :param initial_state: Decoder initial state, tiled to batch_size * beam_width
+  :param output_layer: The tf.layers.Dense projecting onto the target vocabulary
+  :param length_penalty_weight: Strength of the length normalization of beam scores, 0 to disable
+  :return: Time-major ids of the best beam of every sentence, (max_time, batch_size)
+  """
+  decoder = tf.contrib.seq2seq.BeamSearchDecoder(
+    cell,
+    embedding,
+    start_tokens,
+    end_token,
+    initial_state,
+    beam_width,
+    output_layer=output_layer,
+    length_penalty_weight=length_penalty_weight)
+
+  decoder_outputs, _, _ = tf.contrib.seq2seq.dynamic_decode(
+    decoder,
+    maximum_iterations=maximum_iterations,
+    output_time_major=True,
+    swap_memory=True)
+  # Beams are sorted by score, (max_time, batch_size, beam_width)
+  return decoder_outputs.predicted_ids[:, :, 0]
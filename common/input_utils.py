@@ -0,0 +1,76 @@
+from __future__ import print_function
+
+import resource
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+def padded_batch_bytes(batch_size, source_max_length, target_max_length):
+  """
+  Upper bound of the memory taken by one padded batch
+  :param batch_size: Number of sentence pairs in a batch
+  :param source_max_length: Maximum length of source sequence
+  :param target_max_length: Maximum length of target sequence (without <s>/</s>)
+  :return: Size in bytes of (source, target_in, target_out, source_length, target_length)
+  """
+  # Everything is int32: source + target_in + target_out + two lengths
+  return 4 * batch_size * (source_max_length + 2 * (target_max_length + 1) + 2)
+
+
+def prefetch_buffer_size(memory_budget_mb, batch_size,
+                         source_max_length, target_max_length):
+  """
+  Number of padded batches to prefetch
+  :param memory_budget_mb: Memory (in MB) the input pipeline may hold, 0 to let tf.data decide
+  :return: tf.data.experimental.AUTOTUNE if there is no budget, otherwise the number
+           of padded batches that fit into the budget (at least one)
+  """
+  if memory_budget_mb <= 0:
+    return tf.data.experimental.AUTOTUNE
+  batch_bytes = padded_batch_bytes(batch_size, source_max_length, target_max_length)
+  return max(1, int(memory_budget_mb * 1024 * 1024) // batch_bytes)
+
+
+def peak_rss_mb():
+  # ru_maxrss is reported in kilobytes on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def benchmark_input_pipeline(sess, next_element, num_steps, warmup_steps=10):
+  """
+  Pull batches from the input pipeline alone, without running the model
+  :param sess: Session in which tables and iterator are already initialized
+  :param next_element: Output of iterator.get_next(), source sequence must come first
+                       and target sequence length last
+  :param num_steps: Number of batches to time
+  :param warmup_steps: Number of batches to pull before the timer starts
+  :return: A dict of the measured statistics
+  """
+  for _ in range(warmup_steps):
+    sess.run(next_element)
+
+  rss_before = peak_rss_mb()
+  num_elements = 0
+  num_tokens = 0
+  start = time.time()
+  for _ in range(num_steps):
+    batch = sess.run(next_element)
+    num_elements += batch[0].shape[0]
+    num_tokens += np.sum(batch[-1])
+  elapsed = time.time() - start
+
+  stats = {
+    'batches_per_sec': num_steps / elapsed,
+    'elements_per_sec': num_elements / elapsed,
+    'target_tokens_per_sec': num_tokens / elapsed,
+    'peak_rss_mb': peak_rss_mb(),
+    'peak_rss_before_mb': rss_before,
+  }
+  print('Input pipeline: {} batches in {:.2f}s'.format(num_steps, elapsed))
+  print('  {:.1f} batches/sec, {:.1f} elements/sec, {:.1f} target tokens/sec'.format(
+    stats['batches_per_sec'], stats['elements_per_sec'], stats['target_tokens_per_sec']))
+  print('  peak RSS {:.1f}MB (after warmup: {:.1f}MB)'.format(
+    stats['peak_rss_mb'], stats['peak_rss_before_mb']))
+  return stats
@@ -0,0 +1,73 @@
+import tensorflow as tf
+
+# 'lstm':  tf.nn.rnn_cell.LSTMCell, many small ops per time step
+# 'block': tf.contrib.rnn.LSTMBlockCell, one kernel per time step
+# 'fused': tf.contrib.rnn.LSTMBlockFusedCell, one kernel for the whole sequence (encoder only,
+#          the decoder falls back to 'block' since attention needs to step through time)
+# All of them create the same variables (.../lstm_cell/kernel and .../lstm_cell/bias)
+# with the same gate layout, so checkpoints can be shared between cell types.
+CELL_TYPES = ['lstm', 'block', 'fused']
+
+
+def create_lstm_cell(cell_type, hidden_size, keep_prob=None):
+  if cell_type not in CELL_TYPES:
+    raise ValueError('Unknown cell type! Must be either lstm, block or fused.')
+
+  if cell_type == 'lstm':
+    cell = tf.nn.rnn_cell.LSTMCell(hidden_size)
+  else:
+    cell = tf.contrib.rnn.LSTMBlockCell(hidden_size, name='lstm_cell')
+
+  if keep_prob is None:
+    return cell
+  return tf.nn.rnn_cell.DropoutWrapper(cell, input_keep_prob=keep_prob)
+
+
+def fused_lstm(inputs, sequence_length, hidden_size, keep_prob, scopes):
+  """
+  Time-major stack of LSTMBlockFusedCell
+  :param inputs: Time-major inputs, (max_time, batch_size, input_size)
+  :param sequence_length: Length of every sequence in the batch
+  :param keep_prob: Keeping ratio of dropout applied to every layer's inputs, None to disable
+  :param scopes: Variable scope of every layer, the ones dynamic_rnn would use
+                 (e.g. 'rnn/multi_rnn_cell/cell_0') so that variable names match
+  :return: A tuple of (outputs of the last layer, tuple of LSTMStateTuple of every layer)
+  """
+  states = []
+  for scope in scopes:
+    if keep_prob is not None:
+      inputs = tf.nn.dropout(inputs, keep_prob)
+    with tf.variable_scope(scope):
+      cell = tf.contrib.rnn.LSTMBlockFusedCell(hidden_size, name='lstm_cell')
+      inputs, state = cell(
+        inputs, dtype=tf.float32, sequence_length=sequence_length)
+    states.append(state)
+  return inputs, tuple(states)
+
+
+def fused_bidirectional_lstm(inputs, sequence_length, hidden_size,
+                             num_layers, keep_prob):
+  """
+  Fused replacement of tf.nn.bidirectional_dynamic_rnn(fw_cell, bw_cell, time_major=True),
+  where each direction is one LSTM cell if num_layers == 1, or a MultiRNNCell otherwise
+  :return: The same ((fw_outputs, bw_outputs), (fw_state, bw_state)) as bidirectional_dynamic_rnn
+  """
+  def _scopes(direction):
+    prefix = 'bidirectional_rnn/' + direction
+    if num_layers == 1:
+      return [prefix]
+    return ['{}/multi_rnn_cell/cell_{}'.format(prefix, i) for i in range(num_layers)]
+
+  fw_outputs, fw_states = fused_lstm(
+    inputs, sequence_length, hidden_size, keep_prob, _scopes('fw'))
+
+  reversed_inputs = tf.reverse_sequence(
+    inputs, sequence_length, seq_axis=0, batch_axis=1)
+  bw_outputs, bw_states = fused_lstm(
+    reversed_inputs, sequence_length, hidden_size, keep_prob, _scopes('bw'))
+  bw_outputs = tf.reverse_sequence(
+    bw_outputs, sequence_length, seq_axis=0, batch_axis=1)
+
+  if num_layers == 1:
+    fw_states, bw_states = fw_states[0], bw_states[0]
+  return (fw_outputs, bw_outputs), (fw_states, bw_states)
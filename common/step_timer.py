@@ -0,0 +1,119 @@
+from __future__ import print_function
+
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class StepTimer(object):
+  """
+  Split each training step into time spent waiting for data, copying it to the device
+  and computing
+
+  Usage:
+    step_timer = StepTimer(report_every=100)
+    for batch in step_timer.iterate(batches):
+      with step_timer.copying():
+        batch = to_device(batch)
+      with step_timer.computing():
+        loss = train_step(batch)
+      step_timer.end_step(num_tokens)
+    step_timer.report()
+
+  When the input pipeline lives inside the graph (TF1 iterators),
+  fetch the batch under `step_timer.waiting()` and feed it to the step instead.
+  Copies to the device are optional, they are reported only if some were timed.
+  """
+
+  def __init__(self, report_every=100, enabled=True, name='train'):
+    self.report_every = report_every
+    self.enabled = enabled
+    self.name = name
+    self.recent = deque(maxlen=report_every)
+    self.steps = []
+    self._wait = 0.
+    self._copy = 0.
+    self._compute = 0.
+
+  @contextmanager
+  def waiting(self):
+    start = time.time()
+    yield
+    self._wait += time.time() - start
+
+  @contextmanager
+  def copying(self):
+    start = time.time()
+    yield
+    self._copy += time.time() - start
+
+  @contextmanager
+  def computing(self):
+    start = time.time()
+    yield
+    self._compute += time.time() - start
+
+  def iterate(self, iterable):
+    """
+    Yield the items of `iterable`, timing each `next()` as waiting for data
+    """
+    if not self.enabled:
+      for item in iterable:
+        yield item
+      return
+
+    iterator = iter(iterable)
+    while True:
+      with self.waiting():
+        try:
+          item = next(iterator)
+        except StopIteration:
+          return
+      yield item
+
+  def end_step(self, num_tokens=0):
+    if not self.enabled:
+      return
+    step = (self._wait, self._copy, self._compute, int(num_tokens))
+    self.recent.append(step)
+    self.steps.append(step)
+    self._wait = 0.
+    self._copy = 0.
+    self._compute = 0.
+    if len(self.steps) % self.report_every == 0:
+      print('[{}] last {} steps: {}'.format(
+        self.name, len(self.recent), self._summary(self.recent)))
+
+  @staticmethod
+  def _summary(steps):
+    wait, copy, compute, tokens = (np.array(x, dtype=np.float64) for x in zip(*steps))
+    total = max(wait.sum() + copy.sum() + compute.sum(), 1e-12)
+    summary = 'wait {:.1f}ms/step ({:.1%}), '.format(1000 * wait.mean(), wait.sum() / total)
+    if copy.sum() > 0:
+      summary += 'copy {:.1f}ms/step ({:.1%}), '.format(1000 * copy.mean(), copy.sum() / total)
+    return summary + 'compute {:.1f}ms/step, {:.0f} tokens/sec'.format(
+      1000 * compute.mean(), tokens.sum() / total)
+
+  def report(self):
+    if not self.enabled or not self.steps:
+      return
+    wait, copy, compute, _ = (np.array(x) for x in zip(*self.steps))
+    print('[{}] {} steps: {}'.format(
+      self.name, len(self.steps), self._summary(self.steps)))
+    print('[{}] wait p50 {:.1f}ms, p95 {:.1f}ms, max {:.1f}ms; '
+          'compute p50 {:.1f}ms, p95 {:.1f}ms'.format(
+            self.name,
+            1000 * np.percentile(wait, 50), 1000 * np.percentile(wait, 95),
+            1000 * wait.max(),
+            1000 * np.percentile(compute, 50), 1000 * np.percentile(compute, 95)))
+    total = wait.sum() + copy.sum() + compute.sum()
+    if wait.sum() > 0.1 * total:
+      print('[{}] More than 10% of the time is spent waiting for data: '
+            'the input pipeline is the bottleneck.'.format(self.name))
+    elif copy.sum() > 0.1 * total:
+      print('[{}] More than 10% of the time is spent copying batches to the device.'.format(
+        self.name))
+    else:
+      print('[{}] The model is the bottleneck.'.format(self.name))
@@ -1,9 +1,15 @@
+import os
+import sys
 import tensorflow as tf
 from prepare_data import read_data_from_file, get_dataset, get_eval_dataset, sample_eval_data
 from model import get_embed, get_loss_and_training_op, get_predictions, get_top_10_words
 import numpy as np
 import time
 
+# common/ holds the modules shared by all the projects
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from common.async_checkpoint import AsyncCheckpointer
+
 flags = tf.app.flags
 
 flags.DEFINE_string('mode', 'train',
@@ -39,6 +45,12 @@ flags.DEFINE_integer('print_every', 100,
                      'Print loss every ... iterations.')
 flags.DEFINE_integer('infer_every', 1000,
                      'Infer every ... iteration.')
+flags.DEFINE_boolean('async_checkpoint', True,
+                     'Write checkpoints in a background thread.')
+flags.DEFINE_integer('keep_checkpoints', 5,
+                     'Number of recent checkpoints to keep.')
+flags.DEFINE_float('average_decay', 0.,
+                   'Decay of the weight average saved with every checkpoint, 0 to disable.')
 
 FLAGS = flags.FLAGS
 
@@ -58,10 +70,13 @@ def train(n_vocab, labels, embedding, embed, int_to_vocab):
     loss_op, train_op = get_loss_and_training_op(n_vocab, labels, embed)
     valid_words = sample_eval_data()
     with tf.Session() as sess:
-        saver = tf.train.Saver()
+        saver = tf.train.Saver(max_to_keep=FLAGS.keep_checkpoints)
         all_losses = []
         batch_loss = []
         sess.run(tf.global_variables_initializer())
+        checkpointer = AsyncCheckpointer(
+            sess, saver, FLAGS.keep_checkpoints, FLAGS.average_decay,
+            enabled=FLAGS.async_checkpoint)
         start = time.time()
         for i in range(FLAGS.total_iterations):
             loss, _ = sess.run([loss_op, train_op])
@@ -76,11 +91,12 @@ def train(n_vocab, labels, embedding, embed, int_to_vocab):
                 start = time.time()
 
             if i % FLAGS.evaluate_every == 0:
-                saver.save(sess, 'checkpoint/model-{}.ckpt'.format(i))
+                checkpointer.save('checkpoint/model-{}.ckpt'.format(i))
                 pred_op = get_predictions(valid_words, embedding)
                 predictions = sess.run(pred_op)
                 words = get_top_10_words(predictions, int_to_vocab)
-        saver.save(sess, 'checkpoint/model.ckpt')
+        checkpointer.save('checkpoint/model.ckpt')
+        checkpointer.close()
         np.savez('checkpoint/all_losses.npz', all_losses)
 
 
@@ -0,0 +1,105 @@
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+import tensorflow as tf
+
+# common/ holds the modules shared by all the projects
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.rnn_cells import CELL_TYPES, create_lstm_cell, fused_lstm, fused_bidirectional_lstm
+
+# Times a training step (forward + backward) of the encoder with every cell type
+# and checks that all of them create exactly the same variables.
+# Run with CUDA_VISIBLE_DEVICES= to benchmark on CPU.
+flags = tf.app.flags
+flags.DEFINE_integer('hidden_size', 128, 'hidden size of RNN cell')
+flags.DEFINE_integer('num_layers', 2, 'number of layers (per direction if bidirectional)')
+flags.DEFINE_integer('batch_size', 128, 'batch size')
+flags.DEFINE_integer('max_time', 50, 'length of source sequences')
+flags.DEFINE_boolean('bidirectional', False, 'benchmark the bidirectional encoder')
+flags.DEFINE_float('keep_prob', 0.8, 'keeping ratio for dropout')
+flags.DEFINE_integer('num_steps', 20, 'number of timed training steps')
+flags.DEFINE_integer('warmup_steps', 3, 'number of untimed training steps')
+
+FLAGS = flags.FLAGS
+
+
+def build_encoder(cell_type, inputs, sequence_length):
+  if cell_type == 'fused':
+    if FLAGS.bidirectional:
+      outputs, _ = fused_bidirectional_lstm(
+        inputs, sequence_length, FLAGS.hidden_size,
+        FLAGS.num_layers, FLAGS.keep_prob)
+      return tf.concat(outputs, -1)
+    outputs, _ = fused_lstm(
+      inputs, sequence_length, FLAGS.hidden_size, FLAGS.keep_prob,
+      ['rnn/multi_rnn_cell/cell_{}'.format(i) for i in range(FLAGS.num_layers)])
+    return outputs
+
+  def _create_cell():
+    return tf.nn.rnn_cell.MultiRNNCell(
+      [create_lstm_cell(cell_type, FLAGS.hidden_size, FLAGS.keep_prob)
+       for _ in range(FLAGS.num_layers)])
+
+  if FLAGS.bidirectional:
+    if FLAGS.num_layers == 1:
+      fw_cell = create_lstm_cell(cell_type, FLAGS.hidden_size, FLAGS.keep_prob)
+      bw_cell = create_lstm_cell(cell_type, FLAGS.hidden_size, FLAGS.keep_prob)
+    else:
+      fw_cell, bw_cell = _create_cell(), _create_cell()
+    outputs, _ = tf.nn.bidirectional_dynamic_rnn(
+      fw_cell, bw_cell, inputs, dtype=tf.float32,
+      time_major=True, sequence_length=sequence_length)
+    return tf.concat(outputs, -1)
+
+  outputs, _ = tf.nn.dynamic_rnn(
+    _create_cell(), inputs, dtype=tf.float32,
+    time_major=True, sequence_length=sequence_length)
+  return outputs
+
+
+def time_train_step(cell_type):
+  tf.reset_default_graph()
+  inputs = tf.random_normal([FLAGS.max_time, FLAGS.batch_size, FLAGS.hidden_size])
+  sequence_length = tf.random_uniform(
+    [FLAGS.batch_size], FLAGS.max_time // 2, FLAGS.max_time + 1, dtype=tf.int32)
+  with tf.variable_scope('encoder'):
+    outputs = build_encoder(cell_type, inputs, sequence_length)
+  train_op = tf.train.GradientDescentOptimizer(0.1).minimize(tf.reduce_sum(outputs))
+
+  variable_names = sorted(
+    '{}:{}'.format(v.op.name, v.shape) for v in tf.global_variables())
+
+  with tf.Session() as sess:
+    sess.run(tf.global_variables_initializer())
+    for _ in range(FLAGS.warmup_steps):
+      sess.run(train_op)
+    start = time.time()
+    for _ in range(FLAGS.num_steps):
+      sess.run(train_op)
+    return (time.time() - start) / FLAGS.num_steps, variable_names
+
+
+def main(unused_argv):
+  print('{} encoder: {} layer(s), hidden {}, batch {}, time steps {}'.format(
+    'Bidirectional' if FLAGS.bidirectional else 'Unidirectional',
+    FLAGS.num_layers, FLAGS.hidden_size, FLAGS.batch_size, FLAGS.max_time))
+
+  results = {}
+  for cell_type in CELL_TYPES:
+    results[cell_type] = time_train_step(cell_type)
+
+  base_step_time, base_variables = results['lstm']
+  print('{:>8} {:>10} {:>10} {:>22}'.format(
+    'cell', 'ms/step', 'speed-up', 'same variables as lstm'))
+  for cell_type in CELL_TYPES:
+    step_time, variables = results[cell_type]
+    print('{:>8} {:>10.2f} {:>10.2f} {:>22}'.format(
+      cell_type, 1000 * step_time, base_step_time / step_time,
+      str(variables == base_variables)))
+
+
+if __name__ == '__main__':
+  tf.app.run()
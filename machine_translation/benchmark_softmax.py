@@ -0,0 +1,73 @@
+from __future__ import print_function
+
+import time
+
+import tensorflow as tf
+
+from sampled_softmax import sampled_sequence_loss
+
+# Times one training step of the decoder output layer (projection + loss + Adam update)
+# with the full softmax and with sampled softmax/NCE for several numbers of samples.
+# Run with CUDA_VISIBLE_DEVICES= to benchmark on CPU.
+flags = tf.app.flags
+flags.DEFINE_integer('target_vocab_size', 30000, 'number of target words')
+flags.DEFINE_integer('hidden_size', 128, 'hidden size of RNN cell')
+flags.DEFINE_integer('batch_size', 128, 'batch size')
+flags.DEFINE_integer('max_time', 30, 'number of decoder time steps')
+flags.DEFINE_string('softmax_loss', 'sampled', 'loss to compare against the full softmax: sampled or nce')
+flags.DEFINE_list('num_sampled', ['64', '256', '1024', '4096'], 'numbers of sampled words to benchmark')
+flags.DEFINE_integer('num_steps', 20, 'number of timed training steps')
+flags.DEFINE_integer('warmup_steps', 3, 'number of untimed training steps')
+
+FLAGS = flags.FLAGS
+
+
+def time_train_step(softmax_loss, num_sampled):
+  tf.reset_default_graph()
+  with tf.variable_scope('decoder'):
+    # Stands in for the decoder RNN outputs so that gradients flow back like in training
+    decoder_outputs = tf.get_variable(
+      'decoder_outputs',
+      [FLAGS.max_time, FLAGS.batch_size, FLAGS.hidden_size])
+    target_sequence_out = tf.random_uniform(
+      [FLAGS.max_time, FLAGS.batch_size], 0, FLAGS.target_vocab_size, dtype=tf.int32)
+    decoder_output_layer = tf.layers.Dense(FLAGS.target_vocab_size, use_bias=False)
+
+    if softmax_loss == 'full':
+      cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(
+        labels=target_sequence_out, logits=decoder_output_layer(decoder_outputs))
+    else:
+      cross_entropy = sampled_sequence_loss(
+        decoder_outputs, target_sequence_out,
+        decoder_output_layer, FLAGS.hidden_size, FLAGS.target_vocab_size,
+        num_sampled, softmax_loss)
+    loss = tf.reduce_sum(cross_entropy) / tf.to_float(FLAGS.batch_size)
+
+  train_op = tf.train.AdamOptimizer().minimize(loss)
+
+  with tf.Session() as sess:
+    sess.run(tf.global_variables_initializer())
+    for _ in range(FLAGS.warmup_steps):
+      sess.run(train_op)
+    start = time.time()
+    for _ in range(FLAGS.num_steps):
+      sess.run(train_op)
+    return (time.time() - start) / FLAGS.num_steps
+
+
+def main(unused_argv):
+  print('vocab {}, hidden {}, batch {}, time steps {}'.format(
+    FLAGS.target_vocab_size, FLAGS.hidden_size, FLAGS.batch_size, FLAGS.max_time))
+
+  full_step_time = time_train_step('full', 0)
+  print('{:>12} {:>14} {:>10}'.format('num_sampled', 'ms/step', 'speed-up'))
+  print('{:>12} {:>14.2f} {:>10.2f}'.format('full', 1000 * full_step_time, 1.))
+
+  for num_sampled in FLAGS.num_sampled:
+    step_time = time_train_step(FLAGS.softmax_loss, int(num_sampled))
+    print('{:>12} {:>14.2f} {:>10.2f}'.format(
+      num_sampled, 1000 * step_time, full_step_time / step_time))
+
+
+if __name__ == '__main__':
+  tf.app.run()
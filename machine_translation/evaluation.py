@@ -0,0 +1,196 @@
+from __future__ import print_function, division
+
+import io
+import math
+import multiprocessing
+import time
+from collections import Counter
+
+import numpy as np
+
+BLEU_MAX_ORDER = 4
+CHRF_ORDER = 6
+CHRF_BETA = 2
+
+
+def held_out_split(num_sentences, held_out_size, seed=0):
+  """
+  Random split of the sentence ids into training and held-out ids,
+  always the same for a given seed so that training and evaluation agree
+  """
+  ids = np.random.RandomState(seed).permutation(num_sentences)
+  return np.sort(ids[held_out_size:]), np.sort(ids[:held_out_size])
+
+
+def read_tokens(file_name):
+  """
+  Sentences of a UTF-8 file, one per line, as lists of tokens
+  """
+  with io.open(file_name, encoding='utf-8') as f:
+    return [line.split() for line in f]
+
+
+def graph_translate_batch(sess, source_sequence, source_sequence_length, preds, batch_size,
+                          source_int_to_vocab, target_int_to_vocab, unk_id, eos,
+                          reverse_source=False, feed_dict=None):
+  """
+  translate_batch for evaluate_translation running the inference graph of a TF1 training script:
+  preds (max_time, batch_size) decoded from the source ids fed to source_sequence (batch_size, max_time)
+  and source_sequence_length. The graph has a fixed batch size, smaller batches are filled
+  with copies of their first sentence. feed_dict is added to every run, e.g. to turn off dropout
+  """
+  source_vocab_to_int = {word: i for i, word in enumerate(source_int_to_vocab)}
+  eos_id = source_vocab_to_int[eos]
+
+  def translate_batch(sentences):
+    seqs = [[source_vocab_to_int.get(word, unk_id) for word in words] or [eos_id]
+            for words in sentences]
+    if reverse_source:
+      seqs = [seq[::-1] for seq in seqs]
+    seqs += [seqs[0]] * (batch_size - len(seqs))
+    lengths = [len(seq) for seq in seqs]
+    batch_feed_dict = dict(feed_dict or {})
+    batch_feed_dict[source_sequence] = [seq + [eos_id] * (max(lengths) - len(seq)) for seq in seqs]
+    batch_feed_dict[source_sequence_length] = lengths
+    predictions = sess.run(preds, feed_dict=batch_feed_dict)
+    translations = []
+    for i in range(len(sentences)):
+      words = [target_int_to_vocab[ix] for ix in predictions[:, i]]
+      if eos in words:
+        words = words[:words.index(eos)]
+      translations.append(words)
+    return translations
+  return translate_batch
+
+
+def _ngram_counts(sequence, n):
+  return Counter(tuple(sequence[i:i + n]) for i in range(len(sequence) - n + 1))
+
+
+def _matches(hypothesis, reference, n):
+  """
+  Clipped n-gram matches, n-grams in the hypothesis and in the reference
+  """
+  hypothesis_counts = _ngram_counts(hypothesis, n)
+  reference_counts = _ngram_counts(reference, n)
+  matches = sum((hypothesis_counts & reference_counts).values())
+  return matches, max(len(hypothesis) - n + 1, 0), max(len(reference) - n + 1, 0)
+
+
+def _chunk_statistics(pairs):
+  """
+  Sufficient statistics of BLEU and chrF for a chunk of (hypothesis, reference) pairs:
+  BLEU matches and hypothesis n-grams per order, hypothesis and reference lengths,
+  then chrF matches, hypothesis and reference character n-grams per order
+  """
+  statistics = np.zeros(2 * BLEU_MAX_ORDER + 2 + 3 * CHRF_ORDER)
+  for hypothesis, reference in pairs:
+    for n in range(1, BLEU_MAX_ORDER + 1):
+      matches, total, _ = _matches(hypothesis, reference, n)
+      statistics[n - 1] += matches
+      statistics[BLEU_MAX_ORDER + n - 1] += total
+    statistics[2 * BLEU_MAX_ORDER] += len(hypothesis)
+    statistics[2 * BLEU_MAX_ORDER + 1] += len(reference)
+
+    # Character n-grams, ignoring whitespace
+    offset = 2 * BLEU_MAX_ORDER + 2
+    hypothesis_chars, reference_chars = ''.join(hypothesis), ''.join(reference)
+    for n in range(1, CHRF_ORDER + 1):
+      statistics[offset + 3 * (n - 1):offset + 3 * n] += _matches(
+        hypothesis_chars, reference_chars, n)
+  return statistics
+
+
+def _bleu(statistics):
+  matches = statistics[:BLEU_MAX_ORDER]
+  totals = statistics[BLEU_MAX_ORDER:2 * BLEU_MAX_ORDER]
+  hypothesis_length, reference_length = statistics[2 * BLEU_MAX_ORDER:2 * BLEU_MAX_ORDER + 2]
+  if hypothesis_length == 0 or matches.min() == 0:
+    return 0.
+
+  log_precision = np.mean(np.log(matches / totals))
+  brevity_penalty = min(1., math.exp(1 - reference_length / hypothesis_length))
+  return 100 * brevity_penalty * math.exp(log_precision)
+
+
+def _chrf(statistics):
+  statistics = statistics[2 * BLEU_MAX_ORDER + 2:].reshape(CHRF_ORDER, 3)
+  precisions, recalls = [], []
+  for matches, hypothesis_total, reference_total in statistics:
+    if hypothesis_total > 0 and reference_total > 0:
+      precisions.append(matches / hypothesis_total)
+      recalls.append(matches / reference_total)
+  if not precisions:
+    return 0.
+
+  precision, recall = np.mean(precisions), np.mean(recalls)
+  if precision + recall == 0:
+    return 0.
+  beta_square = CHRF_BETA ** 2
+  return 100 * (1 + beta_square) * precision * recall / (beta_square * precision + recall)
+
+
+def _can_fork():
+  """
+  Whether a pool can start its workers by forking: the training scripts do all their work
+  at module level, workers started by 'spawn' or 'forkserver' (default on macOS and Windows)
+  would import them and run them again
+  """
+  # Python 2 always forks
+  get_start_method = getattr(multiprocessing, 'get_start_method', lambda: 'fork')
+  return get_start_method() == 'fork'
+
+
+def corpus_scores(hypotheses, references, num_processes=None, chunk_size=500):
+  """
+  Corpus BLEU and chrF, the n-grams are counted in a pool of num_processes processes
+  (one per CPU by default), or in this process if num_processes is 1
+  or if workers cannot be forked (see _can_fork)
+  :param hypotheses: Translations, as lists of tokens
+  :param references: One reference translation per hypothesis, as lists of tokens
+  :return: BLEU, chrF
+  """
+  pairs = list(zip(hypotheses, references))
+  chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+  if num_processes == 1 or len(chunks) <= 1 or not _can_fork():
+    statistics = np.sum([_chunk_statistics(chunk) for chunk in chunks]
+                        or [_chunk_statistics([])], axis=0)
+  else:
+    pool = multiprocessing.Pool(num_processes)
+    try:
+      statistics = np.sum(pool.map(_chunk_statistics, chunks), axis=0)
+    finally:
+      pool.close()
+      pool.join()
+
+  return _bleu(statistics), _chrf(statistics)
+
+
+def evaluate_translation(translate_batch, source_seqs, references,
+                         batch_size, num_processes=None):
+  """
+  Translate source_seqs in batches of sentences of similar lengths and score the translations
+  :param translate_batch: Function translating a list of source sequences
+                          into a list of translations (lists of tokens)
+  :param source_seqs: Source sentences, as lists of ids or tokens
+  :param references: Reference translations, as lists of tokens
+  :return: Dict with the BLEU and chrF scores, decoded sentences/s and tokens/s
+  """
+  order = sorted(range(len(source_seqs)), key=lambda i: len(source_seqs[i]))
+  hypotheses = [None] * len(source_seqs)
+
+  start = time.time()
+  for batch_start in range(0, len(order), batch_size):
+    ids = order[batch_start:batch_start + batch_size]
+    for i, hypothesis in zip(ids, translate_batch([source_seqs[i] for i in ids])):
+      hypotheses[i] = hypothesis
+  elapsed = time.time() - start
+
+  bleu, chrf = corpus_scores(hypotheses, references, num_processes)
+  results = {'bleu': bleu,
+             'chrf': chrf,
+             'sentences_per_sec': len(source_seqs) / elapsed,
+             'tokens_per_sec': sum(len(h) for h in hypotheses) / elapsed}
+  print('{} sentences: BLEU {:.2f}, chrF {:.2f}, {:.2f} sentences/s, {:.1f} tokens/s'.format(
+    len(source_seqs), bleu, chrf, results['sentences_per_sec'], results['tokens_per_sec']))
+  return results
@@ -5,7 +5,16 @@ import tensorflow as tf
 from tensorflow.python.ops import lookup_ops
 import codecs
 import numpy as np
+import os
 import sys
+import time
+
+# common/ holds the modules shared by all the projects
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.rnn_cells import create_lstm_cell, fused_lstm
+from common.beam_search import decode_length, beam_search_decode
+from shortlist import load_lexical_table, build_shortlist, ShortlistDense
+from evaluation import evaluate_translation
 
 # TODO: Use tf.app.flags
 UNK = '<unk>'
@@ -16,7 +25,38 @@ encoder_hidden_size = 512
 decoder_hidden_size = 512
 encoder_num_layers = 2
 decoder_num_layers = 2
+# LSTM implementation: lstm, block or fused (see rnn_cells.py), checkpoints work with any of them
+cell_type = 'lstm'
+# beam_width = 1 (default) decodes greedily, > 1 opts in to beam search with length normalization
+beam_width = 1
+length_penalty_weight = 1.0
+# Decode at most decode_length_ratio times the length of the longest source sentence
+decode_length_ratio = 2.
 src_sent = 'Bạn từ đâu đến ?'
+# Translate every line of source_file instead of src_sent, batch_size sentences at a time
+source_file = None
+output_file = None
+batch_size = 32
+# Time the translation of source_file with each of these beam widths
+# (translations of each width go to output_file.beam<width> if output_file is set)
+benchmark_beam_widths = []
+# Project decoder outputs only onto a shortlist of shortlist_size target words per batch
+# (0 for the full vocab): the num_frequent most frequent words and the num_candidates
+# best translations of every source word, from a lexical table built on the training data
+shortlist_size = 0
+num_frequent = 500
+num_candidates = 20
+# Rebuilt when the vocabularies, num_candidates or the training files change
+lexical_table_file = 'lexical_table.npz'
+train_source_file = '../data/train.vi'
+train_target_file = '../data/train.en'
+# Time the translation of source_file with the full vocab and with the shortlist,
+# and count how many translations are identical
+benchmark_shortlist = False
+# Translate eval_source_file and compute BLEU and chrF against eval_target_file,
+# with the decoding throughput (see evaluation.py)
+eval_source_file = None
+eval_target_file = '../data/tst2012.en'
 
 # ======================== DATA READING =============================
 def load_vocab(vocab_file):
@@ -33,7 +73,9 @@ def create_network(source_sequence,
                    target_vocab,
                    source_sequence_length,
                    source_vocab_size,
-                   target_vocab_size):
+                   target_vocab_size,
+                   beam_width,
+                   shortlist=None):
   with tf.variable_scope('encoder'):
     encoder_embedding = tf.get_variable(
       'encoder_embedding_weights',
@@ -45,16 +87,20 @@ def create_network(source_sequence,
 
     # TODO: Update to bidirectional RNN
     def _create_encoder_cell(hidden_size):
-      cell =  tf.nn.rnn_cell.LSTMCell(hidden_size)
-      return cell
-    encoder_lstm = tf.nn.rnn_cell.MultiRNNCell(
-      [_create_encoder_cell(encoder_hidden_size) for _ in range(encoder_num_layers)])
-    encoder_outputs, encoder_state = tf.nn.dynamic_rnn(
-      encoder_lstm,
-      encoder_embedded,
-      dtype=tf.float32,
-      time_major=True,
-      sequence_length=source_sequence_length)
+      return create_lstm_cell(cell_type, hidden_size)
+    if cell_type == 'fused':
+      encoder_outputs, encoder_state = fused_lstm(
+        encoder_embedded, source_sequence_length, encoder_hidden_size, None,
+        ['rnn/multi_rnn_cell/cell_{}'.format(i) for i in range(encoder_num_layers)])
+    else:
+      encoder_lstm = tf.nn.rnn_cell.MultiRNNCell(
+        [_create_encoder_cell(encoder_hidden_size) for _ in range(encoder_num_layers)])
+      encoder_outputs, encoder_state = tf.nn.dynamic_rnn(
+        encoder_lstm,
+        encoder_embedded,
+        dtype=tf.float32,
+        time_major=True,
+        sequence_length=source_sequence_length)
 
   with tf.variable_scope('decoder'):
     decoder_embedding = tf.get_variable(
@@ -65,35 +111,61 @@ def create_network(source_sequence,
 
     # TODO: Update to bidirectional RNN
     def _create_decoder_cell(hidden_size):
-      cell =  tf.nn.rnn_cell.LSTMCell(hidden_size)
-      return cell
+      return create_lstm_cell(cell_type, hidden_size)
     decoder_lstm = tf.nn.rnn_cell.MultiRNNCell(
       [_create_decoder_cell(decoder_hidden_size) for _ in range(decoder_num_layers)])
-    decoder_output_layer = tf.layers.Dense(target_vocab_size, use_bias=False)
-
     decoder_initial_state = encoder_state
 
-    target_sos_id = tf.cast(target_vocab.lookup(tf.constant(SOS)), tf.int32)
-    target_eos_id = tf.cast(target_vocab.lookup(tf.constant(EOS)), tf.int32)
-    infer_sequence_in = tf.fill([1], target_sos_id)
-
-    infer_helper = tf.contrib.seq2seq.GreedyEmbeddingHelper(
-      decoder_embedding,
-      infer_sequence_in,
-      target_eos_id)
-    infer_decoder = tf.contrib.seq2seq.BasicDecoder(
-      decoder_lstm,
-      infer_helper,
-      decoder_initial_state,
-      decoder_output_layer)
-
-    maximum_iterations = tf.round(tf.reduce_max(source_sequence_length) * 2)
-    infer_decoder_outputs, _, _ = tf.contrib.seq2seq.dynamic_decode(
-      infer_decoder,
-      maximum_iterations=maximum_iterations,
-      output_time_major=True,
-      swap_memory=True)
-    preds = infer_decoder_outputs.sample_id
+    if shortlist is None:
+      decoder_output_layer = tf.layers.Dense(target_vocab_size, use_bias=False)
+      decoder_embedding_fn = decoder_embedding
+      target_sos_id = tf.cast(target_vocab.lookup(tf.constant(SOS)), tf.int32)
+      target_eos_id = tf.cast(target_vocab.lookup(tf.constant(EOS)), tf.int32)
+    else:
+      # Decode positions in the shortlist, which starts with </s> and <s>
+      with tf.variable_scope('decoder/dense'):
+        # The kernel the Dense layer would create in dynamic_decode
+        output_kernel = tf.get_variable(
+          'kernel', [decoder_hidden_size, target_vocab_size])
+      decoder_output_layer = ShortlistDense(
+        tf.gather(output_kernel, shortlist, axis=1))
+      def decoder_embedding_fn(ids):
+        return tf.nn.embedding_lookup(decoder_embedding, tf.gather(shortlist, ids))
+      target_eos_id, target_sos_id = 0, 1
+    batch_size = tf.shape(source_sequence)[1]
+    infer_sequence_in = tf.fill([batch_size], target_sos_id)
+
+    maximum_iterations = decode_length(source_sequence_length, decode_length_ratio)
+    if beam_width > 1:
+      preds = beam_search_decode(
+        decoder_lstm,
+        decoder_embedding_fn,
+        infer_sequence_in,
+        target_eos_id,
+        tf.contrib.seq2seq.tile_batch(decoder_initial_state, beam_width),
+        decoder_output_layer,
+        beam_width, length_penalty_weight,
+        maximum_iterations)
+    else:
+      infer_helper = tf.contrib.seq2seq.GreedyEmbeddingHelper(
+        decoder_embedding_fn,
+        infer_sequence_in,
+        target_eos_id)
+      infer_decoder = tf.contrib.seq2seq.BasicDecoder(
+        decoder_lstm,
+        infer_helper,
+        decoder_initial_state,
+        decoder_output_layer)
+
+      infer_decoder_outputs, _, _ = tf.contrib.seq2seq.dynamic_decode(
+        infer_decoder,
+        maximum_iterations=maximum_iterations,
+        output_time_major=True,
+        swap_memory=True)
+      preds = infer_decoder_outputs.sample_id
+
+    if shortlist is not None:
+      preds = tf.gather(shortlist, preds)
   return preds
 
 source_vocab_file = '../data/vocab.vi'
@@ -102,41 +174,145 @@ target_vocab_file = '../data/vocab.en'
 source_int_to_vocab, source_vocab_size = load_vocab(source_vocab_file)
 target_int_to_vocab, target_vocab_size = load_vocab(target_vocab_file)
 
-source_vocab = lookup_ops.index_table_from_file(
-  source_vocab_file, default_value=UNK_token)
-target_vocab = lookup_ops.index_table_from_file(
-  target_vocab_file, default_value=UNK_token)
+source_vocab_to_int = {word: i for i, word in enumerate(source_int_to_vocab)}
+lexical_table = None
 
-src_sent = tf.convert_to_tensor([src_sent.split()[::-1]])
-source_sequence = tf.cast(source_vocab.lookup(src_sent), tf.int32)
-source_sequence_length = tf.map_fn(lambda x: tf.size(x), source_sequence)
+def load_model(beam_width, shortlist_size=0):
+  global lexical_table
+  tf.reset_default_graph()
+  source_vocab = lookup_ops.index_table_from_file(
+    source_vocab_file, default_value=UNK_token)
+  target_vocab = lookup_ops.index_table_from_file(
+    target_vocab_file, default_value=UNK_token)
 
-preds = create_network(
-  source_sequence,
-  target_vocab,
-  source_sequence_length,
-  source_vocab_size,
-  target_vocab_size)
+  # Reversed source words, padded at the end
+  source_words = tf.placeholder(tf.string, [None, None])
+  source_sequence_length = tf.placeholder(tf.int32, [None])
+  source_sequence = tf.cast(source_vocab.lookup(source_words), tf.int32)
 
-sess = tf.Session()
+  shortlist = None
+  if shortlist_size > 0:
+    shortlist = tf.placeholder(tf.int32, [shortlist_size])
+    if lexical_table is None:
+      lexical_table = load_lexical_table(
+        lexical_table_file, train_source_file, train_target_file,
+        source_int_to_vocab, target_int_to_vocab, UNK_token, num_candidates)
 
-sess.run(tf.global_variables_initializer())
-sess.run(tf.tables_initializer())
+  preds = create_network(
+    source_sequence,
+    target_vocab,
+    source_sequence_length,
+    source_vocab_size,
+    target_vocab_size,
+    beam_width,
+    shortlist)
 
-saver = tf.train.Saver()
-latest_checkpoint = tf.train.latest_checkpoint('checkpoint')
-if latest_checkpoint and tf.train.checkpoint_exists(latest_checkpoint):
-  saver.restore(sess, latest_checkpoint)
-else:
-  print('You must train the model first!')
-  print('Exiting...')
-  sys.exit()
+  sess = tf.Session()
 
-predictions = sess.run(preds)
-pred_sent = ' '.join([target_int_to_vocab[ix] for ix in predictions[:, 0]])
+  sess.run(tf.global_variables_initializer())
+  sess.run(tf.tables_initializer())
 
-if EOS in pred_sent:
-  eos_index = pred_sent.index(EOS)
-  pred_sent = pred_sent[:eos_index]
+  saver = tf.train.Saver()
+  latest_checkpoint = tf.train.latest_checkpoint('checkpoint')
+  if latest_checkpoint and tf.train.checkpoint_exists(latest_checkpoint):
+    saver.restore(sess, latest_checkpoint)
+  else:
+    print('You must train the model first!')
+    print('Exiting...')
+    sys.exit()
+  return sess, source_words, source_sequence_length, shortlist, preds
 
-print(pred_sent)
+def translate(model, sentences):
+  sess, source_words, source_sequence_length, shortlist, preds = model
+  # Sentences of similar lengths go in the same batch to decode as little padding as possible
+  order = sorted(range(len(sentences)), key=lambda i: len(sentences[i].split()))
+  translations = [None] * len(sentences)
+  for start in range(0, len(order), batch_size):
+    batch_ids = order[start:start + batch_size]
+    words = [sentences[i].split()[::-1] for i in batch_ids]
+    lengths = [len(w) for w in words]
+    feed_dict = {source_words: [w + [EOS] * (max(lengths) - len(w)) for w in words],
+                 source_sequence_length: lengths}
+    if shortlist is not None:
+      first_ids = [target_int_to_vocab.index(EOS), target_int_to_vocab.index(SOS)]
+      feed_dict[shortlist] = build_shortlist(
+        [[source_vocab_to_int.get(word, UNK_token) for word in w] for w in words],
+        lexical_table, shortlist.shape[0].value,
+        first_ids + list(range(num_frequent)))
+    predictions = sess.run(preds, feed_dict=feed_dict)
+    for batch_i, sentence_i in enumerate(batch_ids):
+      pred_words = [target_int_to_vocab[ix] for ix in predictions[:, batch_i]]
+      if EOS in pred_words:
+        pred_words = pred_words[:pred_words.index(EOS)]
+      translations[sentence_i] = ' '.join(pred_words)
+  return translations
+
+def time_translation(model, sentences):
+  # Warm up, the first run also builds the kernels
+  translate(model, sentences[:batch_size])
+  start = time.time()
+  translations = translate(model, sentences)
+  return translations, time.time() - start
+
+def read_sentences(file_name):
+  with codecs.getreader('utf-8')(tf.gfile.GFile(file_name, 'r')) as f:
+    return [line.strip() for line in f]
+
+def write_sentences(file_name, sentences):
+  with codecs.getwriter('utf-8')(tf.gfile.GFile(file_name, 'w')) as f:
+    for sentence in sentences:
+      f.write(sentence + '\n')
+
+if eval_source_file is not None:
+  model = load_model(beam_width, shortlist_size)
+  evaluate_translation(
+    lambda batch: [t.split() for t in translate(model, [' '.join(w) for w in batch])],
+    [s.split() for s in read_sentences(eval_source_file)],
+    [s.split() for s in read_sentences(eval_target_file)],
+    batch_size)
+elif source_file is None:
+  print(translate(load_model(beam_width, shortlist_size), [src_sent])[0])
+elif benchmark_beam_widths:
+  sentences = read_sentences(source_file)
+  print('{:>6} {:>12} {:>12} {:>12}'.format(
+    'beam', 'sentences/s', 'tokens/s', 'mean length'))
+  for width in benchmark_beam_widths:
+    model = load_model(width, shortlist_size)
+    translations, elapsed = time_translation(model, sentences)
+    num_tokens = sum(len(t.split()) for t in translations)
+    print('{:>6} {:>12.2f} {:>12.2f} {:>12.2f}'.format(
+      width, len(sentences) / elapsed, num_tokens / elapsed,
+      num_tokens / float(len(sentences))))
+    if output_file is not None:
+      write_sentences('{}.beam{}'.format(output_file, width), translations)
+    model[0].close()
+elif benchmark_shortlist:
+  sentences = read_sentences(source_file)
+  results = []
+  for size in [0, shortlist_size]:
+    model = load_model(beam_width, size)
+    results.append(time_translation(model, sentences))
+    model[0].close()
+  (full_translations, full_time), (shortlist_translations, shortlist_time) = results
+
+  same_sentences = 0
+  same_tokens, num_tokens = 0, 0
+  for full, short in zip(full_translations, shortlist_translations):
+    same_sentences += full == short
+    full, short = full.split(), short.split()
+    same_tokens += sum(f == s for f, s in zip(full, short))
+    num_tokens += len(full)
+  print('Full vocab ({} words): {:.2f} sentences/s'.format(
+    target_vocab_size, len(sentences) / full_time))
+  print('Shortlist ({} words): {:.2f} sentences/s, speed-up {:.2f}'.format(
+    shortlist_size, len(sentences) / shortlist_time, full_time / shortlist_time))
+  print('Identical translations: {:.2%}, identical tokens: {:.2%}'.format(
+    same_sentences / float(len(sentences)), same_tokens / float(max(num_tokens, 1))))
+else:
+  translations = translate(
+    load_model(beam_width, shortlist_size), read_sentences(source_file))
+  if output_file is not None:
+    write_sentences(output_file, translations)
+  else:
+    for translation in translations:
+      print(translation)
@@ -0,0 +1,79 @@
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+# Processes started by run_in_process get their configuration (JSON) in this variable
+CONFIG_ENV = 'MEMORY_BENCHMARK_CONFIG'
+RESULT_PREFIX = 'Memory benchmark: '
+
+
+def peak_memory():
+    """
+    Peak resident memory of this process so far, in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, in kilobytes on Linux
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def process_config():
+    """
+    Configuration of this process if it was started by run_in_process, else None
+    """
+    config = os.environ.get(CONFIG_ENV)
+    return None if config is None else json.loads(config)
+
+
+def measure_train_step(train_step, args, num_steps=10):
+    """
+    Time num_steps calls of train_step(*args), after a first call that traces it,
+    and report the peak memory to run_in_process: the peak of the whole process and
+    how much the training steps added to the peak reached before them (data, models).
+    The peak never goes down, so every configuration needs a process of its own
+    """
+    memory_before = peak_memory()
+    train_step(*args).numpy()
+    start = time.time()
+    for _ in range(num_steps):
+        loss = train_step(*args)
+    loss.numpy()
+    step_time = (time.time() - start) / num_steps
+
+    print(RESULT_PREFIX + json.dumps({'peak_memory': peak_memory(),
+                                      'step_memory': peak_memory() - memory_before,
+                                      'step_time': step_time}))
+
+
+def run_in_process(script, config):
+    """
+    Run script in a new process with config, the script must call measure_train_step
+    when process_config() is not None
+    Returns the dict reported by measure_train_step
+    """
+    env = dict(os.environ)
+    env[CONFIG_ENV] = json.dumps(config)
+    output = subprocess.run([sys.executable, os.path.abspath(script)], env=env,
+                            stdout=subprocess.PIPE, universal_newlines=True,
+                            check=True).stdout
+    for line in output.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError('{} did not report its memory usage'.format(script))
+
+
+def compare_memory(script, configs):
+    """
+    Print peak memory and step time of every configuration (dicts), each run in its own process
+    """
+    keys = sorted(configs[0])
+    print(' '.join('{:>12}'.format(key) for key in keys) +
+          ' {:>12} {:>12} {:>10}'.format('peak (MB)', 'steps (MB)', 'step (ms)'))
+    for config in configs:
+        result = run_in_process(script, config)
+        print(' '.join('{:>12}'.format(str(config[key])) for key in keys) +
+              ' {:>12.1f} {:>12.1f} {:>10.2f}'.format(
+                  result['peak_memory'] / 2 ** 20, result['step_memory'] / 2 ** 20,
+                  1000 * result['step_time']))
@@ -0,0 +1,116 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+# 'float':   plain TFLite conversion, the reference for latency and agreement
+# 'dynamic': int8 weights, activations quantized on the fly by the int8 kernels
+# 'int8':    int8 weights and activations, activation ranges calibrated on a representative dataset
+#            (ops without int8 kernels stay in float)
+QUANTIZATION_MODES = ['float', 'dynamic', 'int8']
+
+
+def convert_to_tflite(concrete_function, mode, representative_inputs=None):
+    """
+    Convert a tf.function to a TFLite flatbuffer
+    :param concrete_function: Function traced with a full input_signature
+    :param mode: One of QUANTIZATION_MODES
+    :param representative_inputs: Lists of inputs (in the order of the function arguments)
+                                  used to calibrate activation ranges, required by 'int8'
+    :return: The TFLite model as bytes
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(
+            'Unknown quantization mode! Must be either float, dynamic or int8.')
+
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete_function])
+    # Keras LSTMs are converted to while loops, which may need the TF ops fallback
+    converter.target_spec.supported_ops = [
+        tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    if mode != 'float':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == 'int8':
+        if not representative_inputs:
+            raise ValueError('int8 quantization needs representative inputs.')
+
+        def representative_dataset():
+            for inputs in representative_inputs:
+                yield [np.asarray(x) for x in inputs]
+
+        converter.representative_dataset = representative_dataset
+
+    return converter.convert()
+
+
+class TFLiteModel(object):
+    """
+    Run a converted function with the TFLite interpreter,
+    inputs are given in the order of the function arguments
+    and inputs with dynamic dimensions are resized as needed.
+    Like the tf.function, returns a single output as is and several outputs as a list
+    """
+
+    def __init__(self, model_content, num_threads=1):
+        self.size = len(model_content)
+        self.interpreter = tf.lite.Interpreter(
+            model_content=model_content, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+
+    def __call__(self, *inputs):
+        inputs = [np.asarray(x, dtype=detail['dtype'])
+                  for x, detail in zip(inputs, self.input_details)]
+        resized = False
+        for x, detail in zip(inputs, self.input_details):
+            if list(x.shape) != list(detail['shape']):
+                self.interpreter.resize_tensor_input(detail['index'], x.shape)
+                resized = True
+        if resized:
+            self.interpreter.allocate_tensors()
+            self.input_details = self.interpreter.get_input_details()
+
+        for x, detail in zip(inputs, self.input_details):
+            self.interpreter.set_tensor(detail['index'], x)
+        self.interpreter.invoke()
+        outputs = [self.interpreter.get_tensor(detail['index'])
+                   for detail in self.output_details]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+
+class InputRecorder(object):
+    """
+    Call `function` and keep the inputs of every call, to build a representative dataset
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.inputs = []
+
+    def __call__(self, *inputs):
+        # Copies, callers may update their input arrays in place
+        self.inputs.append([np.array(x) for x in inputs])
+        return self.function(*inputs)
+
+
+def compare_models(translate_fns, model_sizes, source_seqs):
+    """
+    Print latency, size and agreement with the first (float) model
+    :param translate_fns: List of (name, function translating one source sequence into a list of ids)
+    :param model_sizes: Size in bytes of every model
+    """
+    results = []
+    for name, translate_fn in translate_fns:
+        # Warm up
+        translate_fn(source_seqs[0])
+        start = time.time()
+        translations = [translate_fn(seq) for seq in source_seqs]
+        latency = (time.time() - start) / len(source_seqs)
+        results.append((name, translations, latency))
+
+    reference = results[0][1]
+    print('{:>8} {:>10} {:>14} {:>10}'.format('model', 'size (MB)', 'ms/sentence', 'agreement'))
+    for (name, translations, latency), size in zip(results, model_sizes):
+        agreement = np.mean([t == r for t, r in zip(translations, reference)])
+        print('{:>8} {:>10.2f} {:>14.2f} {:>9.1f}%'.format(
+            name, size / 2 ** 20, 1000 * latency, 100 * agreement))
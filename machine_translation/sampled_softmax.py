@@ -0,0 +1,43 @@
+import tensorflow as tf
+
+
+def sampled_sequence_loss(decoder_outputs, target_sequence_out,
+                          output_layer, output_size, target_vocab_size,
+                          num_sampled, softmax_loss='sampled'):
+  """
+  Cross entropy of every time step, estimated over a sample of the target vocabulary
+  :param decoder_outputs: Time-major RNN outputs before projection, (max_time, batch_size, output_size)
+  :param target_sequence_out: Time-major target ids, (max_time, batch_size)
+  :param output_layer: The tf.layers.Dense(target_vocab_size, use_bias=False) used at inference
+  :param output_size: Size of the RNN outputs
+  :param target_vocab_size: Number of target classes
+  :param num_sampled: Number of classes sampled per batch
+  :param softmax_loss: Either 'sampled' (sampled softmax) or 'nce' (noise-contrastive estimation)
+  :return: Loss of each time step, (max_time, batch_size)
+  """
+  if softmax_loss not in ['sampled', 'nce']:
+    raise ValueError('Unknown softmax loss! Must be either sampled or nce.')
+
+  # Create the projection where dynamic_decode would have created it,
+  # so checkpoints are interchangeable with the full softmax mode
+  with tf.variable_scope('decoder'):
+    output_layer.build(tf.TensorShape([None, output_size]))
+
+  # Dense kernel has shape (output_size, vocab_size),
+  # the sampled losses expect (vocab_size, output_size)
+  weights = tf.transpose(output_layer.kernel)
+  biases = tf.zeros([target_vocab_size])
+
+  inputs = tf.reshape(decoder_outputs, [-1, output_size])
+  labels = tf.reshape(tf.cast(target_sequence_out, tf.int64), [-1, 1])
+
+  loss_fn = tf.nn.sampled_softmax_loss if softmax_loss == 'sampled' else tf.nn.nce_loss
+  cross_entropy = loss_fn(
+    weights=weights,
+    biases=biases,
+    labels=labels,
+    inputs=inputs,
+    num_sampled=num_sampled,
+    num_classes=target_vocab_size)
+
+  return tf.reshape(cross_entropy, tf.shape(target_sequence_out))
@@ -0,0 +1,89 @@
+import itertools
+import time
+
+import numpy as np
+import tensorflow as tf
+
+# 'static':  no input_signature, the step is traced again for every new batch shape,
+#            so batches must keep a few fixed shapes (full batches padded to fixed lengths)
+# 'dynamic': input_signature with unknown batch size and lengths, the step is traced once
+#            and batches can be trimmed to their longest sentence
+SHAPE_POLICIES = ['static', 'dynamic']
+
+
+def sequence_spec():
+    """
+    Spec of a batch of padded id sequences of any size and length
+    """
+    return tf.TensorSpec([None, None], tf.int32)
+
+
+class CountedFunction(object):
+    """
+    tf.function counting its traces (the Python function only runs when it is traced)
+    input_signature is only used by the 'dynamic' shape policy
+    """
+
+    def __init__(self, python_function, shape_policy, input_signature, jit_compile=False):
+        if shape_policy not in SHAPE_POLICIES:
+            raise ValueError('Unknown shape policy! Must be either static or dynamic.')
+        self.num_traces = 0
+
+        def traced_function(*args):
+            self.num_traces += 1
+            return python_function(*args)
+
+        self.function = tf.function(
+            traced_function,
+            input_signature=input_signature if shape_policy == 'dynamic' else None,
+            jit_compile=jit_compile)
+
+    def __call__(self, *args):
+        return self.function(*args)
+
+
+def trim_batch(*batch):
+    """
+    Remove the padding columns (zeros at the end) shared by all the sequences of a batch,
+    to map on a batched tf.data.Dataset of padded sequences
+    """
+    return tuple(sequences[:, :tf.reduce_max(
+        tf.math.count_nonzero(sequences, axis=1, dtype=tf.int32))] for sequences in batch)
+
+
+def benchmark_step(step, batches, num_steps):
+    """
+    Call step (a CountedFunction) on the first num_steps batches (tuples of arguments)
+    Returns the number of traces, the total time of the steps that traced
+    and the mean time of the other steps (steady state)
+    """
+    trace_time = 0.
+    step_times = []
+    for args in itertools.islice(batches, num_steps):
+        num_traces = step.num_traces
+        start = time.time()
+        step(*args).numpy()
+        elapsed = time.time() - start
+        if step.num_traces > num_traces:
+            trace_time += elapsed
+        else:
+            step_times.append(elapsed)
+    return step.num_traces, trace_time, np.mean(step_times) if step_times else float('nan')
+
+
+def compare_shape_policies(make_step, make_batches, num_steps):
+    """
+    Print the number of traces and the steady-state step time of every shape policy,
+    with and without XLA
+    :param make_step: Function (shape_policy, jit_compile) => CountedFunction training new models
+    :param make_batches: Function shape_policy => iterable of tuples of arguments of the step
+    """
+    print('{:>8} {:>5} {:>7} {:>15} {:>10}'.format(
+        'shapes', 'xla', 'traces', 'tracing (s)', 'step (ms)'))
+    for jit_compile in [False, True]:
+        for shape_policy in SHAPE_POLICIES:
+            num_traces, trace_time, step_time = benchmark_step(
+                make_step(shape_policy, jit_compile), make_batches(shape_policy), num_steps)
+            print('{:>8} {:>5} {:>7} {:>15.2f} {:>10.2f}'.format(
+                shape_policy, 'on' if jit_compile else 'off', num_traces,
+                trace_time, 1000 * step_time))
@@ -0,0 +1,153 @@
+import codecs
+import hashlib
+import os
+
+import numpy as np
+import tensorflow as tf
+
+
+def build_lexical_table(source_file, target_file,
+                        source_vocab, target_vocab, unk_id,
+                        num_candidates=20, chunk_size=10000):
+  """
+  Best translation candidates of every source word, scored by the Dice coefficient
+  of the number of sentence pairs where both words appear
+  :param source_vocab: List of source words, the index of a word is its id
+  :param target_vocab: List of target words
+  :return: Target ids of the candidates of every source id, (source_vocab_size, num_candidates),
+           padded with -1 for words with fewer candidates
+  """
+  source_to_int = {word: i for i, word in enumerate(source_vocab)}
+  target_to_int = {word: i for i, word in enumerate(target_vocab)}
+  source_vocab_size, target_vocab_size = len(source_vocab), len(target_vocab)
+
+  source_counts = np.zeros(source_vocab_size)
+  target_counts = np.zeros(target_vocab_size)
+  # Co-occurring pairs are encoded as source_id * target_vocab_size + target_id
+  pair_codes, pair_counts = np.zeros(0, np.int64), np.zeros(0)
+
+  def _merge(pair_codes, pair_counts, chunk):
+    codes = np.concatenate([pair_codes] + chunk)
+    counts = np.concatenate([pair_counts, np.ones(len(codes) - len(pair_codes))])
+    unique_codes, inverse = np.unique(codes, return_inverse=True)
+    return unique_codes, np.bincount(inverse, weights=counts)
+
+  chunk = []
+  with codecs.open(source_file, 'r', 'utf-8') as source_f, \
+       codecs.open(target_file, 'r', 'utf-8') as target_f:
+    for source_line, target_line in zip(source_f, target_f):
+      source_ids = np.unique(
+        [source_to_int.get(w, unk_id) for w in source_line.split()]).astype(np.int64)
+      target_ids = np.unique(
+        [target_to_int.get(w, unk_id) for w in target_line.split()]).astype(np.int64)
+      if len(source_ids) == 0 or len(target_ids) == 0:
+        continue
+      source_counts[source_ids] += 1
+      target_counts[target_ids] += 1
+      chunk.append((source_ids[:, None] * target_vocab_size + target_ids).ravel())
+      if len(chunk) == chunk_size:
+        pair_codes, pair_counts = _merge(pair_codes, pair_counts, chunk)
+        chunk = []
+  if chunk:
+    pair_codes, pair_counts = _merge(pair_codes, pair_counts, chunk)
+
+  source_ids = pair_codes // target_vocab_size
+  target_ids = pair_codes % target_vocab_size
+  dice = 2 * pair_counts / (source_counts[source_ids] + target_counts[target_ids])
+
+  # Sort by source id, then by decreasing score, and keep the first candidates of every source id
+  order = np.lexsort((-dice, source_ids))
+  source_ids, target_ids = source_ids[order], target_ids[order]
+  rank = np.arange(len(source_ids)) - np.searchsorted(source_ids, source_ids)
+  keep = rank < num_candidates
+
+  table = np.full([source_vocab_size, num_candidates], -1, np.int32)
+  table[source_ids[keep], rank[keep]] = target_ids[keep]
+  return table
+
+
+def _lexical_table_key(source_file, target_file, source_vocab, target_vocab,
+                       unk_id, num_candidates):
+  """
+  What a lexical table depends on: the vocabularies, the parameters
+  and the size and modification time of the training files (when they exist)
+  """
+  digest = hashlib.md5()
+  for vocab in (source_vocab, target_vocab):
+    digest.update('\n'.join(vocab).encode('utf-8'))
+    digest.update(b'\0')
+  files = ['{}:{}:{}'.format(f, os.path.getsize(f), os.path.getmtime(f))
+           for f in (source_file, target_file) if os.path.exists(f)]
+  return {'vocabs': digest.hexdigest(),
+          'params': '{}:{}'.format(unk_id, num_candidates),
+          'train_files': ' '.join(files)}
+
+
+def load_lexical_table(cache_file, source_file, target_file,
+                       source_vocab, target_vocab, unk_id, num_candidates=20):
+  """
+  build_lexical_table, cached in cache_file (.npz) with what it was built from:
+  the cache is rebuilt when the vocabularies, unk_id, num_candidates
+  or the training files have changed
+  """
+  key = _lexical_table_key(source_file, target_file, source_vocab, target_vocab,
+                           unk_id, num_candidates)
+  if os.path.exists(cache_file):
+    cache = np.load(cache_file)
+    # The training files cannot be checked (nor the table rebuilt) without them
+    if all(str(cache[name]) == value for name, value in key.items()
+           if name != 'train_files' or value):
+      return cache['table']
+    print('{} is out of date'.format(cache_file))
+
+  print('Building lexical table from {} and {}...'.format(source_file, target_file))
+  table = build_lexical_table(source_file, target_file,
+                              source_vocab, target_vocab, unk_id, num_candidates)
+  np.savez(cache_file, table=table, **key)
+  return table
+
+
+def build_shortlist(source_ids, lexical_table, shortlist_size, first_ids):
+  """
+  Target words allowed when decoding a batch
+  :param source_ids: Source ids of every sentence of the batch
+  :param shortlist_size: Number of ids to return, must be smaller than the target vocab size
+  :param first_ids: Ids that always come first, in this order (e.g. end and start tokens,
+                    then the most frequent words)
+  :return: shortlist_size target ids: first_ids, then the candidates of the source words
+           (best candidates of all words first), then the most frequent remaining words
+           (target vocab is assumed sorted by frequency) to fill up
+  """
+  source_ids = np.unique(np.concatenate([np.asarray(ids, np.int64) for ids in source_ids]))
+  candidates = lexical_table[source_ids].T.ravel()
+  candidates = candidates[candidates >= 0]
+  fill = np.arange(shortlist_size + len(first_ids))
+
+  shortlist = []
+  seen = set()
+  for target_id in np.concatenate([first_ids, candidates, fill]):
+    if target_id not in seen:
+      seen.add(target_id)
+      shortlist.append(target_id)
+      if len(shortlist) == shortlist_size:
+        break
+  return np.array(shortlist, np.int32)
+
+
+class ShortlistDense(tf.layers.Layer):
+  """
+  Output projection onto the shortlisted words only, logits come out in shortlist order
+  """
+
+  def __init__(self, kernel, **kwargs):
+    """
+    :param kernel: Columns of the full output kernel for the shortlist, (hidden_size, shortlist_size)
+    """
+    super(ShortlistDense, self).__init__(**kwargs)
+    self.kernel = kernel
+
+  def call(self, inputs):
+    return tf.matmul(inputs, self.kernel)
+
+  def compute_output_shape(self, input_shape):
+    return tf.TensorShape(input_shape)[:-1].concatenate(self.kernel.shape[-1])
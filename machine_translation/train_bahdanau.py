@@ -3,6 +3,19 @@ from __future__ import print_function
 import tensorflow as tf
 from tensorflow.python.ops import lookup_ops
 import numpy as np
+import os
+import sys
+import time
+
+# common/ holds the modules shared by all the projects
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.input_utils import prefetch_buffer_size, benchmark_input_pipeline
+from common.step_timer import StepTimer
+from common.async_checkpoint import AsyncCheckpointer
+from common.rnn_cells import create_lstm_cell, fused_bidirectional_lstm
+from sampled_softmax import sampled_sequence_loss
+from common.beam_search import decode_length, beam_search_decode
+from evaluation import read_tokens, graph_translate_batch, evaluate_translation
 
 # TODO: Use tf.app.flags
 flags = tf.app.flags
@@ -24,8 +37,23 @@ flags.DEFINE_integer('source_max_length', 50, 'maximum length of source sequence
 flags.DEFINE_integer('target_max_length', 50, 'maximum length of target sequence')
 flags.DEFINE_float('max_gradient', 5.0, 'threshold value for gradient clipping')
 flags.DEFINE_integer('num_iterations', 17000, 'number of iterations for training')
-flags.DEFINE_integer('print_every', 100, 'print loss and sample every ... iterations')
+flags.DEFINE_integer('print_every', 100, 'print loss and step time every ... iterations')
 flags.DEFINE_integer('save_every', 1000, 'save checkpoint every ... iterations')
+flags.DEFINE_integer('sample_every', 100, 'decode and print a sample every ... iterations, 0 to disable')
+flags.DEFINE_integer('beam_width', 1, 'beam width used to decode samples, 1 for greedy decoding')
+flags.DEFINE_float('length_penalty_weight', 1.0, 'length normalization of beam scores, 0 to disable')
+flags.DEFINE_integer('num_parallel_calls', -1, 'number of elements to preprocess in parallel, -1 to autotune')
+flags.DEFINE_integer('input_memory_budget_mb', 0, 'memory (MB) for prefetched batches, 0 to autotune')
+flags.DEFINE_integer('benchmark_input_steps', 0, 'only time the input pipeline for ... batches and exit')
+flags.DEFINE_boolean('report_stalls', False, 'report time spent waiting for data and computing per step')
+flags.DEFINE_string('cell_type', 'lstm', 'LSTM implementation: lstm, block (LSTMBlockCell) or fused (LSTMBlockFusedCell encoder)')
+flags.DEFINE_string('softmax_loss', 'full', 'training loss over the target vocabulary: full, sampled or nce')
+flags.DEFINE_integer('num_sampled', 512, 'number of target words sampled per batch by sampled/nce loss')
+flags.DEFINE_boolean('async_checkpoint', True, 'write checkpoints in a background thread')
+flags.DEFINE_integer('keep_checkpoints', 5, 'number of recent checkpoints to keep')
+flags.DEFINE_float('average_decay', 0., 'decay of the weight average saved with every checkpoint, 0 to disable')
+flags.DEFINE_string('eval_source_file', '', 'translate this file after training and compute BLEU and chrF, empty to disable')
+flags.DEFINE_string('eval_target_file', '../data/tst2012.en', 'reference translations of eval_source_file')
 
 FLAGS = flags.FLAGS
 
@@ -42,7 +70,8 @@ def load_vocab(vocab_file):
 def create_input_data(source_data_file, target_data_file,
                       source_vocab_file, target_vocab_file,
                       batch_size, sos, eos, unk_id,
-                      source_max_length, target_max_length):
+                      source_max_length, target_max_length,
+                      num_parallel_calls, memory_budget_mb):
   source_dataset = tf.data.TextLineDataset(tf.gfile.Glob(source_data_file))
   target_dataset = tf.data.TextLineDataset(tf.gfile.Glob(target_data_file))
   source_vocab = lookup_ops.index_table_from_file(
@@ -50,35 +79,29 @@ def create_input_data(source_data_file, target_data_file,
   target_vocab = lookup_ops.index_table_from_file(
     target_vocab_file, default_value=unk_id)
 
-  output_buffer_size = batch_size * 1000
+  output_buffer_size = prefetch_buffer_size(
+    memory_budget_mb, batch_size, source_max_length, target_max_length)
 
   source_eos_id = tf.cast(source_vocab.lookup(tf.constant(eos)), tf.int32)
   target_sos_id = tf.cast(target_vocab.lookup(tf.constant(sos)), tf.int32)
   target_eos_id = tf.cast(target_vocab.lookup(tf.constant(eos)), tf.int32)
 
+  def _split(src, tgt):
+    return tf.string_split([src]).values, tf.string_split([tgt]).values
+
+  # Truncate, look up ids, add <s>/</s> and compute lengths in one stage
+  def _to_ids(src, tgt):
+    src = tf.cast(source_vocab.lookup(src[:source_max_length]), tf.int32)
+    tgt = tf.cast(target_vocab.lookup(tgt[:target_max_length]), tf.int32)
+    tgt_in = tf.concat(([target_sos_id], tgt), 0)
+    tgt_out = tf.concat((tgt, [target_eos_id]), 0)
+    return src, tgt_in, tgt_out, tf.size(src), tf.size(tgt_in)
+
   dataset = tf.data.Dataset.zip((source_dataset, target_dataset))
-  dataset = dataset.map(
-    lambda src, tgt: (tf.string_split([src]).values,
-                      tf.string_split([tgt]).values)).prefetch(output_buffer_size)
+  dataset = dataset.map(_split, num_parallel_calls=num_parallel_calls)
   dataset = dataset.filter(
     lambda src, tgt: tf.logical_and(tf.size(src) > 0, tf.size(tgt) > 0))
-  dataset = dataset.map(
-    lambda src, tgt: (src[:source_max_length], tgt[:target_max_length]))
-  dataset = dataset.prefetch(output_buffer_size)
-
-  dataset = dataset.map(
-    lambda src, tgt: (tf.cast(source_vocab.lookup(src), tf.int32),
-                      tf.cast(target_vocab.lookup(tgt), tf.int32)))
-  dataset = dataset.prefetch(output_buffer_size)
-
-  dataset = dataset.map(
-    lambda src, tgt: (src,
-                      tf.concat(([target_sos_id], tgt), 0),
-                      tf.concat((tgt, [target_eos_id]), 0))).prefetch(output_buffer_size)
-
-  dataset = dataset.map(
-    lambda src, tgt_in, tgt_out: (
-      src, tgt_in, tgt_out, tf.size(src), tf.size(tgt_in))).prefetch(output_buffer_size)
+  dataset = dataset.map(_to_ids, num_parallel_calls=num_parallel_calls)
 
   dataset = dataset.shuffle(100).repeat().padded_batch(
     batch_size,
@@ -92,6 +115,8 @@ def create_input_data(source_data_file, target_data_file,
                     target_eos_id,
                     0,
                     0))
+  # Only whole batches are buffered, bounded by the memory budget if one is given
+  dataset = dataset.prefetch(output_buffer_size)
 
   iterator = dataset.make_initializable_iterator()
 
@@ -105,7 +130,9 @@ def create_network(source_sequence, sos, eos,
                    target_sequence_length,
                    source_vocab_size, target_vocab_size,
                    hidden_size, keep_prob, batch_size,
-                   encoder_num_layers, decoder_num_layers):
+                   encoder_num_layers, decoder_num_layers,
+                   softmax_loss, num_sampled, cell_type,
+                   beam_width, length_penalty_weight):
   with tf.variable_scope('encoder'):
     encoder_embedding = tf.get_variable(
       'encoder_embedding_weights',
@@ -118,27 +145,31 @@ def create_network(source_sequence, sos, eos,
 
     # TODO: Update to bidirectional RNN
     def _create_encoder_cell(hidden_size):
-      cell =  tf.nn.rnn_cell.LSTMCell(hidden_size)
-      return tf.nn.rnn_cell.DropoutWrapper(cell, input_keep_prob=keep_prob)
+      return create_lstm_cell(cell_type, hidden_size, keep_prob)
 
     bi_num_layers = int(encoder_num_layers / 2)
 
-    if bi_num_layers == 1:
-      fw_encoder_lstm = _create_encoder_cell(hidden_size)
-      bw_encoder_lstm = _create_encoder_cell(hidden_size)
+    if cell_type == 'fused':
+      encoder_outputs, bi_encoder_state = fused_bidirectional_lstm(
+        encoder_embedded, source_sequence_length, hidden_size,
+        bi_num_layers, keep_prob)
     else:
-      fw_encoder_lstm = tf.nn.rnn_cell.MultiRNNCell(
-        [_create_encoder_cell(hidden_size) for _ in range(bi_num_layers)])
-      bw_encoder_lstm = tf.nn.rnn_cell.MultiRNNCell(
-        [_create_encoder_cell(hidden_size) for _ in range(bi_num_layers)])
-
-    encoder_outputs, bi_encoder_state = tf.nn.bidirectional_dynamic_rnn(
-      fw_encoder_lstm,
-      bw_encoder_lstm,
-      encoder_embedded,
-      dtype=tf.float32,
-      time_major=True,
-      sequence_length=source_sequence_length)
+      if bi_num_layers == 1:
+        fw_encoder_lstm = _create_encoder_cell(hidden_size)
+        bw_encoder_lstm = _create_encoder_cell(hidden_size)
+      else:
+        fw_encoder_lstm = tf.nn.rnn_cell.MultiRNNCell(
+          [_create_encoder_cell(hidden_size) for _ in range(bi_num_layers)])
+        bw_encoder_lstm = tf.nn.rnn_cell.MultiRNNCell(
+          [_create_encoder_cell(hidden_size) for _ in range(bi_num_layers)])
+
+      encoder_outputs, bi_encoder_state = tf.nn.bidirectional_dynamic_rnn(
+        fw_encoder_lstm,
+        bw_encoder_lstm,
+        encoder_embedded,
+        dtype=tf.float32,
+        time_major=True,
+        sequence_length=source_sequence_length)
 
     if bi_num_layers == 1:
       encoder_state = bi_encoder_state
@@ -169,12 +200,11 @@ def create_network(source_sequence, sos, eos,
 
     # TODO: Update to bidirectional RNN
     def _create_decoder_cell(hidden_size):
-      cell =  tf.nn.rnn_cell.LSTMCell(hidden_size)
-      return tf.nn.rnn_cell.DropoutWrapper(cell, input_keep_prob=keep_prob)
-    decoder_lstm = tf.nn.rnn_cell.MultiRNNCell(
+      return create_lstm_cell(cell_type, hidden_size, keep_prob)
+    decoder_cell = tf.nn.rnn_cell.MultiRNNCell(
       [_create_decoder_cell(hidden_size) for _ in range(decoder_num_layers)])
     decoder_lstm = tf.contrib.seq2seq.AttentionWrapper(
-      decoder_lstm, attention_mechanism,
+      decoder_cell, attention_mechanism,
       attention_layer_size=hidden_size)
     decoder_output_layer = tf.layers.Dense(target_vocab_size, use_bias=False)
 
@@ -185,11 +215,12 @@ def create_network(source_sequence, sos, eos,
       target_sequence_length,
       time_major=True)
 
+    # Sampled losses project the RNN outputs themselves, onto the sampled classes only
     my_decoder = tf.contrib.seq2seq.BasicDecoder(
       decoder_lstm,
       helper,
       decoder_initial_state,
-      decoder_output_layer)
+      decoder_output_layer if softmax_loss == 'full' else None)
 
     decoder_outputs, decoder_final_states, _ = tf.contrib.seq2seq.dynamic_decode(
       my_decoder,
@@ -197,8 +228,14 @@ def create_network(source_sequence, sos, eos,
       swap_memory=True)
 
     target_sequence_out = tf.transpose(target_sequence_out)
-    cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(
-      labels=target_sequence_out, logits=decoder_outputs.rnn_output)
+    if softmax_loss == 'full':
+      cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(
+        labels=target_sequence_out, logits=decoder_outputs.rnn_output)
+    else:
+      cross_entropy = sampled_sequence_loss(
+        decoder_outputs.rnn_output, target_sequence_out,
+        decoder_output_layer, hidden_size, target_vocab_size,
+        num_sampled, softmax_loss)
     loss_weights = tf.sequence_mask(
       target_sequence_length, tf.shape(target_sequence_out)[0],
       dtype=tf.float32)
@@ -206,28 +243,54 @@ def create_network(source_sequence, sos, eos,
 
     loss = tf.reduce_sum(cross_entropy * loss_weights) / tf.to_float(batch_size)
 
+  if beam_width > 1:
+    # Beam search attends over a copy of the encoder outputs for every beam
+    with tf.variable_scope('attention', reuse=True):
+      infer_attention_mechanism = tf.contrib.seq2seq.BahdanauAttention(
+        hidden_size,
+        tf.contrib.seq2seq.tile_batch(attention_state, beam_width),
+        memory_sequence_length=tf.contrib.seq2seq.tile_batch(
+          source_sequence_length, beam_width))
+
   with tf.variable_scope('decoder', reuse=True):
     target_sos_id = tf.cast(target_vocab.lookup(tf.constant(sos)), tf.int32)
     target_eos_id = tf.cast(target_vocab.lookup(tf.constant(eos)), tf.int32)
     infer_sequence_in = tf.fill([batch_size], target_sos_id)
 
-    infer_helper = tf.contrib.seq2seq.GreedyEmbeddingHelper(
-      decoder_embedding,
-      infer_sequence_in,
-      target_eos_id)
-    infer_decoder = tf.contrib.seq2seq.BasicDecoder(
-      decoder_lstm,
-      infer_helper,
-      decoder_initial_state,
-      decoder_output_layer)
-
-    maximum_iterations = tf.round(tf.reduce_max(source_sequence_length) * 2)
-    infer_decoder_outputs, _, _ = tf.contrib.seq2seq.dynamic_decode(
-      infer_decoder,
-      maximum_iterations=maximum_iterations,
-      output_time_major=True,
-      swap_memory=True)
-    preds = infer_decoder_outputs.sample_id
+    maximum_iterations = decode_length(source_sequence_length)
+    if beam_width > 1:
+      infer_decoder_lstm = tf.contrib.seq2seq.AttentionWrapper(
+        decoder_cell, infer_attention_mechanism,
+        attention_layer_size=hidden_size)
+      infer_initial_state = infer_decoder_lstm.zero_state(
+        batch_size * beam_width, tf.float32).clone(
+          cell_state=tf.contrib.seq2seq.tile_batch(encoder_state, beam_width))
+      preds = beam_search_decode(
+        infer_decoder_lstm,
+        decoder_embedding,
+        infer_sequence_in,
+        target_eos_id,
+        infer_initial_state,
+        decoder_output_layer,
+        beam_width, length_penalty_weight,
+        maximum_iterations)
+    else:
+      infer_helper = tf.contrib.seq2seq.GreedyEmbeddingHelper(
+        decoder_embedding,
+        infer_sequence_in,
+        target_eos_id)
+      infer_decoder = tf.contrib.seq2seq.BasicDecoder(
+        decoder_lstm,
+        infer_helper,
+        decoder_initial_state,
+        decoder_output_layer)
+
+      infer_decoder_outputs, _, _ = tf.contrib.seq2seq.dynamic_decode(
+        infer_decoder,
+        maximum_iterations=maximum_iterations,
+        output_time_major=True,
+        swap_memory=True)
+      preds = infer_decoder_outputs.sample_id
   return loss, source_sequence, target_sequence_in, preds
 
 def create_train_op(loss, max_gradient, learning_rate):
@@ -257,8 +320,22 @@ target_int_to_vocab, target_vocab_size = load_vocab(FLAGS.target_vocab_file)
   FLAGS.source_data_file, FLAGS.target_data_file,
   FLAGS.source_vocab_file, FLAGS.target_vocab_file,
   FLAGS.batch_size, FLAGS.sos, FLAGS.eos, FLAGS.unk_id,
-  FLAGS.source_max_length, FLAGS.target_max_length)
-
+  FLAGS.source_max_length, FLAGS.target_max_length,
+  FLAGS.num_parallel_calls, FLAGS.input_memory_budget_mb)
+
+if FLAGS.benchmark_input_steps > 0:
+  sess = tf.Session()
+  sess.run(tf.tables_initializer())
+  sess.run(iterator_initializer)
+  benchmark_input_pipeline(
+    sess,
+    (source_sequence, target_sequence_in, target_sequence_out,
+     source_sequence_length, target_sequence_length),
+    FLAGS.benchmark_input_steps)
+  sys.exit()
+
+# Dropout is on by default, evaluation feeds 1
+keep_prob = tf.placeholder_with_default(FLAGS.keep_prob, [], name='keep_prob')
 loss, t_source_sequence, t_target_sequence_in, preds = create_network(
   source_sequence, FLAGS.sos, FLAGS.eos,
   target_sequence_in, target_sequence_out,
@@ -266,8 +343,10 @@ loss, t_source_sequence, t_target_sequence_in, preds = create_network(
   source_sequence_length,
   target_sequence_length,
   source_vocab_size, target_vocab_size,
-  FLAGS.hidden_size, FLAGS.keep_prob, FLAGS.batch_size,
-  FLAGS.encoder_num_layers, FLAGS.decoder_num_layers)
+  FLAGS.hidden_size, keep_prob, FLAGS.batch_size,
+  FLAGS.encoder_num_layers, FLAGS.decoder_num_layers,
+  FLAGS.softmax_loss, FLAGS.num_sampled, FLAGS.cell_type,
+  FLAGS.beam_width, FLAGS.length_penalty_weight)
 
 global_step, train_op = create_train_op(loss, FLAGS.max_gradient,
                                         FLAGS.learning_rate)
@@ -278,21 +357,50 @@ sess.run(tf.global_variables_initializer())
 sess.run(tf.tables_initializer())
 sess.run(iterator_initializer)
 
-saver = tf.train.Saver()
+saver = tf.train.Saver(max_to_keep=FLAGS.keep_checkpoints)
 latest_checkpoint = tf.train.latest_checkpoint('checkpoint_bahdanau')
 if latest_checkpoint and tf.train.checkpoint_exists(latest_checkpoint):
   saver.restore(sess, latest_checkpoint)
+checkpointer = AsyncCheckpointer(
+  sess, saver, FLAGS.keep_checkpoints, FLAGS.average_decay,
+  enabled=FLAGS.async_checkpoint)
+
+next_batch = (source_sequence, target_sequence_in, target_sequence_out,
+              source_sequence_length, target_sequence_length)
+step_timer = StepTimer(FLAGS.print_every, enabled=FLAGS.report_stalls)
+step_time, num_steps = 0., 0
 
 for _ in range(FLAGS.num_iterations):
   i = global_step.eval(sess)
   if i >= FLAGS.num_iterations:
     print('Training complete!')
     break
-  src_seq, tar_seq, predictions, loss_value, _ = sess.run(
-    [t_source_sequence, t_target_sequence_in, preds, loss, train_op])
+  step_start = time.time()
+  # The greedy decode only runs on sample steps, normal steps fetch the loss alone
+  sample = FLAGS.sample_every > 0 and (i + 1) % FLAGS.sample_every == 0
+  feed_dict, num_tokens = None, 0
+  if step_timer.enabled or sample:
+    # Pull the batch out of the graph so that waiting and computing are timed apart
+    # and the sample is decoded from the batch the model was just trained on
+    with step_timer.waiting():
+      batch = sess.run(next_batch)
+    feed_dict = dict(zip(next_batch, batch))
+    num_tokens = np.sum(batch[3]) + np.sum(batch[4])
+  with step_timer.computing():
+    loss_value, _ = sess.run([loss, train_op], feed_dict=feed_dict)
+  step_timer.end_step(num_tokens)
+  step_time += time.time() - step_start
+  num_steps += 1
+
   if (i + 1) % FLAGS.print_every == 0:
+    print('Step {}: loss {:.4f}, {:.1f} ms/step'.format(
+      i + 1, loss_value, 1000 * step_time / num_steps))
+    step_time, num_steps = 0., 0
+
+  if sample:
+    src_seq, tar_seq, predictions = sess.run(
+      [t_source_sequence, t_target_sequence_in, preds], feed_dict=feed_dict)
     random_id = np.random.choice(src_seq.shape[1])
-    print('Step {}: loss {:.4f}'.format(i + 1, loss_value))
     src_sent = ' '.join([source_int_to_vocab[ix] for ix in src_seq[:, random_id]])
     tar_sent = ' '.join([target_int_to_vocab[ix] for ix in tar_seq[:, random_id]])
     pred_sent = ' '.join([target_int_to_vocab[ix] for ix in predictions[:, random_id]])
@@ -313,4 +421,17 @@ for _ in range(FLAGS.num_iterations):
 
   if (i + 1) % FLAGS.save_every == 0:
     print('Saving checkpoint for step {}...\n'.format(i + 1))
-    saver.save(sess, 'checkpoint_bahdanau/model-{}.ckpt'.format(i + 1))
+    checkpointer.save('checkpoint_bahdanau/model-{}.ckpt'.format(i + 1))
+
+checkpointer.close()
+step_timer.report()
+
+if FLAGS.eval_source_file:
+  evaluate_translation(
+    graph_translate_batch(
+      sess, source_sequence, source_sequence_length, preds, FLAGS.batch_size,
+      source_int_to_vocab, target_int_to_vocab, FLAGS.unk_id, FLAGS.eos,
+      feed_dict={keep_prob: 1.}),
+    read_tokens(FLAGS.eval_source_file),
+    read_tokens(FLAGS.eval_target_file),
+    FLAGS.batch_size)
@@ -6,10 +6,20 @@ import unicodedata
 import re
 import matplotlib.pyplot as plt
 import os
+import sys
 import imageio
+import time
 from zipfile import ZipFile
 import requests #updated import
 
+# common/ holds the modules shared by all the projects
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.step_timer import StepTimer
+from evaluation import held_out_split, evaluate_translation
+from quantization import QUANTIZATION_MODES, convert_to_tflite, TFLiteModel, InputRecorder, compare_models
+from memory_benchmark import process_config, measure_train_step, compare_memory
+from shape_policy import CountedFunction, sequence_spec, trim_batch, compare_shape_policies, benchmark_step
+
 # Mode can be either 'train' or 'infer'
 # Set to 'infer' will skip the training
 MODE = 'train'
@@ -19,10 +29,68 @@ BATCH_SIZE = 64
 EMBEDDING_SIZE = 256
 RNN_SIZE = 512
 NUM_EPOCHS = 15
+# Report how long each step waits for data vs. computes
+REPORT_STALLS = False
+# HELD_OUT_SIZE sentence pairs are left out of training,
+# set EVALUATE to compute the BLEU and chrF of their greedy translations (see evaluation.py)
+EVALUATE = False
+HELD_OUT_SIZE = 1000
+EVAL_BATCH_SIZE = 64
+# translate_batch stops a translation at <end> or after
+# DECODE_LENGTH_RATIO * source length + DECODE_LENGTH_OFFSET words
+DECODE_LENGTH_RATIO = 2.
+DECODE_LENGTH_OFFSET = 3
+# predict and translate_batch decode with compiled_decode (one tf.while_loop in a tf.function),
+# False decodes with one eager decoder call per word
+COMPILED_DECODE = True
+# Per-sentence latency of eager and compiled decoding on BENCHMARK_COMPILED_DECODE_SIZE held-out sentences
+BENCHMARK_COMPILED_DECODE = False
+BENCHMARK_COMPILED_DECODE_SIZE = 200
 
 # Set the score function to compute alignment vectors
 # Can choose between 'dot', 'general' or 'concat'
 ATTENTION_FUNC = 'concat'
+# Concat score: split Wa into its decoder and encoder halves, the encoder half is projected
+# once per sentence instead of Wa running over concat(decoder_output, encoder_output) every step
+SPLIT_ATTENTION = True
+# Per-word decoding latency of every score function, with the encoder projections
+# recomputed at every step or computed once per sentence
+BENCHMARK_ATTENTION_KEYS = False
+BENCHMARK_ATTENTION_KEYS_WORDS = 50
+
+# Export the trained encoder and decoder step to TFLite (float, dynamic range and int8)
+# and compare latency, size and greedy translations on held-out sentences,
+# int8 activation ranges are calibrated on CALIBRATION_SIZE sentences of raw_data_en
+QUANTIZE = False
+CALIBRATION_SIZE = 100
+QUANTIZATION_EVAL_SIZE = 200
+
+# Recompute the activations of every decoder step (attention included) in the backward pass
+# (tf.recompute_grad) instead of keeping them from the forward pass
+RECOMPUTE_GRAD = False
+# Compare peak memory and step time with and without RECOMPUTE_GRAD for these batch sizes,
+# every configuration runs in its own process (see memory_benchmark.py)
+BENCHMARK_RECOMPUTE = False
+BENCHMARK_RECOMPUTE_BATCH_SIZES = [64, 128, 256]
+
+# Shapes of the training batches (see shape_policy.py): 'static' pads every batch
+# to the longest sentence of the corpus and unrolls the decoder loop over that length,
+# 'dynamic' trims every batch to its longest sentence and loops with a tf.while_loop
+# 'static' is the default: the training LSTMs are not masked, so 'dynamic' changes how much
+# padding they read (not only the speed), the transformer masks padding and defaults to 'dynamic'
+SHAPE_POLICY = 'static'
+# Compile train_step with XLA
+JIT_COMPILE = False
+# Compare traces and steady-state step time of both shape policies, with and without XLA
+BENCHMARK_SHAPE_POLICY = False
+BENCHMARK_SHAPE_POLICY_STEPS = 100
+
+# Train the decoder over whole target sequences at once (Decoder.call_sequence),
+# False calls the decoder once per target word like in inference (same loss)
+PARALLEL_DECODER = True
+# Compare the losses and the training step time of both decoders
+BENCHMARK_PARALLEL_DECODER = False
+BENCHMARK_PARALLEL_DECODER_STEPS = 50
 
 
 def maybe_download_and_read_file(url, filename):
@@ -99,10 +167,20 @@ data_fr_out = tf.keras.preprocessing.sequence.pad_sequences(data_fr_out,
 print('French output sequences')
 print(data_fr_out[:2])
 
-dataset = tf.data.Dataset.from_tensor_slices(
-    (data_en, data_fr_in, data_fr_out))
-dataset = dataset.shuffle(len(raw_data_en)).batch(
-    BATCH_SIZE, drop_remainder=True)
+train_ids, held_out_ids = held_out_split(len(data_en), HELD_OUT_SIZE)
+
+
+def make_batches(shape_policy):
+    batches = tf.data.Dataset.from_tensor_slices(
+        (data_en[train_ids], data_fr_in[train_ids], data_fr_out[train_ids]))
+    batches = batches.shuffle(len(train_ids)).batch(
+        BATCH_SIZE, drop_remainder=True)
+    if shape_policy == 'dynamic':
+        batches = batches.map(trim_batch)
+    return batches
+
+
+dataset = make_batches(SHAPE_POLICY)
 
 
 class Encoder(tf.keras.Model):
@@ -113,9 +191,12 @@ class Encoder(tf.keras.Model):
         self.lstm = tf.keras.layers.LSTM(
             rnn_size, return_sequences=True, return_state=True)
 
-    def call(self, sequence, states):
+    def call(self, sequence, states, mask=None):
+        # mask (batch_size, max_len) is False on padding,
+        # the final states are then those of the last words
         embed = self.embedding(sequence)
-        output, state_h, state_c = self.lstm(embed, initial_state=states)
+        output, state_h, state_c = self.lstm(
+            embed, initial_state=states, mask=mask)
 
         return output, state_h, state_c
 
@@ -130,9 +211,11 @@ encoder = Encoder(en_vocab_size, EMBEDDING_SIZE, RNN_SIZE)
 
 
 class LuongAttention(tf.keras.Model):
-    def __init__(self, rnn_size, attention_func):
+    def __init__(self, rnn_size, attention_func, split=SPLIT_ATTENTION):
         super(LuongAttention, self).__init__()
+        self.rnn_size = rnn_size
         self.attention_func = attention_func
+        self.split = split
 
         if attention_func not in ['dot', 'general', 'concat']:
             raise ValueError(
@@ -145,35 +228,73 @@ class LuongAttention(tf.keras.Model):
             # Concat score function
             self.wa = tf.keras.layers.Dense(rnn_size, activation='tanh')
             self.va = tf.keras.layers.Dense(1)
+            # The halves of the kernel of Wa are used before Wa is ever called
+            self.wa.build((None, 2 * rnn_size))
+
+    def precompute_keys(self, encoder_output):
+        """
+        The part of the scores that only depends on the encoder output, (batch_size, max_len, rnn_size):
+        encoder_output for dot, Wa (dot) encoder_output for general,
+        the encoder half of Wa (dot) encoder_output (bias included) for concat
+        Computed once per sentence, it can be passed to call() as keys at every decoding step
+        """
+        if self.attention_func == 'general':
+            return self.wa(encoder_output)
+        if self.attention_func == 'concat' and self.split:
+            return tf.matmul(encoder_output, self.wa.kernel[self.rnn_size:]) + self.wa.bias
+        return encoder_output
+
+    def call(self, decoder_output, encoder_output, encoder_mask=None, keys=None):
+        # decoder_output holds one or more decoder steps (teacher forcing),
+        # the steps attend to the encoder output independently
+        # keys, if given, is precompute_keys(encoder_output) computed beforehand
+        if keys is None:
+            keys = self.precompute_keys(encoder_output)
 
-    def call(self, decoder_output, encoder_output):
         if self.attention_func == 'dot':
             # Dot score function: decoder_output (dot) encoder_output
-            # decoder_output has shape: (batch_size, 1, rnn_size)
+            # decoder_output has shape: (batch_size, num_steps, rnn_size)
             # encoder_output has shape: (batch_size, max_len, rnn_size)
-            # => score has shape: (batch_size, 1, max_len)
-            score = tf.matmul(decoder_output, encoder_output, transpose_b=True)
+            # => score has shape: (batch_size, num_steps, max_len)
+            score = tf.matmul(decoder_output, keys, transpose_b=True)
         elif self.attention_func == 'general':
             # General score function: decoder_output (dot) (Wa (dot) encoder_output)
-            # decoder_output has shape: (batch_size, 1, rnn_size)
+            # decoder_output has shape: (batch_size, num_steps, rnn_size)
             # encoder_output has shape: (batch_size, max_len, rnn_size)
-            # => score has shape: (batch_size, 1, max_len)
-            score = tf.matmul(decoder_output, self.wa(
-                encoder_output), transpose_b=True)
-        elif self.attention_func == 'concat':
+            # => score has shape: (batch_size, num_steps, max_len)
+            score = tf.matmul(decoder_output, keys, transpose_b=True)
+        elif self.split:
+            # Concat score function with Wa split into its decoder and encoder halves:
+            # Wa (dot) concat(decoder_output, encoder_output) = Wa_dec (dot) decoder_output + keys
+            # (batch_size, num_steps, 1, rnn_size) + (batch_size, 1, max_len, rnn_size)
+            # => va => (batch_size, num_steps, max_len, 1)
+            decoder_part = tf.matmul(decoder_output, self.wa.kernel[:self.rnn_size])
+            score = self.va(tf.tanh(decoder_part[:, :, tf.newaxis] + keys[:, tf.newaxis]))
+
+            # (batch_size, num_steps, max_len, 1) => (batch_size, num_steps, max_len)
+            score = tf.squeeze(score, -1)
+        else:
             # Concat score function: va (dot) tanh(Wa (dot) concat(decoder_output + encoder_output))
-            # Decoder output must be broadcasted to encoder output's shape first
+            # Decoder output and encoder output must be broadcasted to
+            # (batch_size, num_steps, max_len, rnn_size) first
             decoder_output = tf.tile(
-                decoder_output, [1, encoder_output.shape[1], 1])
+                decoder_output[:, :, tf.newaxis], [1, 1, tf.shape(encoder_output)[1], 1])
+            encoder_output_per_step = tf.tile(
+                encoder_output[:, tf.newaxis], [1, tf.shape(decoder_output)[1], 1, 1])
 
             # Concat => Wa => va
-            # (batch_size, max_len, 2 * rnn_size) => (batch_size, max_len, rnn_size) => (batch_size, max_len, 1)
+            # (batch_size, num_steps, max_len, 2 * rnn_size) => (batch_size, num_steps, max_len, rnn_size)
+            # => (batch_size, num_steps, max_len, 1)
             score = self.va(
-                self.wa(tf.concat((decoder_output, encoder_output), axis=-1)))
+                self.wa(tf.concat((decoder_output, encoder_output_per_step), axis=-1)))
 
-            # Transpose score vector to have the same shape as other two above
-            # (batch_size, max_len, 1) => (batch_size, 1, max_len)
-            score = tf.transpose(score, [0, 2, 1])
+            # Remove the last axis to have the same shape as other two above
+            # (batch_size, num_steps, max_len, 1) => (batch_size, num_steps, max_len)
+            score = tf.squeeze(score, -1)
+
+        # No attention on padded source words, encoder_mask has shape (batch_size, max_len)
+        if encoder_mask is not None:
+            score += (1. - tf.cast(encoder_mask[:, tf.newaxis, :], tf.float32)) * -1e9
 
         # alignment a_t = softmax(score)
         alignment = tf.nn.softmax(score, axis=2)
@@ -195,31 +316,43 @@ class Decoder(tf.keras.Model):
         self.wc = tf.keras.layers.Dense(rnn_size, activation='tanh')
         self.ws = tf.keras.layers.Dense(vocab_size)
 
-    def call(self, sequence, state, encoder_output):
+    def call(self, sequence, state, encoder_output, encoder_mask=None, keys=None):
         # Remember that the input to the decoder
         # is now a batch of one-word sequences,
         # which means that its shape is (batch_size, 1)
+        # keys: self.attention.precompute_keys(encoder_output), computed once per sentence
+        logits, state_h, state_c, alignment = self.call_sequence(
+            sequence, state, encoder_output, encoder_mask, keys)
+
+        # (batch_size, 1, vocab_size) => (batch_size, vocab_size)
+        return tf.squeeze(logits, 1), state_h, state_c, alignment
+
+    def call_sequence(self, sequence, state, encoder_output, encoder_mask=None, keys=None):
+        """
+        Decode whole target sequences (batch_size, num_steps) at once (teacher forcing):
+        the LSTM input does not depend on the attention,
+        so the LSTM runs over all the steps first, then all the steps attend at once
+        Returns the logits (batch_size, num_steps, vocab_size), the final states
+        and the alignments (batch_size, num_steps, source_length)
+        """
         embed = self.embedding(sequence)
 
-        # Therefore, the lstm_out has shape (batch_size, 1, rnn_size)
+        # lstm_out has shape (batch_size, num_steps, rnn_size)
         lstm_out, state_h, state_c = self.lstm(embed, initial_state=state)
 
         # Use self.attention to compute the context and alignment vectors
-        # context vector's shape: (batch_size, 1, rnn_size)
-        # alignment vector's shape: (batch_size, 1, source_length)
-        context, alignment = self.attention(lstm_out, encoder_output)
+        # context vector's shape: (batch_size, num_steps, rnn_size)
+        # alignment vector's shape: (batch_size, num_steps, source_length)
+        context, alignment = self.attention(lstm_out, encoder_output, encoder_mask, keys)
 
         # Combine the context vector and the LSTM output
-        # Before combined, both have shape of (batch_size, 1, rnn_size),
-        # so let's squeeze the axis 1 first
-        # After combined, it will have shape of (batch_size, 2 * rnn_size)
-        lstm_out = tf.concat(
-            [tf.squeeze(context, 1), tf.squeeze(lstm_out, 1)], 1)
+        # After combined, it will have shape of (batch_size, num_steps, 2 * rnn_size)
+        lstm_out = tf.concat([context, lstm_out], -1)
 
-        # lstm_out now has shape (batch_size, rnn_size)
+        # lstm_out now has shape (batch_size, num_steps, rnn_size)
         lstm_out = self.wc(lstm_out)
 
-        # Finally, it is converted back to vocabulary space: (batch_size, vocab_size)
+        # Finally, it is converted back to vocabulary space: (batch_size, num_steps, vocab_size)
         logits = self.ws(lstm_out)
 
         return logits, state_h, state_c, alignment
@@ -249,60 +382,275 @@ def loss_func(targets, logits):
 optimizer = tf.keras.optimizers.Adam(clipnorm=5.0)
 
 
-def predict(test_source_text=None):
+def predict(test_source_text=None, compiled=COMPILED_DECODE):
     if test_source_text is None:
         test_source_text = raw_data_en[np.random.choice(len(raw_data_en))]
     print(test_source_text)
     test_source_seq = en_tokenizer.texts_to_sequences([test_source_text])
     print(test_source_seq)
 
+    if compiled:
+        out_words, alignments = compiled_decode_words(test_source_seq)[0]
+    else:
+        out_words, alignments = eager_decode(test_source_seq[0])
+
+    print(' '.join(out_words))
+    return alignments, test_source_text.split(' '), out_words
+
+
+def eager_decode(source_seq):
+    """
+    Greedy decoding of one source sequence (list of ids), one eager decoder call per word,
+    stops at <end> or after decode_length words
+    Returns the words (<end> included) and the alignments (num_words, source_length)
+    """
     en_initial_states = encoder.init_states(1)
-    en_outputs = encoder(tf.constant(test_source_seq), en_initial_states)
+    en_outputs = encoder(tf.constant([source_seq]), en_initial_states)
 
     de_input = tf.constant([[fr_tokenizer.word_index['<start>']]])
     de_state_h, de_state_c = en_outputs[1:]
+    keys = decoder.attention.precompute_keys(en_outputs[0])
+    max_words = int(decode_length(len(source_seq)))
     out_words = []
     alignments = []
 
     while True:
         de_output, de_state_h, de_state_c, alignment = decoder(
-            de_input, (de_state_h, de_state_c), en_outputs[0])
+            de_input, (de_state_h, de_state_c), en_outputs[0], keys=keys)
         de_input = tf.expand_dims(tf.argmax(de_output, -1), 0)
         out_words.append(fr_tokenizer.index_word[de_input.numpy()[0][0]])
 
         alignments.append(alignment.numpy())
 
-        if out_words[-1] == '<end>' or len(out_words) >= 20:
+        if out_words[-1] == '<end>' or len(out_words) >= max_words:
             break
 
-    print(' '.join(out_words))
-    return np.array(alignments), test_source_text.split(' '), out_words
-
-
-@tf.function
-def train_step(source_seq, target_seq_in, target_seq_out, en_initial_states):
-    loss = 0
-    with tf.GradientTape() as tape:
-        en_outputs = encoder(source_seq, en_initial_states)
-        en_states = en_outputs[1:]
-        de_state_h, de_state_c = en_states
+    # alignment has shape (1, 1, source_length)
+    return out_words, np.concatenate(alignments)[:, 0]
 
-        # We need to create a loop to iterate through the target sequences
-        for i in range(target_seq_out.shape[1]):
-            # Input to the decoder must have shape of (batch_size, length)
-            # so we need to expand one dimension
-            decoder_in = tf.expand_dims(target_seq_in[:, i], 1)
-            logit, de_state_h, de_state_c, _ = decoder(
-                decoder_in, (de_state_h, de_state_c), en_outputs[0])
 
-            # The loss is now accumulated through the whole batch
-            loss += loss_func(target_seq_out[:, i], logit)
+def greedy_decode(source_seq, max_steps):
+    """
+    Greedy decoding of a batch of padded source sequences,
+    stops when every sentence has produced <end> or its max_steps words
+    (max_steps is either one number for the batch or one per sentence)
+    Returns the ids of the words, padded with 0 after <end>
+    """
+    end_id = fr_tokenizer.word_index['<end>']
+    max_steps = np.broadcast_to(max_steps, len(source_seq))
+    encoder_mask = tf.constant(source_seq != 0)
+    en_outputs = encoder(tf.constant(source_seq), encoder.init_states(len(source_seq)),
+                         mask=encoder_mask)
 
-    variables = encoder.trainable_variables + decoder.trainable_variables
-    gradients = tape.gradient(loss, variables)
-    optimizer.apply_gradients(zip(gradients, variables))
+    de_input = np.full((len(source_seq), 1), fr_tokenizer.word_index['<start>'])
+    de_state_h, de_state_c = en_outputs[1:]
+    keys = decoder.attention.precompute_keys(en_outputs[0])
+    finished = np.zeros(len(source_seq), dtype=bool)
+    out_ids = []
+    for step in range(max_steps.max()):
+        de_output, de_state_h, de_state_c, _ = decoder(
+            tf.constant(de_input), (de_state_h, de_state_c), en_outputs[0],
+            encoder_mask, keys)
+        new_word = tf.argmax(de_output, -1).numpy()
+        new_word[finished] = 0
+        finished |= new_word == end_id
+        finished |= step + 1 >= max_steps
+        out_ids.append(new_word)
+        de_input = new_word[:, np.newaxis]
+        if finished.all():
+            break
 
-    return loss / target_seq_out.shape[1]
+    return np.stack(out_ids, axis=1)
+
+
+def make_compiled_decode(encoder, decoder):
+    """
+    Greedy decoding of a batch of padded source sequences in a single tf.function:
+    the decoder steps run in a tf.while_loop and the word ids and alignments of every step
+    are written to TensorArrays, nothing goes back to Python before the end
+    Like greedy_decode, stops when every sentence has produced <end> or its max_steps words
+    (max_steps has one number per sentence)
+    Returns the ids of the words (batch_size, num_steps), padded with 0 after <end>,
+    and the alignments (batch_size, num_steps, source_length)
+    """
+    start_id = fr_tokenizer.word_index['<start>']
+    end_id = fr_tokenizer.word_index['<end>']
+
+    @tf.function(input_signature=[sequence_spec(), tf.TensorSpec([None], tf.int32)])
+    def compiled_decode(source_seq, max_steps):
+        batch_size = tf.shape(source_seq)[0]
+        encoder_mask = tf.not_equal(source_seq, 0)
+        en_outputs = encoder(source_seq, encoder.init_states(batch_size), mask=encoder_mask)
+        keys = decoder.attention.precompute_keys(en_outputs[0])
+
+        def not_finished(step, de_input, de_state_h, de_state_c, finished, ids, alignments):
+            return tf.logical_not(tf.reduce_all(finished))
+
+        def decode_step(step, de_input, de_state_h, de_state_c, finished, ids, alignments):
+            de_output, de_state_h, de_state_c, alignment = decoder(
+                de_input, (de_state_h, de_state_c), en_outputs[0], encoder_mask, keys)
+            new_word = tf.argmax(de_output, -1, output_type=tf.int32)
+            new_word = tf.where(finished, 0, new_word)
+            finished = tf.logical_or(finished, tf.equal(new_word, end_id))
+            finished = tf.logical_or(finished, step + 1 >= max_steps)
+            # alignment has shape (batch_size, 1, source_length)
+            return (step + 1, new_word[:, tf.newaxis], de_state_h, de_state_c, finished,
+                    ids.write(step, new_word), alignments.write(step, alignment[:, 0]))
+
+        _, _, _, _, _, ids, alignments = tf.while_loop(
+            not_finished, decode_step,
+            (tf.constant(0), tf.fill([batch_size, 1], start_id), en_outputs[1], en_outputs[2],
+             max_steps <= 0,
+             tf.TensorArray(tf.int32, size=0, dynamic_size=True, element_shape=[None]),
+             tf.TensorArray(tf.float32, size=0, dynamic_size=True, element_shape=[None, None])))
+
+        # (num_steps, batch_size, ...) => (batch_size, num_steps, ...)
+        return tf.transpose(ids.stack()), tf.transpose(alignments.stack(), [1, 0, 2])
+
+    return compiled_decode
+
+
+compiled_decode = make_compiled_decode(encoder, decoder)
+
+
+def compiled_decode_words(source_seqs):
+    """
+    Greedy decoding of a batch of source sequences (lists of ids) with compiled_decode,
+    at most decode_length words per sentence, the ids are converted to words once, after the whole batch is decoded
+    Returns the words (<end> included) and the alignments (num_words, source_length) of every sentence
+    """
+    source_seq = tf.keras.preprocessing.sequence.pad_sequences(source_seqs, padding='post')
+    ids, alignments = compiled_decode(
+        tf.constant(source_seq), tf.constant(decode_length([len(seq) for seq in source_seqs])))
+    results = []
+    for seq, words, alignment in zip(source_seqs, ids.numpy(), alignments.numpy()):
+        num_words = np.count_nonzero(words)
+        results.append(([fr_tokenizer.index_word[i] for i in words[:num_words]],
+                        alignment[:num_words, :len(seq)]))
+    return results
+
+
+def decode_length(source_lengths):
+    """
+    Maximum number of words of the translation of each source sentence
+    """
+    return (np.round(DECODE_LENGTH_RATIO * np.asarray(source_lengths)).astype(np.int32)
+            + DECODE_LENGTH_OFFSET)
+
+
+def translate_tokens(source_seqs):
+    """
+    Greedy translations of a batch of source sequences (lists of ids), as lists of words
+    """
+    source_seq = tf.keras.preprocessing.sequence.pad_sequences(
+        source_seqs, padding='post')
+    max_steps = decode_length([len(seq) for seq in source_seqs])
+    if COMPILED_DECODE:
+        output = compiled_decode(tf.constant(source_seq), tf.constant(max_steps))[0].numpy()
+    else:
+        output = greedy_decode(source_seq, max_steps)
+    end_id = fr_tokenizer.word_index['<end>']
+    translations = []
+    for words in output.tolist():
+        if end_id in words:
+            words = words[:words.index(end_id)]
+        # Sentences stopped by their length limit are padded with 0
+        translations.append([fr_tokenizer.index_word[i] for i in words if i != 0])
+    return translations
+
+
+def translate_batch(sentences):
+    """
+    Greedy translations of English sentences, BATCH_SIZE at a time:
+    sentences of similar lengths are padded and decoded together
+    Returns the translations in the order of sentences
+    """
+    source_seqs = en_tokenizer.texts_to_sequences(
+        [normalize_string(sentence) for sentence in sentences])
+    order = np.argsort([len(seq) for seq in source_seqs], kind='stable')
+    translations = [None] * len(sentences)
+    for start in range(0, len(order), BATCH_SIZE):
+        ids = order[start:start + BATCH_SIZE]
+        for i, words in zip(ids, translate_tokens([source_seqs[i] for i in ids])):
+            translations[i] = ' '.join(words)
+    return translations
+
+
+def decoder_step(decoder, decoder_in, state_h, state_c, encoder_output):
+    """
+    Teacher-forced decoder over the words of decoder_in (batch_size, num_words), without the alignments
+    Returns the logits (batch_size, num_words, vocab_size) and the final states
+    With RECOMPUTE_GRAD, only its inputs are kept for the backward pass
+    (gradients do not flow to decoder_in, the word ids)
+    """
+    def step(state_h, state_c, encoder_output):
+        logits, state_h, state_c, _ = decoder.call_sequence(
+            decoder_in, (state_h, state_c), encoder_output)
+        return logits, state_h, state_c
+
+    if RECOMPUTE_GRAD:
+        step = tf.recompute_grad(step)
+    return step(state_h, state_c, encoder_output)
+
+
+def teacher_forced_loss(encoder, decoder, source_seq, target_seq_in, target_seq_out,
+                        en_initial_states, parallel_decoder=PARALLEL_DECODER):
+    """
+    Loss of the decoder fed with the target words, averaged over the target words
+    parallel_decoder: decode all the words at once, else one decoder call per word
+    """
+    en_outputs = encoder(source_seq, en_initial_states)
+    en_states = en_outputs[1:]
+    de_state_h, de_state_c = en_states
+
+    if parallel_decoder:
+        logits, _, _ = decoder_step(
+            decoder, target_seq_in, de_state_h, de_state_c, en_outputs[0])
+        # The mean over all the words is the mean of the losses of every step below
+        return loss_func(target_seq_out, logits)
+
+    loss = 0.
+    # A Python number unrolls the loop below,
+    # a tensor (unknown length) makes AutoGraph build a tf.while_loop
+    target_length = target_seq_out.shape[1]
+    if target_length is None:
+        target_length = tf.shape(target_seq_out)[1]
+
+    # We need to create a loop to iterate through the target sequences
+    for i in range(target_length):
+        # Input to the decoder must have shape of (batch_size, length)
+        # so we need to expand one dimension
+        decoder_in = tf.expand_dims(target_seq_in[:, i], 1)
+        logit, de_state_h, de_state_c = decoder_step(
+            decoder, decoder_in, de_state_h, de_state_c, en_outputs[0])
+
+        # The loss is now accumulated through the whole batch
+        loss += loss_func(target_seq_out[:, i], logit[:, 0])
+
+    return loss / tf.cast(target_length, tf.float32)
+
+
+def make_train_step(encoder, decoder, optimizer, shape_policy=SHAPE_POLICY,
+                    jit_compile=JIT_COMPILE, parallel_decoder=PARALLEL_DECODER):
+    def train_step(source_seq, target_seq_in, target_seq_out, en_initial_states):
+        with tf.GradientTape() as tape:
+            loss = teacher_forced_loss(encoder, decoder, source_seq, target_seq_in,
+                                       target_seq_out, en_initial_states, parallel_decoder)
+
+        variables = encoder.trainable_variables + decoder.trainable_variables
+        gradients = tape.gradient(loss, variables)
+        optimizer.apply_gradients(zip(gradients, variables))
+
+        return loss
+
+    state_spec = tf.TensorSpec([None, encoder.rnn_size], tf.float32)
+    return CountedFunction(
+        train_step, shape_policy,
+        [sequence_spec(), sequence_spec(), sequence_spec(), (state_spec, state_spec)],
+        jit_compile)
+
+
+train_step = make_train_step(encoder, decoder, optimizer)
 
 
 if not os.path.exists('checkpoints_luong/encoder'):
@@ -318,16 +666,30 @@ if encoder_checkpoint is not None and decoder_checkpoint is not None:
     encoder.load_weights(encoder_checkpoint)
     decoder.load_weights(decoder_checkpoint)
 
+memory_config = process_config()
+if memory_config is not None:
+    # Started by BENCHMARK_RECOMPUTE: a few training steps and exit
+    RECOMPUTE_GRAD = memory_config['recompute']
+    ids = train_ids[:memory_config['batch_size']]
+    measure_train_step(train_step, (tf.constant(data_en[ids]), tf.constant(data_fr_in[ids]),
+                                    tf.constant(data_fr_out[ids]), encoder.init_states(len(ids))))
+    sys.exit(0)
+
 if MODE == 'train':
+    step_timer = StepTimer(100, enabled=REPORT_STALLS)
     for e in range(NUM_EPOCHS):
         en_initial_states = encoder.init_states(BATCH_SIZE)
         encoder.save_weights(
             'checkpoints_luong/encoder/encoder_{}.h5'.format(e + 1))
         decoder.save_weights(
             'checkpoints_luong/decoder/decoder_{}.h5'.format(e + 1))
-        for batch, (source_seq, target_seq_in, target_seq_out) in enumerate(dataset.take(-1)):
-            loss = train_step(source_seq, target_seq_in,
-                              target_seq_out, en_initial_states)
+        for batch, (source_seq, target_seq_in, target_seq_out) in enumerate(
+                step_timer.iterate(dataset.take(-1))):
+            with step_timer.computing():
+                loss = train_step(source_seq, target_seq_in,
+                                  target_seq_out, en_initial_states)
+            step_timer.end_step(
+                np.count_nonzero(source_seq) + np.count_nonzero(target_seq_out))
 
             if batch % 100 == 0:
                 print('Epoch {} Batch {} Loss {:.4f}'.format(
@@ -340,6 +702,214 @@ if MODE == 'train':
         except Exception:
             continue
 
+    step_timer.report()
+    print('train_step traced {} times'.format(train_step.num_traces))
+
+
+if EVALUATE:
+    evaluate_translation(
+        translate_tokens,
+        en_tokenizer.texts_to_sequences([raw_data_en[i] for i in held_out_ids]),
+        [raw_data_fr_out[i].split()[:-1] for i in held_out_ids],
+        EVAL_BATCH_SIZE)
+
+if BENCHMARK_RECOMPUTE:
+    # Batches of the longest (padded) length
+    compare_memory(__file__, [{'batch_size': batch_size, 'recompute': recompute}
+                              for batch_size in BENCHMARK_RECOMPUTE_BATCH_SIZES
+                              for recompute in [False, True]])
+
+
+def new_models():
+    """
+    New encoder and decoder for the benchmarks, built before tracing
+    """
+    new_encoder = Encoder(en_vocab_size, EMBEDDING_SIZE, RNN_SIZE)
+    new_decoder = Decoder(fr_vocab_size, EMBEDDING_SIZE, RNN_SIZE, ATTENTION_FUNC)
+    new_outputs = new_encoder(tf.constant([[1]]), new_encoder.init_states(1))
+    new_decoder(tf.constant([[1]]), new_outputs[1:], new_outputs[0])
+    return new_encoder, new_decoder
+
+
+if BENCHMARK_SHAPE_POLICY:
+    def make_benchmark_step(shape_policy, jit_compile):
+        return make_train_step(*new_models(), tf.keras.optimizers.Adam(clipnorm=5.0),
+                               shape_policy=shape_policy, jit_compile=jit_compile)
+
+    en_initial_states = encoder.init_states(BATCH_SIZE)
+    compare_shape_policies(
+        make_benchmark_step,
+        lambda shape_policy: (batch + (en_initial_states,)
+                              for batch in make_batches(shape_policy).repeat()),
+        BENCHMARK_SHAPE_POLICY_STEPS)
+
+if BENCHMARK_PARALLEL_DECODER:
+    en_initial_states = encoder.init_states(BATCH_SIZE)
+    source_seq, target_seq_in, target_seq_out = next(iter(dataset))
+    loop_loss, parallel_loss = [
+        teacher_forced_loss(encoder, decoder, source_seq, target_seq_in, target_seq_out,
+                            en_initial_states, parallel_decoder).numpy()
+        for parallel_decoder in [False, True]]
+    print('Loss: loop {:.6f}, parallel {:.6f}, difference {:.2e}'.format(
+        loop_loss, parallel_loss, abs(loop_loss - parallel_loss)))
+
+    print('{:>10} {:>12} {:>10}'.format('decoder', 'tracing (s)', 'step (ms)'))
+    step_times = []
+    for parallel_decoder in [False, True]:
+        _, trace_time, step_time = benchmark_step(
+            make_train_step(*new_models(), tf.keras.optimizers.Adam(clipnorm=5.0),
+                            parallel_decoder=parallel_decoder),
+            (batch + (en_initial_states,) for batch in dataset.repeat()),
+            BENCHMARK_PARALLEL_DECODER_STEPS)
+        step_times.append(step_time)
+        print('{:>10} {:>12.2f} {:>10.2f}'.format(
+            'parallel' if parallel_decoder else 'loop', trace_time, 1000 * step_time))
+    print('Speed-up: {:.2f}'.format(step_times[0] / step_times[1]))
+
+
+def benchmark_attention_keys(num_words=BENCHMARK_ATTENTION_KEYS_WORDS):
+    """
+    Per-word latency of decoding one sentence of the longest source length with new decoders:
+    the encoder projections recomputed at every step (the concat score runs Wa over
+    concat(decoder_output, encoder_output)), or computed once per sentence (split Wa)
+    """
+    encoder_output = tf.random.normal([1, data_en.shape[1], RNN_SIZE])
+    start = tf.constant([[fr_tokenizer.word_index['<start>']]])
+    zeros = tf.zeros([1, RNN_SIZE])
+
+    print('{:>8} {:>20} {:>20} {:>10}'.format(
+        'score', 'per step (ms/word)', 'cached (ms/word)', 'speed-up'))
+    for attention_func in ['dot', 'general', 'concat']:
+        benchmark_decoder = Decoder(fr_vocab_size, EMBEDDING_SIZE, RNN_SIZE, attention_func)
+        benchmark_decoder(start, (zeros, zeros), encoder_output)
+
+        latencies = []
+        for cached in [False, True]:
+            # Read when tracing decode_word
+            benchmark_decoder.attention.split = cached
+
+            @tf.function
+            def decode_word(de_input, state_h, state_c, keys):
+                logits, state_h, state_c, _ = benchmark_decoder(
+                    de_input, (state_h, state_c), encoder_output, keys=keys)
+                return tf.argmax(logits, -1, output_type=tf.int32)[:, tf.newaxis], state_h, state_c
+
+            def precompute_keys():
+                return benchmark_decoder.attention.precompute_keys(encoder_output) if cached else None
+
+            # Warm up, the first call traces decode_word
+            decode_word(start, zeros, zeros, precompute_keys())
+            begin = time.time()
+            keys = precompute_keys()
+            de_input, state_h, state_c = start, zeros, zeros
+            for _ in range(num_words):
+                de_input, state_h, state_c = decode_word(de_input, state_h, state_c, keys)
+            de_input.numpy()
+            latencies.append((time.time() - begin) / num_words)
+
+        print('{:>8} {:>20.3f} {:>20.3f} {:>10.2f}'.format(
+            attention_func, 1000 * latencies[0], 1000 * latencies[1], latencies[0] / latencies[1]))
+
+
+if BENCHMARK_ATTENTION_KEYS:
+    benchmark_attention_keys()
+
+
+if BENCHMARK_COMPILED_DECODE:
+    benchmark_seqs = en_tokenizer.texts_to_sequences(
+        [raw_data_en[i] for i in held_out_ids[:BENCHMARK_COMPILED_DECODE_SIZE]])
+
+    def eager_words(source_seqs):
+        return [eager_decode(seq)[0] for seq in source_seqs]
+
+    def compiled_words(source_seqs):
+        return [words for words, _ in compiled_decode_words(source_seqs)]
+
+    reference = None
+    print('{:>10} {:>7} {:>14} {:>10}'.format('decoding', 'batch', 'ms/sentence', 'agreement'))
+    for name, decode_words, batch_size in [('eager', eager_words, 1),
+                                           ('compiled', compiled_words, 1),
+                                           ('compiled', compiled_words, EVAL_BATCH_SIZE)]:
+        # Warm up, compiled_decode is traced once for all the batch shapes
+        decode_words(benchmark_seqs[:batch_size])
+        start = time.time()
+        translations = []
+        for i in range(0, len(benchmark_seqs), batch_size):
+            translations += decode_words(benchmark_seqs[i:i + batch_size])
+        latency = (time.time() - start) / len(benchmark_seqs)
+
+        # Padding the batches may change a few translations (numerical differences)
+        if reference is None:
+            reference = translations
+        agreement = np.mean([t == r for t, r in zip(translations, reference)])
+        print('{:>10} {:>7} {:>14.2f} {:>9.1f}%'.format(
+            name, batch_size, 1000 * latency, 100 * agreement))
+
+
+def greedy_translate(encode, decode_step, source_seq):
+    """
+    Greedy translation of one source sequence (at most decode_length words),
+    encode and decode_step are either the tf.functions below or their TFLite conversions
+    """
+    end_id = fr_tokenizer.word_index['<end>']
+    max_words = int(decode_length(len(source_seq)))
+    en_output, de_state_h, de_state_c = encode(
+        np.array([source_seq], dtype=np.int32))[:3]
+    de_input = np.array([[fr_tokenizer.word_index['<start>']]], dtype=np.int32)
+    out_ids = []
+
+    while True:
+        logits, de_state_h, de_state_c = decode_step(
+            de_input, de_state_h, de_state_c, en_output)
+        out_ids.append(int(np.argmax(logits)))
+        if out_ids[-1] == end_id or len(out_ids) >= max_words:
+            break
+        de_input = np.array([[out_ids[-1]]], dtype=np.int32)
+
+    return out_ids
+
+
+if QUANTIZE:
+    @tf.function(input_signature=[tf.TensorSpec([1, None], tf.int32)])
+    def encode(source_seq):
+        return encoder(source_seq, encoder.init_states(1))
+
+    @tf.function(input_signature=[
+        tf.TensorSpec([1, 1], tf.int32),
+        tf.TensorSpec([1, RNN_SIZE], tf.float32),
+        tf.TensorSpec([1, RNN_SIZE], tf.float32),
+        tf.TensorSpec([1, None, RNN_SIZE], tf.float32)])
+    def decode_step(de_input, state_h, state_c, encoder_output):
+        logits, state_h, state_c, _ = decoder(
+            de_input, (state_h, state_c), encoder_output)
+        return logits, state_h, state_c
+
+    sentence_ids = np.random.RandomState(0).permutation(len(raw_data_en))
+    calibration_seqs = en_tokenizer.texts_to_sequences(
+        [raw_data_en[i] for i in sentence_ids[:CALIBRATION_SIZE]])
+    eval_seqs = en_tokenizer.texts_to_sequences(
+        [raw_data_en[i] for i in sentence_ids[
+            CALIBRATION_SIZE:CALIBRATION_SIZE + QUANTIZATION_EVAL_SIZE]])
+
+    # Inputs seen by the float model while translating the calibration sentences
+    encode_recorder = InputRecorder(encode)
+    decode_recorder = InputRecorder(decode_step)
+    for source_seq in calibration_seqs:
+        greedy_translate(encode_recorder, decode_recorder, source_seq)
+
+    translate_fns = []
+    model_sizes = []
+    for mode in QUANTIZATION_MODES:
+        encode_model = TFLiteModel(convert_to_tflite(
+            encode.get_concrete_function(), mode, encode_recorder.inputs))
+        decode_model = TFLiteModel(convert_to_tflite(
+            decode_step.get_concrete_function(), mode, decode_recorder.inputs))
+        translate_fns.append(
+            (mode, lambda seq, e=encode_model, d=decode_model: greedy_translate(e, d, seq)))
+        model_sizes.append(encode_model.size + decode_model.size)
+
+    compare_models(translate_fns, model_sizes, eval_seqs)
+
 
 if not os.path.exists('heatmap'):
     os.makedirs('heatmap')
@@ -372,7 +942,7 @@ filenames = []
 for i, test_sent in enumerate(test_sents):
     test_sequence = normalize_string(test_sent)
     alignments, source, prediction = predict(test_sequence)
-    attention = np.squeeze(alignments, (1, 2))
+    attention = alignments
     fig = plt.figure(figsize=(10, 10))
     ax = fig.add_subplot(1, 1, 1)
     ax.matshow(attention, cmap='jet')
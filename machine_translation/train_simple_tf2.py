@@ -2,6 +2,13 @@ import tensorflow as tf
 import numpy as np
 import unicodedata
 import re
+import os
+import sys
+
+# common/ holds the modules shared by all the projects
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.step_timer import StepTimer
+from shape_policy import CountedFunction, sequence_spec, trim_batch, compare_shape_policies
 
 raw_data = (
     ('What a ridiculous concept!', 'Quel concept ridicule !'),
@@ -65,9 +72,28 @@ data_fr_out = tf.keras.preprocessing.sequence.pad_sequences(data_fr_out,
                                                             padding='post')
 
 BATCH_SIZE = 5
-dataset = tf.data.Dataset.from_tensor_slices(
-    (data_en, data_fr_in, data_fr_out))
-dataset = dataset.shuffle(20).batch(BATCH_SIZE)
+# Shapes of the training batches (see shape_policy.py): 'static' pads every batch
+# to the longest sentence, 'dynamic' trims every batch to its longest sentence
+# 'static' is the default: the training LSTMs are not masked, so 'dynamic' changes how much
+# padding they read (not only the speed), the transformer masks padding and defaults to 'dynamic'
+SHAPE_POLICY = 'static'
+# Compile train_step with XLA
+JIT_COMPILE = False
+# Compare traces and steady-state step time of both shape policies, with and without XLA
+BENCHMARK_SHAPE_POLICY = False
+BENCHMARK_SHAPE_POLICY_STEPS = 100
+
+
+def make_batches(shape_policy):
+    batches = tf.data.Dataset.from_tensor_slices(
+        (data_en, data_fr_in, data_fr_out))
+    batches = batches.shuffle(20).batch(BATCH_SIZE, drop_remainder=True)
+    if shape_policy == 'dynamic':
+        batches = batches.map(trim_batch)
+    return batches
+
+
+dataset = make_batches(SHAPE_POLICY)
 
 
 class Encoder(tf.keras.Model):
@@ -163,38 +189,75 @@ def predict(test_source_text=None):
     print(' '.join(out_words))
 
 
-@tf.function
-def train_step(source_seq, target_seq_in, target_seq_out, en_initial_states):
-    loss = 0
-    with tf.GradientTape() as tape:
-        en_outputs = encoder(source_seq, en_initial_states)
-        en_states = en_outputs[1:]
-        de_states = en_states
+def make_train_step(encoder, decoder, optimizer,
+                    shape_policy=SHAPE_POLICY, jit_compile=JIT_COMPILE):
+    def train_step(source_seq, target_seq_in, target_seq_out, en_initial_states):
+        loss = 0
+        with tf.GradientTape() as tape:
+            en_outputs = encoder(source_seq, en_initial_states)
+            en_states = en_outputs[1:]
+            de_states = en_states
 
-        de_outputs = decoder(target_seq_in, de_states)
-        logits = de_outputs[0]
-        loss = loss_func(target_seq_out, logits)
+            de_outputs = decoder(target_seq_in, de_states)
+            logits = de_outputs[0]
+            loss = loss_func(target_seq_out, logits)
 
-    variables = encoder.trainable_variables + decoder.trainable_variables
-    gradients = tape.gradient(loss, variables)
-    optimizer.apply_gradients(zip(gradients, variables))
+        variables = encoder.trainable_variables + decoder.trainable_variables
+        gradients = tape.gradient(loss, variables)
+        optimizer.apply_gradients(zip(gradients, variables))
 
-    return loss
+        return loss
+
+    state_spec = tf.TensorSpec([None, encoder.lstm_size], tf.float32)
+    return CountedFunction(
+        train_step, shape_policy,
+        [sequence_spec(), sequence_spec(), sequence_spec(), (state_spec, state_spec)],
+        jit_compile)
+
+
+train_step = make_train_step(encoder, decoder, optimizer)
 
 
 NUM_EPOCHS = 300
+# Report how long each step waits for data vs. computes
+REPORT_STALLS = False
 
+step_timer = StepTimer(100, enabled=REPORT_STALLS)
 for e in range(NUM_EPOCHS):
     en_initial_states = encoder.init_states(BATCH_SIZE)
     
     predict()
 
-    for batch, (source_seq, target_seq_in, target_seq_out) in enumerate(dataset.take(-1)):
-        loss = train_step(source_seq, target_seq_in,
-                          target_seq_out, en_initial_states)
+    for batch, (source_seq, target_seq_in, target_seq_out) in enumerate(
+            step_timer.iterate(dataset.take(-1))):
+        with step_timer.computing():
+            loss = train_step(source_seq, target_seq_in,
+                              target_seq_out, en_initial_states)
+        step_timer.end_step(
+            np.count_nonzero(source_seq) + np.count_nonzero(target_seq_out))
 
     print('Epoch {} Loss {:.4f}'.format(e + 1, loss.numpy()))
 
+step_timer.report()
+print('train_step traced {} times'.format(train_step.num_traces))
+
+if BENCHMARK_SHAPE_POLICY:
+    def make_benchmark_step(shape_policy, jit_compile):
+        # New models, built before tracing
+        new_encoder = Encoder(en_vocab_size, EMBEDDING_SIZE, LSTM_SIZE)
+        new_decoder = Decoder(fr_vocab_size, EMBEDDING_SIZE, LSTM_SIZE)
+        new_decoder(tf.constant([[1]]),
+                    new_encoder(tf.constant([[1]]), new_encoder.init_states(1))[1:])
+        return make_train_step(new_encoder, new_decoder, tf.keras.optimizers.Adam(),
+                               shape_policy, jit_compile)
+
+    en_initial_states = encoder.init_states(BATCH_SIZE)
+    compare_shape_policies(
+        make_benchmark_step,
+        lambda shape_policy: (batch + (en_initial_states,)
+                              for batch in make_batches(shape_policy).repeat()),
+        BENCHMARK_SHAPE_POLICY_STEPS)
+
 test_sents = (
     'What a ridiculous concept!',
     'Your idea is not entirely crazy.',
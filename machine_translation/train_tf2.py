@@ -6,10 +6,17 @@ import unicodedata
 import re
 import matplotlib.pyplot as plt
 import os
+import sys
 import imageio
 from zipfile import ZipFile
 import requests
 
+# common/ holds the modules shared by all the projects
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.step_timer import StepTimer
+from evaluation import held_out_split, evaluate_translation
+from shape_policy import CountedFunction, sequence_spec, trim_batch, compare_shape_policies
+
 # Mode can be either 'train' or 'infer'
 # Set to 'infer' will skip the training
 MODE = 'train'
@@ -19,6 +26,27 @@ BATCH_SIZE = 64
 EMBEDDING_SIZE = 256
 LSTM_SIZE = 512
 NUM_EPOCHS = 15
+# Report how long each step waits for data vs. computes
+REPORT_STALLS = False
+# HELD_OUT_SIZE sentence pairs are left out of training,
+# set EVALUATE to compute the BLEU and chrF of their greedy translations (see evaluation.py)
+EVALUATE = False
+HELD_OUT_SIZE = 1000
+EVAL_BATCH_SIZE = 64
+# translate_batch stops a translation at <end> or after
+# DECODE_LENGTH_RATIO * source length + DECODE_LENGTH_OFFSET words
+DECODE_LENGTH_RATIO = 2.
+DECODE_LENGTH_OFFSET = 3
+# Shapes of the training batches (see shape_policy.py): 'static' pads every batch
+# to the longest sentence of the corpus, 'dynamic' trims every batch to its longest sentence.
+# 'static' is the default: the training LSTMs are not masked, so 'dynamic' changes how much
+# padding they read (not only the speed), the transformer masks padding and defaults to 'dynamic'
+SHAPE_POLICY = 'static'
+# Compile train_step with XLA
+JIT_COMPILE = False
+# Compare traces and steady-state step time of both shape policies, with and without XLA
+BENCHMARK_SHAPE_POLICY = False
+BENCHMARK_SHAPE_POLICY_STEPS = 100
 
 
 def maybe_download_and_read_file(url, filename):
@@ -93,10 +121,20 @@ data_fr_out = tf.keras.preprocessing.sequence.pad_sequences(data_fr_out,
                                                             padding='post')
 print(data_fr_out[:2])
 
-dataset = tf.data.Dataset.from_tensor_slices(
-    (data_en, data_fr_in, data_fr_out))
-dataset = dataset.shuffle(len(raw_data_en)).batch(
-    BATCH_SIZE, drop_remainder=True)
+train_ids, held_out_ids = held_out_split(len(data_en), HELD_OUT_SIZE)
+
+
+def make_batches(shape_policy):
+    batches = tf.data.Dataset.from_tensor_slices(
+        (data_en[train_ids], data_fr_in[train_ids], data_fr_out[train_ids]))
+    batches = batches.shuffle(len(train_ids)).batch(
+        BATCH_SIZE, drop_remainder=True)
+    if shape_policy == 'dynamic':
+        batches = batches.map(trim_batch)
+    return batches
+
+
+dataset = make_batches(SHAPE_POLICY)
 
 
 class Encoder(tf.keras.Model):
@@ -107,9 +145,12 @@ class Encoder(tf.keras.Model):
         self.lstm = tf.keras.layers.LSTM(
             lstm_size, return_sequences=True, return_state=True)
 
-    def call(self, sequence, states):
+    def call(self, sequence, states, mask=None):
+        # mask (batch_size, max_len) is False on padding,
+        # the final states are then those of the last words
         embed = self.embedding(sequence)
-        output, state_h, state_c = self.lstm(embed, initial_state=states)
+        output, state_h, state_c = self.lstm(
+            embed, initial_state=states, mask=mask)
 
         return output, state_h, state_c
 
@@ -167,22 +208,32 @@ def loss_func(targets, logits):
 optimizer = tf.keras.optimizers.Adam(clipnorm=5.0)
 
 
-@tf.function
-def train_step(source_seq, target_seq_in, target_seq_out, en_initial_states):
-    with tf.GradientTape() as tape:
-        en_outputs = encoder(source_seq, en_initial_states)
-        en_states = en_outputs[1:]
-        de_states = en_states
+def make_train_step(encoder, decoder, optimizer,
+                    shape_policy=SHAPE_POLICY, jit_compile=JIT_COMPILE):
+    def train_step(source_seq, target_seq_in, target_seq_out, en_initial_states):
+        with tf.GradientTape() as tape:
+            en_outputs = encoder(source_seq, en_initial_states)
+            en_states = en_outputs[1:]
+            de_states = en_states
 
-        de_outputs = decoder(target_seq_in, de_states)
-        logits = de_outputs[0]
-        loss = loss_func(target_seq_out, logits)
+            de_outputs = decoder(target_seq_in, de_states)
+            logits = de_outputs[0]
+            loss = loss_func(target_seq_out, logits)
 
-    variables = encoder.trainable_variables + decoder.trainable_variables
-    gradients = tape.gradient(loss, variables)
-    optimizer.apply_gradients(zip(gradients, variables))
+        variables = encoder.trainable_variables + decoder.trainable_variables
+        gradients = tape.gradient(loss, variables)
+        optimizer.apply_gradients(zip(gradients, variables))
 
-    return loss
+        return loss
+
+    state_spec = tf.TensorSpec([None, encoder.lstm_size], tf.float32)
+    return CountedFunction(
+        train_step, shape_policy,
+        [sequence_spec(), sequence_spec(), sequence_spec(), (state_spec, state_spec)],
+        jit_compile)
+
+
+train_step = make_train_step(encoder, decoder, optimizer)
 
 
 def predict(test_source_text=None):
@@ -192,23 +243,82 @@ def predict(test_source_text=None):
     test_source_seq = en_tokenizer.texts_to_sequences([test_source_text])
     print(test_source_seq)
 
-    en_initial_states = encoder.init_states(1)
-    en_outputs = encoder(tf.constant(test_source_seq), en_initial_states)
+    # Greedy decoding of at most decode_length words
+    print(' '.join(translate_tokens(test_source_seq)[0]))
 
-    de_input = tf.constant([[fr_tokenizer.word_index['<start>']]])
-    de_state_h, de_state_c = en_outputs[1:]
-    out_words = []
 
-    while True:
-        de_output, de_state_h, de_state_c = decoder(
-            de_input, (de_state_h, de_state_c))
-        de_input = tf.argmax(de_output, -1)
-        out_words.append(fr_tokenizer.index_word[de_input.numpy()[0][0]])
+def greedy_decode(source_seq, max_steps):
+    """
+    Greedy decoding of a batch of padded source sequences,
+    stops when every sentence has produced <end> or its max_steps words
+    (max_steps is either one number for the batch or one per sentence)
+    Returns the ids of the words, padded with 0 after <end>
+    """
+    end_id = fr_tokenizer.word_index['<end>']
+    max_steps = np.broadcast_to(max_steps, len(source_seq))
+    encoder_mask = tf.constant(source_seq != 0)
+    en_outputs = encoder(tf.constant(source_seq), encoder.init_states(len(source_seq)),
+                         mask=encoder_mask)
 
-        if out_words[-1] == '<end>' or len(out_words) >= 20:
+    de_input = np.full((len(source_seq), 1), fr_tokenizer.word_index['<start>'])
+    de_state_h, de_state_c = en_outputs[1:]
+    finished = np.zeros(len(source_seq), dtype=bool)
+    out_ids = []
+    for step in range(max_steps.max()):
+        de_output, de_state_h, de_state_c = decoder(
+            tf.constant(de_input), (de_state_h, de_state_c))
+        new_word = tf.argmax(de_output, -1).numpy()[:, 0]
+        new_word[finished] = 0
+        finished |= new_word == end_id
+        finished |= step + 1 >= max_steps
+        out_ids.append(new_word)
+        de_input = new_word[:, np.newaxis]
+        if finished.all():
             break
 
-    print(' '.join(out_words))
+    return np.stack(out_ids, axis=1)
+
+
+def decode_length(source_lengths):
+    """
+    Maximum number of words of the translation of each source sentence
+    """
+    return (np.round(DECODE_LENGTH_RATIO * np.asarray(source_lengths)).astype(np.int32)
+            + DECODE_LENGTH_OFFSET)
+
+
+def translate_tokens(source_seqs):
+    """
+    Greedy translations of a batch of source sequences (lists of ids), as lists of words
+    """
+    source_seq = tf.keras.preprocessing.sequence.pad_sequences(
+        source_seqs, padding='post')
+    output = greedy_decode(source_seq, decode_length([len(seq) for seq in source_seqs]))
+    end_id = fr_tokenizer.word_index['<end>']
+    translations = []
+    for words in output.tolist():
+        if end_id in words:
+            words = words[:words.index(end_id)]
+        # Sentences stopped by their length limit are padded with 0
+        translations.append([fr_tokenizer.index_word[i] for i in words if i != 0])
+    return translations
+
+
+def translate_batch(sentences):
+    """
+    Greedy translations of English sentences, BATCH_SIZE at a time:
+    sentences of similar lengths are padded and decoded together
+    Returns the translations in the order of sentences
+    """
+    source_seqs = en_tokenizer.texts_to_sequences(
+        [normalize_string(sentence) for sentence in sentences])
+    order = np.argsort([len(seq) for seq in source_seqs], kind='stable')
+    translations = [None] * len(sentences)
+    for start in range(0, len(order), BATCH_SIZE):
+        ids = order[start:start + BATCH_SIZE]
+        for i, words in zip(ids, translate_tokens([source_seqs[i] for i in ids])):
+            translations[i] = ' '.join(words)
+    return translations
 
 
 if not os.path.exists('checkpoints/encoder'):
@@ -226,13 +336,18 @@ if encoder_checkpoint is not None and decoder_checkpoint is not None:
     decoder.load_weights(decoder_checkpoint)
     
 if MODE == 'train':
+    step_timer = StepTimer(100, enabled=REPORT_STALLS)
     for e in range(NUM_EPOCHS):
         en_initial_states = encoder.init_states(BATCH_SIZE)
         encoder.save_weights('checkpoints/encoder/encoder_{}.h5'.format(e + 1))
         decoder.save_weights('checkpoints/decoder/decoder_{}.h5'.format(e + 1))
 
-        for batch, (source_seq, target_seq_in, target_seq_out) in enumerate(dataset.take(-1)):
-            loss = train_step(source_seq, target_seq_in, target_seq_out, en_initial_states)
+        for batch, (source_seq, target_seq_in, target_seq_out) in enumerate(
+                step_timer.iterate(dataset.take(-1))):
+            with step_timer.computing():
+                loss = train_step(source_seq, target_seq_in, target_seq_out, en_initial_states)
+            step_timer.end_step(
+                np.count_nonzero(source_seq) + np.count_nonzero(target_seq_out))
 
             if batch % 100 == 0:
                 print('Epoch {} Batch {} Loss {:.4f}'.format(e + 1, batch, loss.numpy()))
@@ -244,6 +359,33 @@ if MODE == 'train':
         except Exception:
             continue
 
+    step_timer.report()
+    print('train_step traced {} times'.format(train_step.num_traces))
+
+if EVALUATE:
+    evaluate_translation(
+        translate_tokens,
+        en_tokenizer.texts_to_sequences([raw_data_en[i] for i in held_out_ids]),
+        [raw_data_fr_out[i].split()[:-1] for i in held_out_ids],
+        EVAL_BATCH_SIZE)
+
+if BENCHMARK_SHAPE_POLICY:
+    def make_benchmark_step(shape_policy, jit_compile):
+        # New models, built before tracing
+        new_encoder = Encoder(en_vocab_size, EMBEDDING_SIZE, LSTM_SIZE)
+        new_decoder = Decoder(fr_vocab_size, EMBEDDING_SIZE, LSTM_SIZE)
+        new_decoder(tf.constant([[1]]),
+                    new_encoder(tf.constant([[1]]), new_encoder.init_states(1))[1:])
+        return make_train_step(new_encoder, new_decoder, tf.keras.optimizers.Adam(clipnorm=5.0),
+                               shape_policy, jit_compile)
+
+    en_initial_states = encoder.init_states(BATCH_SIZE)
+    compare_shape_policies(
+        make_benchmark_step,
+        lambda shape_policy: (batch + (en_initial_states,)
+                              for batch in make_batches(shape_policy).repeat()),
+        BENCHMARK_SHAPE_POLICY_STEPS)
+
 test_sents = (
     'What a ridiculous concept!',
     'Your idea is not entirely crazy.',
@@ -267,6 +409,6 @@ test_sents = (
     "I can't believe you're giving up.",
 )
 
-for test_sent in test_sents:
-    test_sequence = normalize_string(test_sent)
-    predict(test_sequence)
+for test_sent, translation in zip(test_sents, translate_batch(test_sents)):
+    print(test_sent)
+    print(translation)
@@ -3,17 +3,149 @@ import numpy as np
 import unicodedata
 import re
 import os
+import sys
+import json
+import subprocess
+import shutil
+import tempfile
 import requests
 from zipfile import ZipFile
 import time
 
+# common/ holds the modules shared by all the projects
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.step_timer import StepTimer
+from evaluation import held_out_split, corpus_scores, evaluate_translation
+from quantization import QUANTIZATION_MODES, convert_to_tflite, TFLiteModel, InputRecorder, compare_models
+from memory_benchmark import process_config, measure_train_step, compare_memory
+from shape_policy import CountedFunction, sequence_spec, trim_batch, compare_shape_policies
 
-# Mode can be either 'train' or 'infer'
+
+# Mode can be either 'train', 'infer', 'distill' or 'multi_worker'
 # Set to 'infer' will skip the training
+# Set to 'distill' will translate the training data with the trained model (the teacher)
+# and train a smaller student on these translations
+# Set to 'multi_worker' will start local worker processes training with
+# MultiWorkerMirroredStrategy (see launch_workers)
 MODE = 'train'
 URL = 'http://www.manythings.org/anki/fra-eng.zip'
 FILENAME = 'fra-eng.zip'
 NUM_EPOCHS = 15
+# Report how long each step waits for data vs. computes
+REPORT_STALLS = False
+# Batch sentence pairs of similar lengths (buckets of BUCKET_WIDTH lengths) up to MAX_TOKENS
+# source or target tokens per batch (padding included) instead of BATCH_SIZE pairs,
+# every batch is trimmed to its longest sentence instead of the longest of the corpus
+TOKEN_BATCHING = False
+MAX_TOKENS = 2048
+BUCKET_WIDTH = 4
+# Compare step time and useful (non-padding) tokens/s of fixed-size and token-budget batches
+BENCHMARK_BATCHING = False
+BENCHMARK_BATCHING_STEPS = 200
+# Shapes of the training batches (see shape_policy.py): 'static' keeps full batches padded
+# to the longest sentence of the corpus (token batches: to the longest length of their bucket),
+# 'dynamic' trims every batch to its longest sentence and traces train_step once
+# 'dynamic' is the default: padding is masked, so trimming it only saves time
+# ('static' suits JIT_COMPILE, XLA compiles once per shape)
+SHAPE_POLICY = 'dynamic'
+# Compile train_step with XLA
+JIT_COMPILE = False
+# Compare traces and steady-state step time of both shape policies, with and without XLA
+BENCHMARK_SHAPE_POLICY = False
+BENCHMARK_SHAPE_POLICY_STEPS = 200
+CHECKPOINT_DIR = 'checkpoints_transformer'
+# Student of the distillation, trained for STUDENT_NUM_EPOCHS
+STUDENT_NUM_LAYERS = 2
+STUDENT_H = 4
+STUDENT_NUM_EPOCHS = 15
+# Teacher translations of the training split are cached here,
+# so they are computed only once per teacher checkpoint and split
+DISTILL_CACHE = 'distill_targets.npz'
+DISTILL_BATCH_SIZE = 256
+# Export the trained encoder and decoder to TFLite (float, dynamic range and int8)
+# and compare latency, size and greedy translations on held-out sentences,
+# int8 activation ranges are calibrated on CALIBRATION_SIZE sentences of raw_data_en
+QUANTIZE = False
+CALIBRATION_SIZE = 100
+QUANTIZATION_EVAL_SIZE = 200
+# Multi-worker training: SCALING_STEPS steps are timed with 1 to NUM_WORKERS workers,
+# then NUM_WORKERS workers train for NUM_EPOCHS.
+# Every worker reads its own shard of the dataset in batches of BATCH_SIZE,
+# so the global batch grows with the number of workers
+NUM_WORKERS = 4
+SCALING_STEPS = 100
+MULTI_WORKER_WARMUP_STEPS = 10
+MULTI_WORKER_PORT = 23456
+# HELD_OUT_SIZE sentence pairs are left out of training,
+# set EVALUATE to compute the BLEU and chrF of their greedy translations (see evaluation.py)
+EVALUATE = False
+HELD_OUT_SIZE = 1000
+EVAL_BATCH_SIZE = 64
+# translate_batch stops a translation at <end> or after
+# DECODE_LENGTH_RATIO * source length + DECODE_LENGTH_OFFSET words
+DECODE_LENGTH_RATIO = 2.
+DECODE_LENGTH_OFFSET = 3
+# Decode with the keys and values of the previous words cached (Decoder.call_step),
+# instead of running the decoder over the whole prefix again at every step
+CACHED_DECODING = True
+# Compare the per-word latency of both decodings on BENCHMARK_DECODING_SIZE held-out sentences
+BENCHMARK_DECODING = False
+BENCHMARK_DECODING_SIZE = 100
+# Time the masking of look-left self-attention scores, former way (band_part mask built
+# at every call, multiply then replace zeros) vs cached additive bias, and a whole
+# MultiHeadAttention layer, at every length of BENCHMARK_ATTENTION_LENGTHS
+BENCHMARK_ATTENTION = False
+BENCHMARK_ATTENTION_LENGTHS = [16, 64, 256, 512]
+# Project the queries, keys and values of self-attention with one matmul,
+# and the keys and values of cross-attention with one matmul.
+# Checkpoints of the fused model are kept in CHECKPOINT_DIR + '_fused',
+# the first ones are converted from the latest checkpoint in CHECKPOINT_DIR
+FUSED_ATTENTION = False
+# Time separate and fused projections of one attention layer, for training and decoding
+BENCHMARK_FUSED_ATTENTION = False
+# Project the decoder output onto the vocabulary with the decoder embedding (transposed)
+# instead of a separate Dense(vocab_size)
+TIE_EMBEDDINGS = False
+# One vocabulary for both languages, the encoder and the decoder share their embedding
+SHARE_EMBEDDINGS = False
+# Compare parameters, memory, checkpoint size and step time of separate, tied and shared embeddings
+BENCHMARK_EMBEDDINGS = False
+# Recompute the activations of every encoder and decoder layer in the backward pass
+# (tf.recompute_grad) instead of keeping them from the forward pass:
+# the memory of the activations goes down to the inputs of the layers, for one more forward pass
+RECOMPUTE_GRAD = False
+# Compare peak memory and step time with and without RECOMPUTE_GRAD for these batch sizes,
+# every configuration runs in its own process (see memory_benchmark.py)
+BENCHMARK_RECOMPUTE = False
+BENCHMARK_RECOMPUTE_BATCH_SIZES = [64, 128, 256]
+# Local attention for long sequences: a word attends only to the words at most `window`
+# positions away (on its left in the decoder), in O(len * window) instead of O(len^2).
+# None for full attention everywhere, one window for all the layers,
+# or a list with one window (None for full attention) per layer, e.g. [64, 64, 64, None]
+ENCODER_ATTENTION_WINDOWS = None
+DECODER_ATTENTION_WINDOWS = None
+# Compare full and local attention layers on long random sequences
+BENCHMARK_LOCAL_ATTENTION = False
+BENCHMARK_LOCAL_ATTENTION_LENGTHS = [128, 512, 2048]
+BENCHMARK_LOCAL_ATTENTION_WINDOW = 64
+
+# Models with tied or shared embeddings have their own checkpoints
+if TIE_EMBEDDINGS:
+    CHECKPOINT_DIR = CHECKPOINT_DIR + '_tied'
+if SHARE_EMBEDDINGS:
+    CHECKPOINT_DIR = CHECKPOINT_DIR + '_shared'
+UNFUSED_CHECKPOINT_DIR = CHECKPOINT_DIR
+if FUSED_ATTENTION:
+    CHECKPOINT_DIR = CHECKPOINT_DIR + '_fused'
+
+# Processes started by launch_workers get the cluster from TF_CONFIG,
+# the strategy must be created before any other TF op
+IS_WORKER = MODE == 'multi_worker' and 'TF_CONFIG' in os.environ
+if IS_WORKER:
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    task_index = json.loads(os.environ['TF_CONFIG'])['task']['index']
+else:
+    strategy = tf.distribute.get_strategy()
 
 
 def maybe_download_and_read_file(url, filename):
@@ -73,13 +205,20 @@ raw_data_fr_out = [normalize_string(data) + ' <end>' for data in raw_data_fr]
 
 en_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters='')
 en_tokenizer.fit_on_texts(raw_data_en)
+if SHARE_EMBEDDINGS:
+    # Joint vocabulary
+    en_tokenizer.fit_on_texts(raw_data_fr_in)
+    en_tokenizer.fit_on_texts(raw_data_fr_out)
 data_en = en_tokenizer.texts_to_sequences(raw_data_en)
 data_en = tf.keras.preprocessing.sequence.pad_sequences(data_en,
                                                         padding='post')
 
-fr_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters='')
-fr_tokenizer.fit_on_texts(raw_data_fr_in)
-fr_tokenizer.fit_on_texts(raw_data_fr_out)
+if SHARE_EMBEDDINGS:
+    fr_tokenizer = en_tokenizer
+else:
+    fr_tokenizer = tf.keras.preprocessing.text.Tokenizer(filters='')
+    fr_tokenizer.fit_on_texts(raw_data_fr_in)
+    fr_tokenizer.fit_on_texts(raw_data_fr_out)
 data_fr_in = fr_tokenizer.texts_to_sequences(raw_data_fr_in)
 data_fr_in = tf.keras.preprocessing.sequence.pad_sequences(data_fr_in,
                                                            padding='post')
@@ -90,32 +229,120 @@ data_fr_out = tf.keras.preprocessing.sequence.pad_sequences(data_fr_out,
 
 """## Create tf.data.Dataset object"""
 
+
+def batch_by_tokens(dataset, max_tokens=MAX_TOKENS, bucket_width=BUCKET_WIDTH,
+                    shape_policy=SHAPE_POLICY):
+    """
+    Batch a dataset of padded (source, target_in, target_out) by length:
+    pairs go to buckets of bucket_width lengths (length of their longest sequence),
+    a batch of a bucket holds as many pairs as its longest length allows in max_tokens,
+    and is padded to its own longest source and target only,
+    or to the longest length of the bucket with the 'static' shape policy (full batches only)
+    """
+    padded_length = max(spec.shape[0] for spec in dataset.element_spec)
+    # Bucket i holds the lengths below boundaries[i], the bucket after the last boundary stays empty
+    boundaries = list(range(bucket_width + 1, padded_length + bucket_width + 1, bucket_width))
+    batch_sizes = [max(1, max_tokens // (boundary - 1)) for boundary in boundaries]
+    batch_sizes.append(batch_sizes[-1])
+
+    def remove_padding(*sequences):
+        return tuple(sequence[:tf.math.count_nonzero(sequence, dtype=tf.int32)]
+                     for sequence in sequences)
+
+    def length(*sequences):
+        return tf.reduce_max([tf.shape(sequence)[0] for sequence in sequences])
+
+    dataset = dataset.map(remove_padding, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    static = shape_policy == 'static'
+    return dataset.apply(tf.data.experimental.bucket_by_sequence_length(
+        length, boundaries, batch_sizes,
+        pad_to_bucket_boundary=static, drop_remainder=static))
+
+
+def make_batches(pairs, shape_policy=SHAPE_POLICY):
+    """
+    Batches of a shuffled dataset of padded (source, target_in, target_out),
+    by token budget with TOKEN_BATCHING, else BATCH_SIZE pairs at a time
+    """
+    if TOKEN_BATCHING:
+        return batch_by_tokens(pairs, shape_policy=shape_policy)
+    if shape_policy == 'static':
+        return pairs.batch(BATCH_SIZE, drop_remainder=True)
+    return pairs.batch(BATCH_SIZE).map(trim_batch)
+
+
 BATCH_SIZE = 64
+train_ids, held_out_ids = held_out_split(len(data_en), HELD_OUT_SIZE)
 dataset = tf.data.Dataset.from_tensor_slices(
-    (data_en, data_fr_in, data_fr_out))
-dataset = dataset.shuffle(len(data_en)).batch(BATCH_SIZE)
+    (data_en[train_ids], data_fr_in[train_ids], data_fr_out[train_ids]))
+dataset = make_batches(dataset.shuffle(len(train_ids)))
 
 """## Create the Positional Embedding"""
 
 
-def positional_embedding(pos, model_size):
-    PE = np.zeros((1, 1, model_size))
-    for i in range(model_size):
-        if i % 2 == 0:
-            PE[:, :, i] = np.sin(pos / 10000 ** (i / model_size))
-        else:
-            PE[:, :, i] = np.cos(pos / 10000 ** ((i - 1) / model_size))
-    return PE
+def positional_embedding(length, model_size):
+    """
+    Sinusoidal encodings of positions 0 to length - 1, (1, length, model_size)
+    """
+    pos = np.arange(length)[:, np.newaxis]
+    i = np.arange(model_size)[np.newaxis, :]
+    # Dimensions 2k and 2k + 1 share the frequency 1 / 10000 ** (2k / model_size)
+    angles = pos / 10000 ** ((i - i % 2) / model_size)
+    PE = np.where(i % 2 == 0, np.sin(angles), np.cos(angles))
+    return PE[np.newaxis].astype(np.float32)
+
+
+class PositionalEmbedding(object):
+    """
+    Table of positional encodings shared by the encoder and the decoder
+    The table is grown (at least doubled) whenever a longer sequence comes,
+    it lives in a variable so that already traced functions read the grown table
+    """
+
+    def __init__(self, model_size, length):
+        self.model_size = model_size
+        self.length = length
+        self.table = tf.Variable(
+            positional_embedding(length, model_size), trainable=False,
+            shape=tf.TensorShape([1, None, model_size]))
+
+    @property
+    def shape(self):
+        return (1, self.length, self.model_size)
+
+    def ensure(self, length):
+        """
+        Grow the table to cover at least `length` positions
+        """
+        if length > self.length:
+            self.length = max(length, 2 * self.length)
+            # Also runs eagerly when called while tracing a tf.function
+            with tf.init_scope():
+                self.table.assign(positional_embedding(self.length, self.model_size))
+
+    def __call__(self, sequence):
+        """
+        Encodings of the positions of sequence (batch, length), (1, length, model_size)
+        """
+        length = sequence.shape[1]
+        if length is None:
+            # Length only known when running, the table must have been grown beforehand
+            return self.table[:, :tf.shape(sequence)[1]]
+        self.ensure(length)
+        return self.table[:, :length]
+
+    def at(self, position):
+        """
+        Encoding of one position (a scalar tensor), (1, 1, model_size),
+        the table must have been grown beforehand
+        """
+        return tf.expand_dims(self.table[:, position], 1)
+
 
 max_length = max(len(data_en[0]), len(data_fr_in[0]))
 MODEL_SIZE = 256
 
-pes = []
-for i in range(max_length):
-    pes.append(positional_embedding(i, MODEL_SIZE))
-
-pes = np.concatenate(pes, axis=1)
-pes = tf.constant(pes, dtype=tf.float32)
+pes = PositionalEmbedding(MODEL_SIZE, max_length)
 
 
 print(pes.shape)
@@ -127,38 +354,85 @@ print(data_fr_in.shape)
 
 
 class MultiHeadAttention(tf.keras.Model):
-    def __init__(self, key_size, value_size, model_size, h):
+    def __init__(self, key_size, value_size, model_size, h, fused=None, window=None, causal=False):
+        # fused is None for separate wq, wk and wv,
+        # 'qkv' for self-attention: one wqkv projects the query, key and value at once,
+        # 'kv' for cross-attention: wq, and one wkv projects the key and value at once
+        # window: local self-attention, every word attends to the words at most window
+        # positions away, only on its left if causal (see attend_local)
         super(MultiHeadAttention, self).__init__()
         self.key_size = key_size
         self.h = h
+        self.fused = fused
+        self.window = window
+        self.causal = causal
 
-        self.wq = tf.keras.layers.Dense(model_size) #[tf.keras.layers.Dense(key_size) for _ in range(h)]
-        self.wk = tf.keras.layers.Dense(model_size) #[tf.keras.layers.Dense(key_size) for _ in range(h)]
-        self.wv = tf.keras.layers.Dense(model_size) #[tf.keras.layers.Dense(value_size) for _ in range(h)]
+        if fused == 'qkv':
+            self.wqkv = tf.keras.layers.Dense(3 * model_size)
+        else:
+            self.wq = tf.keras.layers.Dense(model_size) #[tf.keras.layers.Dense(key_size) for _ in range(h)]
+            if fused == 'kv':
+                self.wkv = tf.keras.layers.Dense(2 * model_size)
+            else:
+                self.wk = tf.keras.layers.Dense(model_size) #[tf.keras.layers.Dense(key_size) for _ in range(h)]
+                self.wv = tf.keras.layers.Dense(model_size) #[tf.keras.layers.Dense(value_size) for _ in range(h)]
         self.wo = tf.keras.layers.Dense(model_size)
 
-    def call(self, query, value, mask=None):
+    def split_heads(self, projection, num):
+        """
+        Split the output of a projection onto num * model_size units
+        into num tensors of shape (batch, h, len, key_size)
+        """
+        batch_size = tf.shape(projection)[0]
+        # Originally, projection has shape (batch, len, num * model_size)
+        # We need to reshape to (batch, len, num, h, key_size)
+        projection = tf.reshape(projection, [batch_size, -1, num, self.h, self.key_size])
+        # In order to compute matmul, the dimensions must be transposed to (num, batch, h, len, key_size)
+        projection = tf.transpose(projection, [2, 0, 3, 1, 4])
+        return tf.unstack(projection, num)
+
+    def project_key_value(self, value):
+        """
+        Keys and values of `value`, split into heads: (batch, h, value_len, key_size)
+        They can be passed to call() as key_value, to attend to the same values many times
+        """
+        if self.fused == 'qkv':
+            return self.split_heads(self.wqkv(value), 3)[1:]
+        if self.fused == 'kv':
+            return self.split_heads(self.wkv(value), 2)
+        return self.split_heads(self.wk(value), 1) + self.split_heads(self.wv(value), 1)
+
+    def project_self(self, sequence):
+        """
+        Queries, keys and values of sequence attending to itself, split into heads
+        """
+        if self.fused == 'qkv':
+            return self.split_heads(self.wqkv(sequence), 3)
+        return self.split_heads(self.wq(sequence), 1) + self.project_key_value(sequence)
+
+    def call(self, query, value, mask=None, key_value=None):
         # query has shape (batch, query_len, model_size)
-        # value has shape (batch, value_len, model_size)
-        query = self.wq(query)
-        key = self.wk(value)
-        value = self.wv(value)
-        
-        # Split matrices for multi-heads attention
-        batch_size = query.shape[0]
-        
-        # Originally, query has shape (batch, query_len, model_size)
-        # We need to reshape to (batch, query_len, h, key_size)
-        query = tf.reshape(query, [batch_size, -1, self.h, self.key_size])
-        # In order to compute matmul, the dimensions must be transposed to (batch, h, query_len, key_size)
-        query = tf.transpose(query, [0, 2, 1, 3])
-        
-        # Do the same for key and value
-        key = tf.reshape(key, [batch_size, -1, self.h, self.key_size])
-        key = tf.transpose(key, [0, 2, 1, 3])
-        value = tf.reshape(value, [batch_size, -1, self.h, self.key_size])
-        value = tf.transpose(value, [0, 2, 1, 3])
-        
+        # value has shape (batch, value_len, model_size), value is query for self-attention
+        # key_value, if given, is project_key_value(value) computed beforehand
+        # (value is then ignored)
+        if self.fused == 'qkv':
+            # Self-attention only
+            query, key, value = self.project_self(query)
+        else:
+            query = self.split_heads(self.wq(query), 1)[0]
+            if key_value is None:
+                key, value = self.project_key_value(value)
+            else:
+                key, value = key_value
+
+        if self.window is not None:
+            return self.attend_local(query, key, value, mask)
+        return self.attend(query, key, value, mask)
+
+    def attend(self, query, key, value, mask=None):
+        # query, key and value are split into heads: (batch, h, len, key_size)
+        batch_size = tf.shape(query)[0]
+
         # Compute the dot score
         # and divide the score by square root of key_size (as stated in paper)
         # (must convert key_size to float32 otherwise an error would occur)
@@ -166,15 +440,13 @@ class MultiHeadAttention(tf.keras.Model):
         # score will have shape of (batch, h, query_len, value_len)
         
         # Mask out the score if a mask is provided
+        # Masks are additive biases: 0 where attention is allowed, a very large negative value elsewhere,
+        # so that the masked out values are zeros after softmax
         # There are two types of mask:
         # - Padding mask (batch, 1, 1, value_len): to prevent attention being drawn to padded token (i.e. 0)
-        # - Look-left mask (batch, 1, query_len, value_len): to prevent decoder to draw attention to tokens to the right
+        # - Look-left mask (query_len, value_len): to prevent decoder to draw attention to tokens to the right
         if mask is not None:
-            score *= mask
-
-            # We want the masked out values to be zeros when applying softmax
-            # One way to accomplish that is assign them to a very large negative value
-            score = tf.where(tf.equal(score, 0), tf.ones_like(score) * -1e9, score)
+            score += mask
         
         # Alignment vector: (batch, h, query_len, value_len)
         alignment = tf.nn.softmax(score, axis=-1)
@@ -191,19 +463,86 @@ class MultiHeadAttention(tf.keras.Model):
         
         return heads
 
+    def attend_local(self, query, key, value, mask=None):
+        """
+        Self-attention of every word to the words at most self.window positions away
+        (only on its left if self.causal)
+        query, key and value are split into heads: (batch, h, len, key_size)
+        mask: padding bias (batch, 1, 1, len) or None, the look-left mask is never needed
+        The sequence is cut into blocks of window words, the words of a block attend to their
+        own block and the previous one (and the next one unless causal):
+        scores are (batch, h, num_blocks, window, 2 or 3 * window), linear in len
+        """
+        window = self.window
+        batch_size = tf.shape(query)[0]
+        length = tf.shape(query)[2]
+        num_blocks = (length + window - 1) // window
+        padding = num_blocks * window - length
+
+        def blocks(x):
+            # (batch, h, len, key_size) => (batch, h, num_blocks, window, key_size)
+            x = tf.pad(x, [[0, 0], [0, 0], [0, padding], [0, 0]])
+            return tf.reshape(x, [batch_size, -1, num_blocks, window, self.key_size])
+
+        def neighbours(x, constant_value=0.):
+            # Previous, current (and next) blocks of every block, concatenated on axis 3
+            x = tf.pad(x, [[0, 0], [0, 0], [1, 1], [0, 0]] + [[0, 0]] * (len(x.shape) - 4),
+                       constant_values=constant_value)
+            parts = [x[:, :, :-2], x[:, :, 1:-1]]
+            if not self.causal:
+                parts.append(x[:, :, 2:])
+            return tf.concat(parts, axis=3)
+
+        # Padding, added words and words out of the sequence get a -1e9 bias
+        if mask is None:
+            mask = tf.zeros([batch_size, 1, 1, length])
+        mask = tf.pad(mask[:, :, 0, :], [[0, 0], [0, 0], [0, padding]], constant_values=-1e9)
+        mask = neighbours(tf.reshape(mask, [batch_size, 1, num_blocks, window]), -1e9)
+
+        query = blocks(query)
+        key = neighbours(blocks(key))
+        value = neighbours(blocks(value))
+
+        # (batch, h, num_blocks, window, 2 or 3 * window)
+        score = tf.matmul(query, key, transpose_b=True) / tf.math.sqrt(tf.cast(self.key_size, dtype=tf.float32))
+        score += mask[:, :, :, tf.newaxis, :]
+        score += local_attention_band(window, self.causal)
+        alignment = tf.nn.softmax(score, axis=-1)
+
+        # (batch, h, num_blocks, window, key_size) => (batch, len, model_size)
+        context = tf.matmul(alignment, value)
+        context = tf.reshape(context, [batch_size, self.h, -1, self.key_size])[:, :, :length]
+        context = tf.transpose(context, [0, 2, 1, 3])
+        context = tf.reshape(context, [batch_size, -1, self.key_size * self.h])
+
+        return self.wo(context)
+
 
 """## Create the Encoder"""
 
 
+def recompute_layer(layer, i, *masks):
+    """
+    Layer i of an Encoder or a Decoder as a function of its inputs, whose activations are
+    recomputed in the backward pass. Gradients do not flow to the masks.
+    The layer must be built: variables cannot be created under tf.recompute_grad
+    """
+    return tf.recompute_grad(lambda *inputs: layer(i, *inputs, *masks))
+
+
 class Encoder(tf.keras.Model):
-    def __init__(self, vocab_size, model_size, num_layers, h):
+    def __init__(self, vocab_size, model_size, num_layers, h, fused_attention=FUSED_ATTENTION,
+                 recompute=RECOMPUTE_GRAD, attention_windows=ENCODER_ATTENTION_WINDOWS):
         super(Encoder, self).__init__()
         self.model_size = model_size
         self.num_layers = num_layers
         self.h = h
+        self.recompute = recompute
         self.embedding = tf.keras.layers.Embedding(vocab_size, model_size)
         self.attention = [MultiHeadAttention(
-            model_size // h, model_size // h, model_size, h) for _ in range(num_layers)]
+            model_size // h, model_size // h, model_size, h,
+            'qkv' if fused_attention else None, window=window)
+            for window in layer_windows(attention_windows, num_layers)]
 
         self.attention_norm = [tf.keras.layers.LayerNormalization(
             epsilon=1e-6) for _ in range(num_layers)]
@@ -219,22 +558,28 @@ class Encoder(tf.keras.Model):
         embed_out = self.embedding(sequence)
 
         embed_out *= tf.math.sqrt(tf.cast(self.model_size, tf.float32))
-        embed_out += pes[:, :sequence.shape[1], :]
+        embed_out += pes(sequence)
 
         sub_in = embed_out
 
         for i in range(self.num_layers):
-            sub_out = self.attention[i](sub_in, sub_in, encoder_mask)
-            sub_out = sub_in + sub_out
-            sub_out = self.attention_norm[i](sub_out)
+            if self.recompute and self.ffn_norm[i].built:
+                sub_in = recompute_layer(self.layer, i, encoder_mask)(sub_in)
+            else:
+                sub_in = self.layer(i, sub_in, encoder_mask)
 
-            ffn_in = sub_out
+        return sub_in
 
-            ffn_out = self.dense_2[i](self.dense_1[i](ffn_in))
-            ffn_out = ffn_in + ffn_out
-            ffn_out = self.ffn_norm[i](ffn_out)
+    def layer(self, i, sub_in, encoder_mask=None):
+        sub_out = self.attention[i](sub_in, sub_in, encoder_mask)
+        sub_out = sub_in + sub_out
+        sub_out = self.attention_norm[i](sub_out)
+
+        ffn_in = sub_out
 
-            sub_in = ffn_out
+        ffn_out = self.dense_2[i](self.dense_1[i](ffn_in))
+        ffn_out = ffn_in + ffn_out
+        ffn_out = self.ffn_norm[i](ffn_out)
 
         return ffn_out
 
@@ -242,26 +587,35 @@ class Encoder(tf.keras.Model):
 H = 8
 NUM_LAYERS = 4
 vocab_size = len(en_tokenizer.word_index) + 1
-encoder = Encoder(vocab_size, MODEL_SIZE, NUM_LAYERS, H)
-print(vocab_size)
-sequence_in = tf.constant([[1, 2, 3, 0, 0]])
-encoder_output = encoder(sequence_in)
+with strategy.scope():
+    encoder = Encoder(vocab_size, MODEL_SIZE, NUM_LAYERS, H)
+    print(vocab_size)
+    sequence_in = tf.constant([[1, 2, 3, 0, 0]])
+    encoder_output = encoder(sequence_in)
 encoder_output.shape
 
 
 class Decoder(tf.keras.Model):
-    def __init__(self, vocab_size, model_size, num_layers, h):
+    def __init__(self, vocab_size, model_size, num_layers, h, fused_attention=FUSED_ATTENTION,
+                 tied_output=TIE_EMBEDDINGS, embedding=None, recompute=RECOMPUTE_GRAD,
+                 attention_windows=DECODER_ATTENTION_WINDOWS):
+        # tied_output: project onto the vocabulary with the transposed embedding
+        # embedding: an Embedding to share (the encoder's one, for a joint vocabulary)
         super(Decoder, self).__init__()
         self.model_size = model_size
         self.num_layers = num_layers
         self.h = h
-        self.embedding = tf.keras.layers.Embedding(vocab_size, model_size)
+        self.recompute = recompute
+        self.embedding = embedding or tf.keras.layers.Embedding(vocab_size, model_size)
         self.attention_bot = [MultiHeadAttention(
-            model_size // h, model_size // h, model_size, h) for _ in range(num_layers)]
+            model_size // h, model_size // h, model_size, h,
+            'qkv' if fused_attention else None, window=window, causal=True)
+            for window in layer_windows(attention_windows, num_layers)]
         self.attention_bot_norm = [tf.keras.layers.LayerNormalization(
             epsilon=1e-6) for _ in range(num_layers)]
         self.attention_mid = [MultiHeadAttention(
-            model_size // h, model_size // h, model_size, h) for _ in range(num_layers)]
+            model_size // h, model_size // h, model_size, h,
+            'kv' if fused_attention else None) for _ in range(num_layers)]
         self.attention_mid_norm = [tf.keras.layers.LayerNormalization(
             epsilon=1e-6) for _ in range(num_layers)]
 
@@ -272,26 +626,99 @@ class Decoder(tf.keras.Model):
         self.ffn_norm = [tf.keras.layers.LayerNormalization(
             epsilon=1e-6) for _ in range(num_layers)]
 
-        self.dense = tf.keras.layers.Dense(vocab_size)
+        self.dense = None if tied_output else tf.keras.layers.Dense(vocab_size)
+
+    def project(self, ffn_out):
+        """
+        Logits over the vocabulary, (batch, len, vocab_size)
+        """
+        if self.dense is None:
+            # Dot products with the embeddings of all the words
+            return tf.matmul(ffn_out, self.embedding.embeddings, transpose_b=True)
+        return self.dense(ffn_out)
 
     def call(self, sequence, encoder_output, training=True, encoder_mask=None):
         # EMBEDDING AND POSITIONAL EMBEDDING
         embed_out = self.embedding(sequence)
 
         embed_out *= tf.math.sqrt(tf.cast(self.model_size, tf.float32))
-        embed_out += pes[:, :sequence.shape[1], :]
+        embed_out += pes(sequence)
 
         bot_sub_in = embed_out
 
-        for i in range(self.num_layers):
-            # BOTTOM MULTIHEAD SUB LAYER
-            seq_len = bot_sub_in.shape[1]
+        # The look-left mask is the same for all the layers,
+        # also when decoding so that every position sees what it saw in training
+        mask = create_look_left_mask(sequence)
 
-            if training:
-                mask = tf.linalg.band_part(tf.ones((seq_len, seq_len)), -1, 0)
+        for i in range(self.num_layers):
+            # The encoder output is an input of the layer, its gradient is needed
+            if self.recompute and self.ffn_norm[i].built:
+                bot_sub_in = recompute_layer(self.layer, i, mask, encoder_mask)(
+                    bot_sub_in, encoder_output)
             else:
-                mask = None
-            bot_sub_out = self.attention_bot[i](bot_sub_in, bot_sub_in, mask)
+                bot_sub_in = self.layer(i, bot_sub_in, encoder_output, mask, encoder_mask)
+
+        logits = self.project(bot_sub_in)
+
+        return logits
+
+    def layer(self, i, bot_sub_in, encoder_output, mask=None, encoder_mask=None):
+        # BOTTOM MULTIHEAD SUB LAYER
+        # Local attention layers are causal by themselves
+        if self.attention_bot[i].window is not None:
+            mask = None
+        bot_sub_out = self.attention_bot[i](bot_sub_in, bot_sub_in, mask)
+        bot_sub_out = bot_sub_in + bot_sub_out
+        bot_sub_out = self.attention_bot_norm[i](bot_sub_out)
+
+        # MIDDLE MULTIHEAD SUB LAYER
+        mid_sub_in = bot_sub_out
+
+        mid_sub_out = self.attention_mid[i](
+            mid_sub_in, encoder_output, encoder_mask)
+        mid_sub_out = mid_sub_out + mid_sub_in
+        mid_sub_out = self.attention_mid_norm[i](mid_sub_out)
+
+        # FFN
+        ffn_in = mid_sub_out
+
+        ffn_out = self.dense_2[i](self.dense_1[i](ffn_in))
+        ffn_out = ffn_out + ffn_in
+        ffn_out = self.ffn_norm[i](ffn_out)
+
+        return ffn_out
+
+    def call_step(self, sequence, position, cache, cross_key_values, encoder_mask=None):
+        """
+        Decode one word per sentence, attending to the cached keys and values of the previous words
+        sequence: the last words, (batch, 1), at index `position` of the target sequences
+        cache: (key, value) of the previous words for every layer, (batch, h, position, key_size)
+        cross_key_values: (key, value) of the encoder output for every layer,
+                          from attention_mid[i].project_key_value
+        Returns the logits (batch, 1, vocab_size) and the cache with the keys and values of sequence
+        """
+        embed_out = self.embedding(sequence)
+
+        embed_out *= tf.math.sqrt(tf.cast(self.model_size, tf.float32))
+        embed_out += pes.at(position)
+
+        bot_sub_in = embed_out
+        new_cache = []
+
+        for i in range(self.num_layers):
+            # BOTTOM MULTIHEAD SUB LAYER
+            # The new word attends to itself and to the previous words only,
+            # like with the look-left mask
+            query, key, value = self.attention_bot[i].project_self(bot_sub_in)
+            key = tf.concat([cache[i][0], key], axis=2)
+            value = tf.concat([cache[i][1], value], axis=2)
+            new_cache.append((key, value))
+
+            window = self.attention_bot[i].window
+            if window is not None:
+                # Local attention: the new word and the window words on its left
+                key, value = key[:, :, -(window + 1):], value[:, :, -(window + 1):]
+            bot_sub_out = self.attention_bot[i].attend(query, key, value)
             bot_sub_out = bot_sub_in + bot_sub_out
             bot_sub_out = self.attention_bot_norm[i](bot_sub_out)
 
@@ -299,7 +726,7 @@ class Decoder(tf.keras.Model):
             mid_sub_in = bot_sub_out
 
             mid_sub_out = self.attention_mid[i](
-                mid_sub_in, encoder_output, encoder_mask)
+                mid_sub_in, None, encoder_mask, key_value=cross_key_values[i])
             mid_sub_out = mid_sub_out + mid_sub_in
             mid_sub_out = self.attention_mid_norm[i](mid_sub_out)
 
@@ -312,16 +739,18 @@ class Decoder(tf.keras.Model):
 
             bot_sub_in = ffn_out
 
-        logits = self.dense(ffn_out)
+        logits = self.project(ffn_out)
 
-        return logits
+        return logits, new_cache
 
 
 vocab_size = len(fr_tokenizer.word_index) + 1
-decoder = Decoder(vocab_size, MODEL_SIZE, NUM_LAYERS, H)
+with strategy.scope():
+    decoder = Decoder(vocab_size, MODEL_SIZE, NUM_LAYERS, H,
+                      embedding=encoder.embedding if SHARE_EMBEDDINGS else None)
 
-sequence_in = tf.constant([[14, 24, 36, 0, 0]])
-decoder_output = decoder(sequence_in, encoder_output)
+    sequence_in = tf.constant([[14, 24, 36, 0, 0]])
+    decoder_output = decoder(sequence_in, encoder_output)
 decoder_output.shape
 
 
@@ -337,6 +766,17 @@ def loss_func(targets, logits):
     return loss
 
 
+def replica_loss_func(targets, logits):
+    """
+    Same as loss_func, without the Keras loss reduction that is not allowed
+    inside strategy.run
+    """
+    mask = tf.cast(tf.math.not_equal(targets, 0), dtype=tf.float32)
+    loss = tf.keras.losses.sparse_categorical_crossentropy(
+        targets, logits, from_logits=True)
+    return tf.reduce_sum(loss * mask) / tf.cast(tf.size(targets), tf.float32)
+
+
 class WarmupThenDecaySchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
     def __init__(self, model_size, warmup_steps=4000):
         super(WarmupThenDecaySchedule, self).__init__()
@@ -354,82 +794,1009 @@ class WarmupThenDecaySchedule(tf.keras.optimizers.schedules.LearningRateSchedule
 
 
 lr = WarmupThenDecaySchedule(MODEL_SIZE)
-optimizer = tf.keras.optimizers.Adam(lr,
-                                     beta_1=0.9,
-                                     beta_2=0.98,
-                                     epsilon=1e-9)
+with strategy.scope():
+    optimizer = tf.keras.optimizers.Adam(lr,
+                                         beta_1=0.9,
+                                         beta_2=0.98,
+                                         epsilon=1e-9)
 
 
-def predict(test_source_text=None):
+def predict(test_source_text=None, model=None):
     if test_source_text is None:
         test_source_text = raw_data_en[np.random.choice(len(raw_data_en))]
     print(test_source_text)
     test_source_seq = en_tokenizer.texts_to_sequences([test_source_text])
     print(test_source_seq)
 
-    en_output = encoder(tf.constant(test_source_seq), training=False)
-
-    de_input = tf.constant(
-        [[fr_tokenizer.word_index['<start>']]], dtype=tf.int64)
-
-    out_words = []
-
-    while True:
-        de_output = decoder(de_input, en_output, training=False)
-        new_word = tf.expand_dims(tf.argmax(de_output, -1)[:, -1], axis=1)
-        out_words.append(fr_tokenizer.index_word[new_word.numpy()[0][0]])
-
-        # Transformer doesn't have sequential mechanism (i.e. states)
-        # so we have to add the last predicted word to create a new input sequence
-        de_input = tf.concat((de_input, new_word), axis=-1)
-
-        # TODO: get a nicer constraint for the sequence length!
-        if out_words[-1] == '<end>' or len(out_words) >= 14:
+    # Greedy decoding (cached with CACHED_DECODING), at most decode_length words
+    print(' '.join(translate_tokens(test_source_seq, model)[0]))
+
+
+look_left_masks = {}
+
+
+def create_look_left_mask(sequence):
+    """
+    Additive bias preventing the words of sequence (batch, seq_len) to attend
+    to the words on their right, (seq_len, seq_len)
+    Biases are cached by length (NumPy arrays, usable in any graph)
+    """
+    seq_len = sequence.shape[1]
+    if seq_len is None:
+        seq_len = tf.shape(sequence)[1]
+        return (1. - tf.linalg.band_part(tf.ones((seq_len, seq_len)), -1, 0)) * -1e9
+    if seq_len not in look_left_masks:
+        look_left_masks[seq_len] = np.triu(
+            np.full((seq_len, seq_len), -1e9, dtype=np.float32), k=1)
+    return tf.constant(look_left_masks[seq_len])
+
+
+local_attention_bands = {}
+
+
+def local_attention_band(window, causal):
+    """
+    Additive bias of MultiHeadAttention.attend_local, (window, 2 or 3 * window):
+    word q of a block may attend to the word k of the neighbour blocks
+    if 0 <= k - q <= window (causal) or 2 * window
+    """
+    if (window, causal) not in local_attention_bands:
+        num_keys = (2 if causal else 3) * window
+        distance = np.arange(num_keys)[np.newaxis, :] - np.arange(window)[:, np.newaxis]
+        allowed = (distance >= 0) & (distance <= (1 if causal else 2) * window)
+        local_attention_bands[window, causal] = np.where(allowed, 0., -1e9).astype(np.float32)
+    return tf.constant(local_attention_bands[window, causal])
+
+
+def layer_windows(attention_windows, num_layers):
+    """
+    Attention window of every layer from ENCODER_ATTENTION_WINDOWS or DECODER_ATTENTION_WINDOWS
+    """
+    if attention_windows is None or isinstance(attention_windows, int):
+        return [attention_windows] * num_layers
+    if len(attention_windows) != num_layers:
+        raise ValueError('{} attention windows for {} layers!'.format(
+            len(attention_windows), num_layers))
+    return list(attention_windows)
+
+
+def create_encoder_mask(source_seq):
+    """
+    Additive bias preventing attention to the padding of source_seq, computed once per batch
+    """
+    encoder_mask = tf.cast(tf.equal(source_seq, 0), dtype=tf.float32) * -1e9
+    # encoder_mask has shape (batch_size, source_len)
+    # we need to add two more dimensions in between
+    # to make it broadcastable when computing attention heads
+    encoder_mask = tf.expand_dims(encoder_mask, axis=1)
+    encoder_mask = tf.expand_dims(encoder_mask, axis=1)
+    return encoder_mask
+
+
+def make_train_step(encoder, decoder, optimizer,
+                    shape_policy=SHAPE_POLICY, jit_compile=JIT_COMPILE):
+    def train_step(source_seq, target_seq_in, target_seq_out):
+        with tf.GradientTape() as tape:
+            encoder_mask = create_encoder_mask(source_seq)
+            encoder_output = encoder(source_seq, encoder_mask=encoder_mask)
+
+            decoder_output = decoder(
+                target_seq_in, encoder_output, encoder_mask=encoder_mask)
+
+            loss = loss_func(target_seq_out, decoder_output)
+
+        variables = encoder.trainable_variables + decoder.trainable_variables
+        gradients = tape.gradient(loss, variables)
+        optimizer.apply_gradients(zip(gradients, variables))
+
+        return loss
+
+    return CountedFunction(train_step, shape_policy, [sequence_spec()] * 3, jit_compile)
+
+
+def train(encoder, decoder, optimizer, dataset, num_epochs, checkpoint_dir):
+    train_step = make_train_step(encoder, decoder, optimizer)
+    starttime = time.time()
+    step_timer = StepTimer(100, enabled=REPORT_STALLS)
+    for e in range(num_epochs):
+        for batch, (source_seq, target_seq_in, target_seq_out) in enumerate(
+                step_timer.iterate(dataset.take(-1))):
+            with step_timer.computing():
+                loss = train_step(source_seq, target_seq_in,
+                                  target_seq_out)
+            step_timer.end_step(
+                np.count_nonzero(source_seq) + np.count_nonzero(target_seq_out))
+            if batch % 100 == 0:
+                print('Epoch {} Batch {} Loss {:.4f} Elapsed time {:.2f}s'.format(
+                    e + 1, batch, loss.numpy(), time.time() - starttime))
+                starttime = time.time()
+
+        encoder.save_weights(
+            os.path.join(checkpoint_dir, 'encoder', 'encoder_{}'.format(e + 1)))
+        decoder.save_weights(
+            os.path.join(checkpoint_dir, 'decoder', 'decoder_{}'.format(e + 1)))
+
+        try:
+            predict(model=(encoder, decoder))
+        except Exception as e:
+            print(e)
+            continue
+
+    step_timer.report()
+    print('train_step traced {} times'.format(train_step.num_traces))
+
+
+def make_distributed_train_step(encoder, decoder, optimizer):
+    def replica_step(source_seq, target_seq_in, target_seq_out):
+        with tf.GradientTape() as tape:
+            encoder_mask = create_encoder_mask(source_seq)
+            encoder_output = encoder(source_seq, encoder_mask=encoder_mask)
+
+            decoder_output = decoder(
+                target_seq_in, encoder_output, encoder_mask=encoder_mask)
+
+            loss = replica_loss_func(target_seq_out, decoder_output)
+            # Gradients are summed over the replicas by apply_gradients
+            scaled_loss = loss / strategy.num_replicas_in_sync
+
+        variables = encoder.trainable_variables + decoder.trainable_variables
+        gradients = tape.gradient(scaled_loss, variables)
+        optimizer.apply_gradients(zip(gradients, variables))
+
+        num_tokens = tf.math.count_nonzero(source_seq) + tf.math.count_nonzero(target_seq_out)
+        return loss, num_tokens
+
+    @tf.function
+    def train_step(source_seq, target_seq_in, target_seq_out):
+        loss, num_tokens = strategy.run(
+            replica_step, args=(source_seq, target_seq_in, target_seq_out))
+        return (strategy.reduce(tf.distribute.ReduceOp.MEAN, loss, axis=None),
+                strategy.reduce(tf.distribute.ReduceOp.SUM, num_tokens, axis=None))
+
+    return train_step
+
+
+def train_multi_worker(num_steps):
+    """
+    Training loop of a process started by launch_workers
+    Trains for num_steps steps, or NUM_EPOCHS epochs if num_steps is 0,
+    and prints the number of tokens per second processed by all the workers
+    (after the first MULTI_WORKER_WARMUP_STEPS steps)
+    """
+    if 0 < num_steps <= MULTI_WORKER_WARMUP_STEPS:
+        raise ValueError('num_steps must be 0 or more than the {} warm-up steps!'.format(
+            MULTI_WORKER_WARMUP_STEPS))
+
+    def dataset_fn(input_context):
+        shard = tf.data.Dataset.from_tensor_slices(
+            (data_en[train_ids], data_fr_in[train_ids], data_fr_out[train_ids]))
+        shard = shard.shard(input_context.num_input_pipelines,
+                            input_context.input_pipeline_id)
+        # Every worker must run the same number of steps, or the all-reduce hangs
+        shard = shard.take(len(train_ids) // input_context.num_input_pipelines)
+        shard = shard.shuffle(len(train_ids)).batch(BATCH_SIZE, drop_remainder=True)
+        return shard.repeat() if num_steps > 0 else shard
+
+    # Checkpoints must be written by every worker, only the chief's are kept
+    checkpoint_dir = CHECKPOINT_DIR if task_index == 0 else os.path.join(
+        CHECKPOINT_DIR + '_workers', 'worker_{}'.format(task_index))
+    train_step = make_distributed_train_step(encoder, decoder, optimizer)
+    distributed_dataset = strategy.distribute_datasets_from_function(dataset_fn)
+
+    step = 0
+    num_tokens = 0
+    starttime = time.time()
+    # Reset after the warm-up steps, in case an epoch has fewer steps than that
+    benchmark_start = starttime
+    for e in range(NUM_EPOCHS if num_steps == 0 else 1):
+        for batch, (source_seq, target_seq_in, target_seq_out) in enumerate(
+                distributed_dataset):
+            loss, batch_tokens = train_step(source_seq, target_seq_in, target_seq_out)
+            step += 1
+            if step == MULTI_WORKER_WARMUP_STEPS:
+                # Do not time the tracing and the setup of the collectives
+                num_tokens = 0
+                benchmark_start = time.time()
+            elif step > MULTI_WORKER_WARMUP_STEPS:
+                num_tokens += int(batch_tokens)
+            if batch % 100 == 0:
+                print('Epoch {} Batch {} Loss {:.4f} Elapsed time {:.2f}s'.format(
+                    e + 1, batch, loss.numpy(), time.time() - starttime))
+                starttime = time.time()
+            if step == num_steps:
+                break
+
+        if num_steps == 0:
+            encoder.save_weights(os.path.join(
+                checkpoint_dir, 'encoder', 'encoder_{}'.format(e + 1)))
+            decoder.save_weights(os.path.join(
+                checkpoint_dir, 'decoder', 'decoder_{}'.format(e + 1)))
+
+    print('Workers: {} Throughput: {:.1f} tokens/s'.format(
+        strategy.num_replicas_in_sync, num_tokens / (time.time() - benchmark_start)))
+
+
+def launch_workers(num_workers, num_steps):
+    """
+    Run this script in num_workers processes on localhost, and echo the output of the chief
+    The CPU cores are split between the workers
+    Returns the throughput (tokens/s) printed by the chief
+    """
+    cluster = {'worker': ['localhost:{}'.format(MULTI_WORKER_PORT + i)
+                          for i in range(num_workers)]}
+    num_threads = max(1, os.cpu_count() // num_workers)
+    processes = []
+    for i in range(num_workers):
+        env = dict(os.environ,
+                   TF_CONFIG=json.dumps({'cluster': cluster,
+                                         'task': {'type': 'worker', 'index': i}}),
+                   MULTI_WORKER_STEPS=str(num_steps),
+                   TF_NUM_INTRAOP_THREADS=str(num_threads),
+                   TF_NUM_INTEROP_THREADS=str(num_threads),
+                   CUDA_VISIBLE_DEVICES='')
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)], env=env,
+            stdout=subprocess.PIPE if i == 0 else subprocess.DEVNULL,
+            universal_newlines=True))
+
+    throughput = None
+    for line in processes[0].stdout:
+        print(line, end='')
+        match = re.search(r'Throughput: ([0-9.]+) tokens/s', line)
+        if match:
+            throughput = float(match.group(1))
+    for process in processes:
+        if process.wait() != 0:
+            raise RuntimeError('A worker failed with code {}'.format(process.returncode))
+
+    return throughput
+
+
+def make_cached_greedy_decode(encoder, decoder):
+    """
+    Greedy decoding with Decoder.call_step in a tf.while_loop,
+    the keys and values of the encoder output are computed once per batch
+    """
+    start_id = fr_tokenizer.word_index['<start>']
+    end_id = fr_tokenizer.word_index['<end>']
+    key_size = decoder.model_size // decoder.h
+
+    # Traced once for all the batch sizes and lengths
+    @tf.function(input_signature=[sequence_spec(), tf.TensorSpec([None], tf.int32)])
+    def cached_greedy_decode(source_seq, max_steps):
+        batch_size = tf.shape(source_seq)[0]
+        encoder_mask = create_encoder_mask(source_seq)
+        en_output = encoder(source_seq, training=False, encoder_mask=encoder_mask)
+        cross_key_values = [decoder.attention_mid[i].project_key_value(en_output)
+                            for i in range(decoder.num_layers)]
+        cache = [(tf.zeros([batch_size, decoder.h, 0, key_size]),
+                  tf.zeros([batch_size, decoder.h, 0, key_size]))
+                 for _ in range(decoder.num_layers)]
+        de_output = tf.fill([batch_size, 1], tf.constant(start_id, tf.int64))
+        finished = tf.zeros([batch_size], dtype=tf.bool)
+
+        def not_finished(step, de_output, finished, cache):
+            return tf.logical_and(step < tf.reduce_max(max_steps),
+                                  tf.logical_not(tf.reduce_all(finished)))
+
+        def decode_step(step, de_output, finished, cache):
+            logits, cache = decoder.call_step(
+                de_output[:, -1:], step, cache, cross_key_values, encoder_mask)
+            new_word = tf.argmax(logits[:, -1], -1)
+            new_word = tf.where(finished, tf.zeros_like(new_word), new_word)
+            finished = tf.logical_or(finished, tf.equal(new_word, end_id))
+            finished = tf.logical_or(finished, step + 1 >= max_steps)
+            de_output = tf.concat([de_output, new_word[:, tf.newaxis]], axis=-1)
+            return step + 1, de_output, finished, cache
+
+        # The decoded words and the cache grow by one position per step
+        cache_shape = tf.TensorShape([None, decoder.h, None, key_size])
+        _, de_output, _, _ = tf.while_loop(
+            not_finished, decode_step,
+            (tf.constant(0), de_output, finished, cache),
+            shape_invariants=(tf.TensorShape([]),
+                              tf.TensorShape([None, None]),
+                              finished.shape,
+                              [(cache_shape, cache_shape)] * decoder.num_layers))
+
+        return de_output[:, 1:]
+
+    return cached_greedy_decode
+
+
+cached_greedy_decodes = {}
+
+
+def greedy_decode(encoder, decoder, source_seq, max_steps, cached=CACHED_DECODING):
+    """
+    Greedy decoding of a batch of padded source sequences,
+    stops when every sentence has produced <end> or its max_steps words
+    (max_steps is either one number for the batch or one per sentence)
+    Returns the ids of the words after <start>, padded with 0 after <end>
+    """
+    max_steps = np.broadcast_to(max_steps, len(source_seq)).astype(np.int32)
+    if cached:
+        # Positions of the source words, of <start> and of all the words but the last one,
+        # the traced function reads the table at lengths only known when running
+        pes.ensure(max(int(max_steps.max()), np.shape(source_seq)[1]))
+        if (encoder, decoder) not in cached_greedy_decodes:
+            cached_greedy_decodes[(encoder, decoder)] = make_cached_greedy_decode(
+                encoder, decoder)
+        return cached_greedy_decodes[(encoder, decoder)](
+            tf.constant(source_seq), tf.constant(max_steps)).numpy()
+
+    start_id = fr_tokenizer.word_index['<start>']
+    end_id = fr_tokenizer.word_index['<end>']
+    source_seq = tf.constant(source_seq)
+    encoder_mask = create_encoder_mask(source_seq)
+    en_output = encoder(source_seq, training=False, encoder_mask=encoder_mask)
+
+    de_input = np.full((source_seq.shape[0], 1), start_id, dtype=np.int64)
+    finished = np.zeros(source_seq.shape[0], dtype=bool)
+    for step in range(max_steps.max()):
+        de_output = decoder(tf.constant(de_input), en_output,
+                            training=False, encoder_mask=encoder_mask)
+        new_word = tf.argmax(de_output[:, -1], -1).numpy()
+        new_word[finished] = 0
+        finished |= new_word == end_id
+        finished |= step + 1 >= max_steps
+        de_input = np.concatenate((de_input, new_word[:, np.newaxis]), axis=-1)
+        if finished.all():
             break
 
-    print(' '.join(out_words))
-
-
-@tf.function
-def train_step(source_seq, target_seq_in, target_seq_out):
-    with tf.GradientTape() as tape:
-        encoder_mask = 1 - tf.cast(tf.equal(source_seq, 0), dtype=tf.float32)
-        # encoder_mask has shape (batch_size, source_len)
-        # we need to add two more dimensions in between
-        # to make it broadcastable when computing attention heads
-        encoder_mask = tf.expand_dims(encoder_mask, axis=1)
-        encoder_mask = tf.expand_dims(encoder_mask, axis=1)
-        encoder_output = encoder(source_seq, encoder_mask=encoder_mask)
-
-        decoder_output = decoder(
-            target_seq_in, encoder_output, encoder_mask=encoder_mask)
-
-        loss = loss_func(target_seq_out, decoder_output)
-
-    variables = encoder.trainable_variables + decoder.trainable_variables
-    gradients = tape.gradient(loss, variables)
-    optimizer.apply_gradients(zip(gradients, variables))
-
-    return loss
-
-
-NUM_EPOCHS = 15
-
-starttime = time.time()
-for e in range(NUM_EPOCHS):
-    for batch, (source_seq, target_seq_in, target_seq_out) in enumerate(dataset.take(-1)):
-        loss = train_step(source_seq, target_seq_in,
-                          target_seq_out)
-        if batch % 100 == 0:
-            print('Epoch {} Batch {} Loss {:.4f} Elapsed time {:.2f}s'.format(
-                e + 1, batch, loss.numpy(), time.time() - starttime))
-            starttime = time.time()
-
-    try:
-        predict()
-    except Exception as e:
-        print(e)
-        continue
+    return de_input[:, 1:]
+
+
+def translate_in_batches(encoder, decoder, source_data, batch_size):
+    """
+    Translate padded source sequences, in batches of sentences of similar lengths
+    Returns the translations (lists of ids without <end>) in the original order
+    and the number of translations per second
+    """
+    end_id = fr_tokenizer.word_index['<end>']
+    lengths = np.count_nonzero(source_data, axis=1)
+    order = np.argsort(lengths)
+    translations = [None] * len(source_data)
+
+    start = time.time()
+    for batch_start in range(0, len(order), batch_size):
+        ids = order[batch_start:batch_start + batch_size]
+        source_seq = source_data[ids, :lengths[ids].max()]
+        # At most as many words as the longest training target
+        output = greedy_decode(encoder, decoder, source_seq, max_length - 1)
+        for i, words in zip(ids, output.tolist()):
+            if end_id in words:
+                words = words[:words.index(end_id)]
+            translations[i] = words
+
+    return translations, len(source_data) / (time.time() - start)
+
+
+def decode_length(source_lengths):
+    """
+    Maximum number of words of the translation of each source sentence
+    """
+    return (np.round(DECODE_LENGTH_RATIO * np.asarray(source_lengths)).astype(np.int32)
+            + DECODE_LENGTH_OFFSET)
+
+
+def translate_tokens(source_seqs, model=None):
+    """
+    Greedy translations of a batch of source sequences (lists of ids), as lists of words
+    """
+    encoder_, decoder_ = model or (encoder, decoder)
+    source_seq = tf.keras.preprocessing.sequence.pad_sequences(
+        source_seqs, padding='post')
+    output = greedy_decode(encoder_, decoder_, source_seq,
+                           decode_length([len(seq) for seq in source_seqs]))
+    end_id = fr_tokenizer.word_index['<end>']
+    translations = []
+    for words in output.tolist():
+        if end_id in words:
+            words = words[:words.index(end_id)]
+        # Sentences stopped by their length limit are padded with 0
+        translations.append([fr_tokenizer.index_word[i] for i in words if i != 0])
+    return translations
+
+
+def translate_batch(sentences, model=None):
+    """
+    Greedy translations of English sentences, BATCH_SIZE at a time:
+    sentences of similar lengths are padded and decoded together
+    Returns the translations in the order of sentences
+    """
+    source_seqs = en_tokenizer.texts_to_sequences(
+        [normalize_string(sentence) for sentence in sentences])
+    order = np.argsort([len(seq) for seq in source_seqs], kind='stable')
+    translations = [None] * len(sentences)
+    for start in range(0, len(order), BATCH_SIZE):
+        ids = order[start:start + BATCH_SIZE]
+        for i, words in zip(ids, translate_tokens([source_seqs[i] for i in ids], model)):
+            translations[i] = ' '.join(words)
+    return translations
+
+
+def distill_targets(encoder, decoder, teacher_checkpoint, ids):
+    """
+    Translations of the training sentences data_en[ids] by the teacher,
+    cached in DISTILL_CACHE with the teacher checkpoint and ids they were computed for
+    """
+    if os.path.exists(DISTILL_CACHE):
+        cache = np.load(DISTILL_CACHE)
+        if (str(cache['checkpoint']) == teacher_checkpoint
+                and 'ids' in cache and np.array_equal(cache['ids'], ids)):
+            print('Loaded teacher translations from', DISTILL_CACHE)
+            return [list(row[:length]) for row, length in zip(
+                cache['targets'], cache['lengths'])]
+
+    print('Translating {} sentences with the teacher...'.format(len(ids)))
+    targets, speed = translate_in_batches(
+        encoder, decoder, data_en[ids], DISTILL_BATCH_SIZE)
+    print('Teacher: {:.2f} translations/s'.format(speed))
+
+    lengths = np.array([len(t) for t in targets])
+    padded = tf.keras.preprocessing.sequence.pad_sequences(
+        targets, maxlen=max(lengths.max(), 1), padding='post')
+    np.savez(DISTILL_CACHE, targets=padded, lengths=lengths,
+             checkpoint=teacher_checkpoint, ids=ids)
+    return targets
+
+
+def evaluate(encoder, decoder, name, eval_ids):
+    """
+    Loss against the reference translations, corpus BLEU of the greedy translations
+    and greedy translations/s, eval_ids must not have been trained on (held_out_ids)
+    """
+    source_data = data_en[eval_ids]
+    losses = []
+    for start in range(0, len(eval_ids), BATCH_SIZE):
+        source_seq = source_data[start:start + BATCH_SIZE]
+        encoder_mask = create_encoder_mask(source_seq)
+        encoder_output = encoder(source_seq, training=False, encoder_mask=encoder_mask)
+        decoder_output = decoder(data_fr_in[eval_ids[start:start + BATCH_SIZE]],
+                                 encoder_output, encoder_mask=encoder_mask)
+        losses.append(loss_func(
+            data_fr_out[eval_ids[start:start + BATCH_SIZE]], decoder_output).numpy())
+
+    translations, speed = translate_in_batches(encoder, decoder, source_data, BATCH_SIZE)
+    # Sentences stopped by their length limit are padded with 0
+    bleu, _ = corpus_scores(
+        [[fr_tokenizer.index_word[i] for i in words if i != 0] for words in translations],
+        [raw_data_fr_out[i].split()[:-1] for i in eval_ids])
+    num_params = sum(int(np.prod(v.shape)) for v in
+                     encoder.trainable_variables + decoder.trainable_variables)
+    print('{}: {} layers x {} heads, {} parameters, loss {:.4f}, BLEU {:.2f}, '
+          '{:.2f} translations/s'.format(name, encoder.num_layers, encoder.h, num_params,
+                                         np.mean(losses), bleu, speed))
+
+
+def fuse_attention_weights(source, target):
+    """
+    Copy the weights of a MultiHeadAttention with separate projections
+    into one with fused projections, both compute the same outputs
+    """
+    if target.fused == 'qkv':
+        projections = [source.wq, source.wk, source.wv]
+        fused_projection = target.wqkv
+    else:
+        target.wq.set_weights(source.wq.get_weights())
+        projections = [source.wk, source.wv]
+        fused_projection = target.wkv
+    # Kernels and biases are concatenated along the output units
+    fused_projection.set_weights(
+        [np.concatenate(weights, axis=-1)
+         for weights in zip(*[projection.get_weights() for projection in projections])])
+    target.wo.set_weights(source.wo.get_weights())
+
+
+def convert_to_fused_attention(encoder_checkpoint, decoder_checkpoint, encoder, decoder):
+    """
+    Load checkpoints of a model with separate attention projections
+    into an encoder and a decoder with fused attention
+    """
+    source_encoder = Encoder(encoder.embedding.input_dim, encoder.model_size,
+                             encoder.num_layers, encoder.h, fused_attention=False)
+    source_decoder = Decoder(decoder.embedding.input_dim, decoder.model_size,
+                             decoder.num_layers, decoder.h, fused_attention=False,
+                             tied_output=decoder.dense is None,
+                             embedding=source_encoder.embedding if SHARE_EMBEDDINGS else None)
+    source_decoder(tf.constant([[1]]), source_encoder(tf.constant([[1]])))
+    source_encoder.load_weights(encoder_checkpoint)
+    source_decoder.load_weights(decoder_checkpoint)
+
+    for source, target in [(source_encoder, encoder), (source_decoder, decoder)]:
+        for source_layer, target_layer in zip(source.layers, target.layers):
+            if isinstance(target_layer, MultiHeadAttention):
+                fuse_attention_weights(source_layer, target_layer)
+            else:
+                target_layer.set_weights(source_layer.get_weights())
+
+
+for directory in ['encoder', 'decoder']:
+    if not os.path.exists(os.path.join(CHECKPOINT_DIR, directory)):
+        os.makedirs(os.path.join(CHECKPOINT_DIR, directory))
+
+encoder_checkpoint = tf.train.latest_checkpoint(os.path.join(CHECKPOINT_DIR, 'encoder'))
+decoder_checkpoint = tf.train.latest_checkpoint(os.path.join(CHECKPOINT_DIR, 'decoder'))
+
+if FUSED_ATTENTION and encoder_checkpoint is None:
+    unfused_encoder_checkpoint = tf.train.latest_checkpoint(
+        os.path.join(UNFUSED_CHECKPOINT_DIR, 'encoder'))
+    unfused_decoder_checkpoint = tf.train.latest_checkpoint(
+        os.path.join(UNFUSED_CHECKPOINT_DIR, 'decoder'))
+    if unfused_encoder_checkpoint is not None and unfused_decoder_checkpoint is not None:
+        print('Converting', unfused_encoder_checkpoint, 'and', unfused_decoder_checkpoint)
+        convert_to_fused_attention(unfused_encoder_checkpoint, unfused_decoder_checkpoint,
+                                   encoder, decoder)
+        encoder_checkpoint = os.path.join(CHECKPOINT_DIR, 'encoder', 'encoder_converted')
+        decoder_checkpoint = os.path.join(CHECKPOINT_DIR, 'decoder', 'decoder_converted')
+        encoder.save_weights(encoder_checkpoint)
+        decoder.save_weights(decoder_checkpoint)
+
+if encoder_checkpoint is not None and decoder_checkpoint is not None:
+    encoder.load_weights(encoder_checkpoint)
+    decoder.load_weights(decoder_checkpoint)
+
+memory_config = process_config()
+if memory_config is not None:
+    # Started by benchmark_recompute: a few training steps and exit
+    encoder.recompute = decoder.recompute = memory_config['recompute']
+    ids = train_ids[:memory_config['batch_size']]
+    measure_train_step(make_train_step(encoder, decoder, optimizer),
+                       (tf.constant(data_en[ids]), tf.constant(data_fr_in[ids]),
+                        tf.constant(data_fr_out[ids])))
+    sys.exit(0)
+
+if MODE == 'train':
+    train(encoder, decoder, optimizer, dataset, NUM_EPOCHS, CHECKPOINT_DIR)
+
+if IS_WORKER:
+    train_multi_worker(int(os.environ.get('MULTI_WORKER_STEPS', 0)))
+    sys.exit(0)
+
+if MODE == 'multi_worker':
+    throughputs = [launch_workers(num_workers, SCALING_STEPS)
+                   for num_workers in range(1, NUM_WORKERS + 1)]
+    launch_workers(NUM_WORKERS, 0)
+
+    # Scaling efficiency: throughput of N workers / (N * throughput of one worker)
+    print('{:>8} {:>12} {:>10}'.format('workers', 'tokens/s', 'efficiency'))
+    for num_workers, throughput in enumerate(throughputs, 1):
+        print('{:>8} {:>12.1f} {:>9.1f}%'.format(
+            num_workers, throughput, 100 * throughput / (num_workers * throughputs[0])))
+
+    encoder.load_weights(tf.train.latest_checkpoint(os.path.join(CHECKPOINT_DIR, 'encoder')))
+    decoder.load_weights(tf.train.latest_checkpoint(os.path.join(CHECKPOINT_DIR, 'decoder')))
+
+if MODE == 'distill':
+    if encoder_checkpoint is None:
+        raise ValueError('The teacher must be trained first (MODE = \'train\')')
+
+    start_id = fr_tokenizer.word_index['<start>']
+    end_id = fr_tokenizer.word_index['<end>']
+    # Only the training split, held_out_ids are left for the comparison below
+    targets = distill_targets(encoder, decoder, encoder_checkpoint, train_ids)
+    distill_fr_in = tf.keras.preprocessing.sequence.pad_sequences(
+        [[start_id] + t for t in targets], padding='post')
+    distill_fr_out = tf.keras.preprocessing.sequence.pad_sequences(
+        [t + [end_id] for t in targets], padding='post')
+
+    distill_dataset = tf.data.Dataset.from_tensor_slices(
+        (data_en[train_ids], distill_fr_in, distill_fr_out))
+    distill_dataset = make_batches(distill_dataset.shuffle(len(train_ids)))
+
+    student_encoder = Encoder(len(en_tokenizer.word_index) + 1, MODEL_SIZE,
+                              STUDENT_NUM_LAYERS, STUDENT_H)
+    student_decoder = Decoder(len(fr_tokenizer.word_index) + 1, MODEL_SIZE,
+                              STUDENT_NUM_LAYERS, STUDENT_H,
+                              embedding=student_encoder.embedding if SHARE_EMBEDDINGS else None)
+    student_optimizer = tf.keras.optimizers.Adam(
+        WarmupThenDecaySchedule(MODEL_SIZE), beta_1=0.9, beta_2=0.98, epsilon=1e-9)
+    student_dir = CHECKPOINT_DIR + '_student'
+    for directory in ['encoder', 'decoder']:
+        if not os.path.exists(os.path.join(student_dir, directory)):
+            os.makedirs(os.path.join(student_dir, directory))
+    train(student_encoder, student_decoder, student_optimizer,
+          distill_dataset, STUDENT_NUM_EPOCHS, student_dir)
+
+    evaluate(encoder, decoder, 'Teacher', held_out_ids)
+    evaluate(student_encoder, student_decoder, 'Student', held_out_ids)
+
+
+def greedy_translate(encode, decode, source_seq):
+    """
+    Greedy translation of one source sequence, encode and decode are either
+    the tf.functions below or their TFLite conversions.
+    Source and target are padded to max_length, so all the shapes are static
+    """
+    start_id = fr_tokenizer.word_index['<start>']
+    end_id = fr_tokenizer.word_index['<end>']
+    source = np.zeros((1, max_length), dtype=np.int32)
+    source[0, :len(source_seq)] = source_seq[:max_length]
+    en_output = encode(source)
+
+    de_input = np.zeros((1, max_length), dtype=np.int32)
+    de_input[0, 0] = start_id
+    out_ids = []
+    for position in range(max_length - 1):
+        logits = decode(de_input, en_output, source, np.int32(position))
+        out_ids.append(int(np.argmax(logits)))
+        if out_ids[-1] == end_id:
+            break
+        de_input[0, position + 1] = out_ids[-1]
+
+    return out_ids
+
+
+if QUANTIZE:
+    @tf.function(input_signature=[tf.TensorSpec([1, max_length], tf.int32)])
+    def encode(source_seq):
+        return encoder(source_seq, training=False,
+                       encoder_mask=create_encoder_mask(source_seq))
+
+    # The look-left mask keeps the padding after position from changing the logits at position
+    @tf.function(input_signature=[
+        tf.TensorSpec([1, max_length], tf.int32),
+        tf.TensorSpec([1, max_length, MODEL_SIZE], tf.float32),
+        tf.TensorSpec([1, max_length], tf.int32),
+        tf.TensorSpec([], tf.int32)])
+    def decode(de_input, encoder_output, source_seq, position):
+        logits = decoder(de_input, encoder_output, training=False,
+                         encoder_mask=create_encoder_mask(source_seq))
+        return logits[:, position]
+
+    sentence_ids = np.random.RandomState(0).permutation(len(raw_data_en))
+    calibration_seqs = en_tokenizer.texts_to_sequences(
+        [raw_data_en[i] for i in sentence_ids[:CALIBRATION_SIZE]])
+    eval_seqs = en_tokenizer.texts_to_sequences(
+        [raw_data_en[i] for i in sentence_ids[
+            CALIBRATION_SIZE:CALIBRATION_SIZE + QUANTIZATION_EVAL_SIZE]])
+
+    # Inputs seen by the float model while translating the calibration sentences
+    encode_recorder = InputRecorder(encode)
+    decode_recorder = InputRecorder(decode)
+    for source_seq in calibration_seqs:
+        greedy_translate(encode_recorder, decode_recorder, source_seq)
+
+    translate_fns = []
+    model_sizes = []
+    for mode in QUANTIZATION_MODES:
+        encode_model = TFLiteModel(convert_to_tflite(
+            encode.get_concrete_function(), mode, encode_recorder.inputs))
+        decode_model = TFLiteModel(convert_to_tflite(
+            decode.get_concrete_function(), mode, decode_recorder.inputs))
+        translate_fns.append(
+            (mode, lambda seq, e=encode_model, d=decode_model: greedy_translate(e, d, seq)))
+        model_sizes.append(encode_model.size + decode_model.size)
+
+    compare_models(translate_fns, model_sizes, eval_seqs)
+
+
+def time_function(function, *args, num_steps=20):
+    """
+    Average time of a call of function, after a first call that traces it
+    """
+    tf.nest.map_structure(lambda t: t.numpy(), function(*args))
+    start = time.time()
+    for _ in range(num_steps):
+        output = function(*args)
+    tf.nest.map_structure(lambda t: t.numpy(), output)
+    return (time.time() - start) / num_steps
+
+
+def benchmark_attention(lengths, batch_size=16, num_steps=20):
+    attention = MultiHeadAttention(MODEL_SIZE // H, MODEL_SIZE // H, MODEL_SIZE, H)
+
+    @tf.function
+    def multiply_mask(score):
+        seq_len = score.shape[-1]
+        mask = tf.linalg.band_part(tf.ones((seq_len, seq_len)), -1, 0)
+        score *= mask
+        score = tf.where(tf.equal(score, 0), tf.ones_like(score) * -1e9, score)
+        return tf.nn.softmax(score, axis=-1)
+
+    @tf.function
+    def add_bias(score, mask):
+        return tf.nn.softmax(score + mask, axis=-1)
+
+    @tf.function
+    def self_attention(sequence, mask):
+        return attention(sequence, sequence, mask)
+
+    print('{:>8} {:>14} {:>14} {:>10} {:>16}'.format(
+        'length', 'multiply (ms)', 'bias (ms)', 'speed-up', 'layer words/s'))
+    for length in lengths:
+        score = tf.random.normal([batch_size, H, length, length])
+        sequence = tf.random.normal([batch_size, length, MODEL_SIZE])
+        mask = create_look_left_mask(sequence)
+        multiply_time = time_function(multiply_mask, score, num_steps=num_steps)
+        bias_time = time_function(add_bias, score, mask, num_steps=num_steps)
+        layer_time = time_function(self_attention, sequence, mask, num_steps=num_steps)
+        print('{:>8} {:>14.2f} {:>14.2f} {:>10.2f} {:>16.1f}'.format(
+            length, 1000 * multiply_time, 1000 * bias_time,
+            multiply_time / bias_time, batch_size * length / layer_time))
+
+
+def benchmark_fused_attention(batch_size=BATCH_SIZE, length=max_length, num_steps=20):
+    """
+    Time a self-attention and a cross-attention layer with separate and fused projections:
+    forward and backward over whole sequences (training), one word attending to
+    `length` cached words (decoding) and the projection of the encoder output (once per sentence)
+    """
+    key_size = MODEL_SIZE // H
+    sequence = tf.random.normal([batch_size, length, MODEL_SIZE])
+    word = tf.random.normal([batch_size, 1, MODEL_SIZE])
+
+    def layer_train_step(layer):
+        @tf.function
+        def train_step(query, value):
+            with tf.GradientTape() as tape:
+                loss = tf.reduce_sum(layer(query, value))
+            return tape.gradient(loss, layer.trainable_variables)
+        return train_step
+
+    def layer_decode_step(layer):
+        @tf.function
+        def decode_step(word, cache):
+            query, key, value = layer.project_self(word)
+            key = tf.concat([cache[0], key], axis=2)
+            value = tf.concat([cache[1], value], axis=2)
+            return layer.attend(query, key, value)
+        return decode_step
+
+    def layer_project(layer):
+        return tf.function(layer.project_key_value)
+
+    print('{:>32} {:>14} {:>14} {:>10}'.format('', 'separate (ms)', 'fused (ms)', 'speed-up'))
+    for fused in ['qkv', 'kv']:
+        layers = [MultiHeadAttention(key_size, key_size, MODEL_SIZE, H),
+                  MultiHeadAttention(key_size, key_size, MODEL_SIZE, H, fused)]
+        for layer in layers:
+            layer(sequence, sequence)
+        fuse_attention_weights(*layers)
+
+        if fused == 'qkv':
+            cache = layers[0].project_key_value(sequence)
+            benchmarks = [('self-attention training step', layer_train_step,
+                           (sequence, sequence)),
+                          ('self-attention decoding step', layer_decode_step,
+                           (word, cache))]
+        else:
+            benchmarks = [('cross-attention training step', layer_train_step,
+                           (sequence, sequence)),
+                          ('cross-attention K/V projection', layer_project,
+                           (sequence,))]
+        for name, make_function, args in benchmarks:
+            separate_time, fused_time = [
+                time_function(make_function(layer), *args, num_steps=num_steps)
+                for layer in layers]
+            print('{:>32} {:>14.3f} {:>14.3f} {:>10.2f}'.format(
+                name, 1000 * separate_time, 1000 * fused_time, separate_time / fused_time))
+
+
+def benchmark_local_attention(lengths, window=BENCHMARK_LOCAL_ATTENTION_WINDOW,
+                              batch_size=2, num_steps=10):
+    """
+    Time a training step (forward and backward) of a self-attention layer with full attention
+    and with local attention, for the encoder and the (causal) decoder, on random sequences.
+    Both layers have the same weights and full attention gets the band mask of the window,
+    so their outputs must be the same
+    """
+    key_size = MODEL_SIZE // H
+
+    def layer_train_step(layer, mask):
+        @tf.function
+        def train_step(sequence):
+            with tf.GradientTape() as tape:
+                loss = tf.reduce_sum(layer(sequence, sequence, mask))
+            return tape.gradient(loss, layer.trainable_variables)
+        return train_step
+
+    print('{:>8} {:>8} {:>10} {:>11} {:>9} {:>12} {:>13} {:>10}'.format(
+        'layer', 'length', 'full (ms)', 'local (ms)', 'speed-up',
+        'full scores', 'local scores', 'max diff'))
+    for causal in [False, True]:
+        full = MultiHeadAttention(key_size, key_size, MODEL_SIZE, H)
+        local = MultiHeadAttention(key_size, key_size, MODEL_SIZE, H, window=window, causal=causal)
+        sequence = tf.random.normal([1, 1, MODEL_SIZE])
+        full(sequence, sequence)
+        local(sequence, sequence)
+        local.set_weights(full.get_weights())
+
+        for length in lengths:
+            sequence = tf.random.normal([batch_size, length, MODEL_SIZE])
+            # k - q for every query q and key k
+            distance = np.arange(length)[np.newaxis, :] - np.arange(length)[:, np.newaxis]
+            allowed = (distance >= -window) & (distance <= (0 if causal else window))
+            band = tf.constant(np.where(allowed, 0., -1e9).astype(np.float32))
+
+            difference = tf.reduce_max(tf.abs(
+                full(sequence, sequence, band) - local(sequence, sequence))).numpy()
+            full_time = time_function(layer_train_step(full, band), sequence, num_steps=num_steps)
+            local_time = time_function(layer_train_step(local, None), sequence,
+                                       num_steps=num_steps)
+
+            # Size of the scores of one layer (float32), in MB
+            num_blocks = -(-length // window)
+            full_scores = batch_size * H * length * length * 4 / 2 ** 20
+            local_scores = (batch_size * H * num_blocks * window *
+                            (2 if causal else 3) * window * 4 / 2 ** 20)
+            print('{:>8} {:>8} {:>10.2f} {:>11.2f} {:>9.2f} {:>9.1f} MB {:>10.1f} MB {:>10.2e}'.format(
+                'decoder' if causal else 'encoder', length, 1000 * full_time, 1000 * local_time,
+                full_time / local_time, full_scores, local_scores, difference))
+
+
+def benchmark_batching(num_steps=BENCHMARK_BATCHING_STEPS):
+    """
+    Train new models for num_steps steps on batches of BATCH_SIZE pairs padded to the longest
+    sentence of the corpus, then on token-budget batches (batch_by_tokens).
+    Steps that trace train_step are not timed
+    """
+    pairs = tf.data.Dataset.from_tensor_slices(
+        (data_en[train_ids], data_fr_in[train_ids], data_fr_out[train_ids]))
+    pairs = pairs.shuffle(len(train_ids))
+
+    print('{:>10} {:>7} {:>7} {:>10} {:>9} {:>9} {:>6} {:>10} {:>8}'.format(
+        'batches', 'steps', 'traces', 'mean (ms)', 'std (ms)', 'p95 (ms)', 'cv',
+        'tokens/s', 'padding'))
+    for name, batches in [('sentences', pairs.batch(BATCH_SIZE)),
+                          ('tokens', batch_by_tokens(pairs))]:
+        encoder = Encoder(len(en_tokenizer.word_index) + 1, MODEL_SIZE, NUM_LAYERS, H)
+        decoder = Decoder(len(fr_tokenizer.word_index) + 1, MODEL_SIZE, NUM_LAYERS, H,
+                          embedding=encoder.embedding if SHARE_EMBEDDINGS else None)
+        optimizer = tf.keras.optimizers.Adam(
+            WarmupThenDecaySchedule(MODEL_SIZE), beta_1=0.9, beta_2=0.98, epsilon=1e-9)
+        train_step = make_train_step(encoder, decoder, optimizer)
+
+        step_times = []
+        num_tokens = 0
+        num_padded_tokens = 0
+        for source_seq, target_seq_in, target_seq_out in batches.repeat().take(num_steps):
+            num_traces = train_step.num_traces
+            start = time.time()
+            train_step(source_seq, target_seq_in, target_seq_out).numpy()
+            step_time = time.time() - start
+            if train_step.num_traces > num_traces:
+                continue
+            step_times.append(step_time)
+            num_tokens += np.count_nonzero(source_seq) + np.count_nonzero(target_seq_out)
+            num_padded_tokens += np.size(source_seq) + np.size(target_seq_out)
+
+        step_times = np.array(step_times)
+        print('{:>10} {:>7} {:>7} {:>10.1f} {:>9.1f} {:>9.1f} {:>6.2f} {:>10.1f} {:>7.1f}%'.format(
+            name, len(step_times), train_step.num_traces, 1000 * step_times.mean(),
+            1000 * step_times.std(), 1000 * np.percentile(step_times, 95),
+            step_times.std() / step_times.mean(), num_tokens / step_times.sum(),
+            100 * (1 - num_tokens / num_padded_tokens)))
+
+
+def benchmark_shape_policy(num_steps=BENCHMARK_SHAPE_POLICY_STEPS):
+    """
+    Train new models for num_steps steps with every shape policy, with and without XLA,
+    on the batches of make_batches (TOKEN_BATCHING included)
+    """
+    pairs = tf.data.Dataset.from_tensor_slices(
+        (data_en[train_ids], data_fr_in[train_ids], data_fr_out[train_ids]))
+    pairs = pairs.shuffle(len(train_ids))
+
+    def make_benchmark_step(shape_policy, jit_compile):
+        # New models, built before tracing
+        new_encoder = Encoder(len(en_tokenizer.word_index) + 1, MODEL_SIZE, NUM_LAYERS, H)
+        new_decoder = Decoder(len(fr_tokenizer.word_index) + 1, MODEL_SIZE, NUM_LAYERS, H,
+                              embedding=new_encoder.embedding if SHARE_EMBEDDINGS else None)
+        new_decoder(tf.constant([[1]]), new_encoder(tf.constant([[1]])))
+        new_optimizer = tf.keras.optimizers.Adam(
+            WarmupThenDecaySchedule(MODEL_SIZE), beta_1=0.9, beta_2=0.98, epsilon=1e-9)
+        return make_train_step(new_encoder, new_decoder, new_optimizer, shape_policy, jit_compile)
+
+    compare_shape_policies(
+        make_benchmark_step,
+        lambda shape_policy: make_batches(pairs, shape_policy).repeat(),
+        num_steps)
+
+
+def benchmark_embeddings(num_steps=20):
+    """
+    Parameters, training memory (weights, gradients and the two Adam slots),
+    checkpoint size and training step time with separate embeddings and output projection,
+    a tied output projection and a joint vocabulary shared by the encoder and the decoder
+    """
+    en_vocab_size = len(en_tokenizer.word_index) + 1
+    fr_vocab_size = len(fr_tokenizer.word_index) + 1
+    # The joint vocabulary holds the words of both languages once,
+    # the ids of both tokenizers fit in it so the same batches can be used
+    joint_vocab_size = len(set(en_tokenizer.word_index) | set(fr_tokenizer.word_index)) + 1
+    source_seq, target_seq_in, target_seq_out = next(iter(dataset))
+
+    print('{:>10} {:>12} {:>14} {:>18} {:>10}'.format(
+        'embeddings', 'parameters', 'memory (MB)', 'checkpoint (MB)', 'step (ms)'))
+    for name, tied, shared in [('separate', False, False),
+                               ('tied', True, False),
+                               ('shared', True, True)]:
+        encoder = Encoder(joint_vocab_size if shared else en_vocab_size, MODEL_SIZE, NUM_LAYERS, H)
+        decoder = Decoder(joint_vocab_size if shared else fr_vocab_size, MODEL_SIZE, NUM_LAYERS, H,
+                          tied_output=tied, embedding=encoder.embedding if shared else None)
+        optimizer = tf.keras.optimizers.Adam(
+            WarmupThenDecaySchedule(MODEL_SIZE), beta_1=0.9, beta_2=0.98, epsilon=1e-9)
+        train_step = make_train_step(encoder, decoder, optimizer)
+        step_time = time_function(train_step, source_seq, target_seq_in, target_seq_out,
+                                  num_steps=num_steps)
+
+        # A shared embedding is a single variable of both models
+        variables = {id(v): v for v in encoder.trainable_variables + decoder.trainable_variables}
+        num_parameters = sum(int(np.prod(v.shape)) for v in variables.values())
+
+        checkpoint_dir = tempfile.mkdtemp()
+        try:
+            tf.train.Checkpoint(encoder=encoder, decoder=decoder).write(
+                os.path.join(checkpoint_dir, 'ckpt'))
+            checkpoint_size = sum(os.path.getsize(os.path.join(checkpoint_dir, f))
+                                  for f in os.listdir(checkpoint_dir))
+        finally:
+            shutil.rmtree(checkpoint_dir)
+
+        print('{:>10} {:>12} {:>14.1f} {:>18.1f} {:>10.2f}'.format(
+            name, num_parameters, 4 * 4 * num_parameters / 2 ** 20,
+            checkpoint_size / 2 ** 20, 1000 * step_time))
+
+
+if BENCHMARK_ATTENTION:
+    benchmark_attention(BENCHMARK_ATTENTION_LENGTHS)
+
+if BENCHMARK_FUSED_ATTENTION:
+    benchmark_fused_attention()
+
+if BENCHMARK_LOCAL_ATTENTION:
+    benchmark_local_attention(BENCHMARK_LOCAL_ATTENTION_LENGTHS)
+
+if BENCHMARK_EMBEDDINGS:
+    benchmark_embeddings()
+
+if BENCHMARK_BATCHING:
+    benchmark_batching()
+
+if BENCHMARK_SHAPE_POLICY:
+    benchmark_shape_policy()
+
+if BENCHMARK_RECOMPUTE:
+    # Batches of the longest (padded) length
+    compare_memory(__file__, [{'batch_size': batch_size, 'recompute': recompute}
+                              for batch_size in BENCHMARK_RECOMPUTE_BATCH_SIZES
+                              for recompute in [False, True]])
+
+if BENCHMARK_DECODING:
+    # One sentence at a time, per-word latency of the decoding loop
+    source_seqs = en_tokenizer.texts_to_sequences(
+        [raw_data_en[i] for i in held_out_ids[:BENCHMARK_DECODING_SIZE]])
+    results = []
+    for cached in [False, True]:
+        # Warm up, the first call traces the tf.function
+        greedy_decode(encoder, decoder, [source_seqs[0]], max_length - 1, cached)
+        outputs = []
+        start = time.time()
+        for source_seq in source_seqs:
+            outputs.append(greedy_decode(
+                encoder, decoder, [source_seq], max_length - 1, cached)[0].tolist())
+        elapsed = time.time() - start
+        num_words = sum(len(output) for output in outputs)
+        results.append((outputs, elapsed, num_words))
+
+    print('{:>10} {:>10} {:>10}'.format('decoding', 'ms/word', 'words/s'))
+    for name, (_, elapsed, num_words) in zip(['full', 'cached'], results):
+        print('{:>10} {:>10.2f} {:>10.1f}'.format(
+            name, 1000 * elapsed / num_words, num_words / elapsed))
+    print('Speed-up in words/s: {:.2f}'.format(
+        (results[1][2] / results[1][1]) / (results[0][2] / results[0][1])))
+    # Both decode with the look-left mask, translations may only differ by numerical errors
+    print('Identical translations: {:.1%}'.format(
+        np.mean([a == b for a, b in zip(results[0][0], results[1][0])])))
+
+if EVALUATE:
+    evaluate_translation(
+        translate_tokens,
+        en_tokenizer.texts_to_sequences([raw_data_en[i] for i in held_out_ids]),
+        [raw_data_fr_out[i].split()[:-1] for i in held_out_ids],
+        EVAL_BATCH_SIZE)
 
 test_sents = (
     'What a ridiculous concept!',
@@ -454,6 +1821,6 @@ test_sents = (
     "I can't believe you're giving up.",
 )
 
-for i, test_sent in enumerate(test_sents):
-    test_sequence = normalize_string(test_sent)
-    predict(test_sequence)
+for test_sent, translation in zip(test_sents, translate_batch(test_sents)):
+    print(test_sent)
+    print(translation)
@@ -2,6 +2,12 @@ import tensorflow as tf
 import numpy as np
 from collections import Counter
 import os
+import sys
+
+# common/ holds the modules shared by all the projects
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.step_timer import StepTimer
+from common.async_checkpoint import AsyncCheckpointer
 
 flags = tf.app.flags
 
@@ -16,6 +22,10 @@ flags.DEFINE_multi_string('initial_words', ['I', 'am'], 'Initial words to start
 flags.DEFINE_integer('predict_top_k', 5, 'top k results to sample word from')
 flags.DEFINE_integer('num_epochs', 20, 'Number of epochs to train')
 flags.DEFINE_string('checkpoint_path', 'checkpoint', 'directory to store trained weights')
+flags.DEFINE_boolean('report_stalls', False, 'report time spent waiting for data and computing per step')
+flags.DEFINE_boolean('async_checkpoint', True, 'write checkpoints in a background thread')
+flags.DEFINE_integer('keep_checkpoints', 5, 'number of recent checkpoints to keep')
+flags.DEFINE_float('average_decay', 0., 'decay of the weight average saved with every checkpoint, 0 to disable')
 
 FLAGS = flags.FLAGS
 
@@ -123,21 +133,27 @@ def main(unused_argv):
   loss_op, train_op = get_loss_and_train_op(out_op, logits, FLAGS.gradients_norm)
 
   sess = tf.Session()
-  saver = tf.train.Saver()
+  saver = tf.train.Saver(max_to_keep=FLAGS.keep_checkpoints)
   if not os.path.exists(FLAGS.checkpoint_path):
     os.mkdir(FLAGS.checkpoint_path)
 
   sess.run(tf.global_variables_initializer())
+  checkpointer = AsyncCheckpointer(
+    sess, saver, FLAGS.keep_checkpoints, FLAGS.average_decay,
+    enabled=FLAGS.async_checkpoint)
   iteration = 0
+  step_timer = StepTimer(100, enabled=FLAGS.report_stalls)
 
   for e in range(FLAGS.num_epochs):
     batches = get_batches(in_text, out_text, FLAGS.batch_size, FLAGS.seq_size)
     new_state = sess.run(initial_state)
-    for x, y in batches:
+    for x, y in step_timer.iterate(batches):
       iteration += 1
-      loss, new_state, _ = sess.run(
-        [loss_op, state, train_op],
-        feed_dict={in_op: x, out_op: y, initial_state: new_state})
+      with step_timer.computing():
+        loss, new_state, _ = sess.run(
+          [loss_op, state, train_op],
+          feed_dict={in_op: x, out_op: y, initial_state: new_state})
+      step_timer.end_step(x.size)
       if iteration % 100 == 0:
         print('Epoch: {}/{}'.format(e, FLAGS.num_epochs),
               'Iteration: {}'.format(iteration),
@@ -147,13 +163,13 @@ def main(unused_argv):
                 sess, val_in_op, val_initial_state,
                 val_preds, val_state, n_vocab,
                 vocab_to_int, int_to_vocab)
-        saver.save(
-          sess,
+        checkpointer.save(
           os.path.join(FLAGS.checkpoint_path, 'model-{}.ckpt'.format(iteration)))
 
-  saver.save(
-    sess,
+  checkpointer.save(
     os.path.join(FLAGS.checkpoint_path, 'model-final.ckpt'))
+  checkpointer.close()
+  step_timer.report()
 
 if __name__ == '__main__':
   tf.app.run()
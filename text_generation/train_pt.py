@@ -5,8 +5,13 @@ import torch.nn.functional as F
 import numpy as np
 from collections import Counter
 import os
+import sys
 from argparse import Namespace
 
+# common/ holds the modules shared by all the projects
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.step_timer import StepTimer
+
 
 flags = Namespace(
     train_file='harry.txt',
@@ -18,6 +23,7 @@ flags = Namespace(
     initial_words=['I', 'am'],
     predict_top_k=5,
     checkpoint_path='checkpoint',
+    report_stalls=False,
 )
 
 
@@ -122,35 +128,40 @@ def main():
     criterion, optimizer = get_loss_and_train_op(net, 0.01)
 
     iteration = 0
+    step_timer = StepTimer(100, enabled=flags.report_stalls)
 
     for e in range(200):
         batches = get_batches(in_text, out_text, flags.batch_size, flags.seq_size)
         state_h, state_c = net.zero_state(flags.batch_size)
         state_h = state_h.to(device)
         state_c = state_c.to(device)
-        for x, y in batches:
+        for x, y in step_timer.iterate(batches):
             iteration += 1
             net.train()
 
-            optimizer.zero_grad()
+            # Host to device copy, reported apart from waiting for the batch
+            with step_timer.copying():
+                x = torch.tensor(x).to(device)
+                y = torch.tensor(y).to(device)
 
-            x = torch.tensor(x).to(device)
-            y = torch.tensor(y).to(device)
+            with step_timer.computing():
+                optimizer.zero_grad()
 
-            logits, (state_h, state_c) = net(x, (state_h, state_c))
-            loss = criterion(logits.transpose(1, 2), y)
+                logits, (state_h, state_c) = net(x, (state_h, state_c))
+                loss = criterion(logits.transpose(1, 2), y)
 
-            loss_value = loss.item()
+                loss_value = loss.item()
 
-            loss.backward()
+                loss.backward()
 
-            state_h = state_h.detach()
-            state_c = state_c.detach()
+                state_h = state_h.detach()
+                state_c = state_c.detach()
 
-            _ = torch.nn.utils.clip_grad_norm_(
-                net.parameters(), flags.gradients_norm)
+                _ = torch.nn.utils.clip_grad_norm_(
+                    net.parameters(), flags.gradients_norm)
 
-            optimizer.step()
+                optimizer.step()
+            step_timer.end_step(x.numel())
 
             if iteration % 100 == 0:
                 print('Epoch: {}/{}'.format(e, 200),
@@ -163,6 +174,8 @@ def main():
                 torch.save(net.state_dict(),
                            'checkpoint_pt/model-{}.pth'.format(iteration))
 
+    step_timer.report()
+
 
 if __name__ == '__main__':
     main()
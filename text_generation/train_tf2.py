@@ -1,8 +1,13 @@
 import os
+import sys
 from collections import Counter
 import numpy as np
 import tensorflow as tf
 
+# common/ holds the modules shared by all the projects
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.step_timer import StepTimer
+
 
 flags = tf.compat.v1.app.flags
 
@@ -19,6 +24,8 @@ flags.DEFINE_integer('predict_top_k', 5, 'top k results to sample word from')
 flags.DEFINE_integer('num_epochs', 20, 'Number of epochs to train')
 flags.DEFINE_string('checkpoint_path', 'checkpoint',
                     'directory to store trained weights')
+flags.DEFINE_boolean('report_stalls', False,
+                     'report time spent waiting for data and computing per step')
 
 FLAGS = flags.FLAGS
 
@@ -128,11 +135,15 @@ def main():
     optimizer = tf.keras.optimizers.Adam()
     
     loss_func = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+    step_timer = StepTimer(100, enabled=FLAGS.report_stalls)
     for e in range(FLAGS.num_epochs):
         state = model.zero_state(FLAGS.batch_size)
 
-        for (batch, (inputs, targets)) in enumerate(dataset.take(steps_per_epoch)):
-            loss = train_func(inputs, targets, model, state, loss_func, optimizer)
+        for (batch, (inputs, targets)) in enumerate(
+                step_timer.iterate(dataset.take(steps_per_epoch))):
+            with step_timer.computing():
+                loss = train_func(inputs, targets, model, state, loss_func, optimizer)
+            step_timer.end_step(np.prod(inputs.shape))
 
             if batch % 100 == 0:
                 print('Epoch: {}/{}'.format(e, FLAGS.num_epochs),
@@ -142,6 +153,8 @@ def main():
             if batch % 300 == 0:
                 predict(model, vocab_to_int, int_to_vocab, n_vocab)
 
+    step_timer.report()
+
 
 if __name__ == '__main__':
     main()